@@ -2,3 +2,4 @@ from net import Net
 # from layers import (BLSTMLayer,
 #                     BidirectionalLayer, BidirectionalRecurrentLayer)
 from source import ToySource, NILMTKSource, RealApplianceSource
+from replay import ReplaySource
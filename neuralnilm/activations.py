@@ -0,0 +1,351 @@
+from __future__ import print_function, division
+import os
+from os.path import join, exists, abspath
+import hashlib
+import numpy as np
+import pandas as pd
+from .timeseries import NS_PER_SEC
+
+# Increment when the way activations are found or stored changes, to
+# invalidate existing caches.
+CACHE_VERSION = 2
+
+
+class ActivationBuffer(object):
+    def __init__(self, values, offsets, lengths, starts=None,
+                 sample_period=None, tz=None):
+        """All activations for one appliance stored in a single ragged
+        float32 buffer.
+
+        Parameters
+        ----------
+        values : 1D np.ndarray
+            All activations, concatenated.
+        offsets, lengths : 1D int np.ndarrays
+            Activation i is values[offsets[i]:offsets[i]+lengths[i]]
+        starts : 1D int64 np.ndarray, optional
+            Start time of each activation in nanoseconds since the
+            epoch (UTC).
+        sample_period : int, optional
+            Seconds between samples.
+        tz : str, optional
+            Timezone used when converting activations back to pd.Series.
+
+        Attributes
+        ----------
+        ids : 1D int np.ndarray
+            The activations which have not been popped.  Integer indexing
+            and len() only see these.
+        """
+        self.values = np.asarray(values, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.starts = None if starts is None else np.asarray(
+            starts, dtype=np.int64)
+        self.sample_period = sample_period
+        self.tz = tz
+        self.ids = np.arange(len(self.offsets))
+
+    @classmethod
+    def from_series(cls, activations, sample_period=None):
+        """
+        Parameters
+        ----------
+        activations : list of pd.Series
+        sample_period : int, optional
+        """
+        lengths = np.array([len(a) for a in activations], dtype=np.int64)
+        offsets = np.zeros(len(lengths), dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)[:-1]
+        if activations:
+            values = np.concatenate([a.values for a in activations])
+            starts = [a.index[0].value for a in activations]
+            tz = activations[0].index.tz
+            tz = None if tz is None else str(tz)
+        else:
+            values = []
+            starts = []
+            tz = None
+        return cls(values, offsets, lengths, starts=starts,
+                   sample_period=sample_period, tz=tz)
+
+    @classmethod
+    def from_array(cls, power, starts, ends, sample_period, start=0,
+                   tz=None):
+        """
+        Parameters
+        ----------
+        power : 1D np.ndarray
+            Regularly sampled.
+        starts, ends : 1D int np.ndarrays
+            Activation i is power[starts[i]:ends[i]], e.g. from
+            `find_activations`.
+        sample_period : int
+            Seconds.
+        start : int
+            Time of power[0] in nanoseconds since the epoch (UTC).
+        tz : str, optional
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        lengths = np.asarray(ends, dtype=np.int64) - starts
+        segment_ids, positions = ragged_indices(lengths)
+        values = power[starts[segment_ids] + positions]
+        offsets = np.cumsum(lengths) - lengths
+        start_times = start + (starts * sample_period * NS_PER_SEC)
+        return cls(values, offsets, lengths, starts=start_times,
+                   sample_period=sample_period, tz=tz)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        activation_id = self.ids[i]
+        start = self.offsets[activation_id]
+        return self.values[start:start+self.lengths[activation_id]]
+
+    def pop(self, i):
+        activation = self[i]
+        self.ids = np.delete(self.ids, i)
+        return activation
+
+    def popped_ids(self):
+        """Ids of the activations which have been popped."""
+        return np.setdiff1d(np.arange(len(self.offsets)), self.ids)
+
+    def remove(self, activation_ids):
+        """Pop the activations with these ids (not indices).  Ids which
+        have already been popped are ignored."""
+        self.ids = np.setdiff1d(self.ids, activation_ids)
+
+    def to_series(self, i):
+        activation_id = self.ids[i]
+        freq = "{:d}S".format(self.sample_period)
+        index = pd.date_range(
+            start=pd.Timestamp(self.starts[activation_id], tz='UTC'),
+            periods=self.lengths[activation_id], freq=freq)
+        if self.tz is not None:
+            index = index.tz_convert(self.tz)
+        return pd.Series(self[i], index=index)
+
+    def to_series_list(self):
+        return [self.to_series(i) for i in range(len(self))]
+
+    def save(self, filename):
+        """Save as a single file: the values array in .npy format followed
+        by the index arrays and metadata, also in .npy format.  The file is
+        written to a temporary name and then renamed so readers never
+        see a partially written file."""
+        ids = self.ids
+        starts = (np.zeros(len(ids), dtype=np.int64) if self.starts is None
+                  else self.starts[ids])
+        index = np.vstack([self.offsets[ids], self.lengths[ids], starts])
+        metadata = np.array([
+            str(self.sample_period or ''), str(self.tz or '')])
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as fh:
+            np.save(fh, self.values)
+            np.save(fh, index)
+            np.save(fh, metadata)
+        os.rename(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, mmap_mode='r'):
+        """Load a file written by `save()`.  The values array is
+        memory-mapped unless `mmap_mode` is None."""
+        with open(filename, 'rb') as fh:
+            major, minor = np.lib.format.read_magic(fh)
+            if major == 1:
+                read_header = np.lib.format.read_array_header_1_0
+            else:
+                read_header = np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(fh)
+            values_offset = fh.tell()
+            n_values = int(np.prod(shape))
+            if mmap_mode is None or n_values == 0:
+                values = np.fromfile(fh, dtype=dtype, count=n_values)
+            else:
+                values = np.memmap(filename, dtype=dtype, mode=mmap_mode,
+                                   offset=values_offset, shape=shape)
+                fh.seek(values_offset + n_values * dtype.itemsize)
+            offsets, lengths, starts = np.load(fh)
+            sample_period, tz = np.load(fh)
+        return cls(values, offsets, lengths, starts=starts,
+                   sample_period=int(sample_period) if sample_period else None,
+                   tz=str(tz) if tz else None)
+
+
+def activations_cache_key(filename, **params):
+    """Key for a set of activations loaded from dataset `filename`.
+
+    The size and modification time of `filename` are part of the key, so
+    cached activations are invalidated when the dataset changes.
+
+    Parameters
+    ----------
+    filename : str
+        The nilmtk HDF5 file.
+    **params
+        Everything which affects the loaded activations, e.g. building,
+        appliance, on_power_threshold, min_on_duration, min_off_duration,
+        sample_period, window, max_power.
+    """
+    stat = os.stat(filename)
+    key = [CACHE_VERSION, abspath(filename), stat.st_size,
+           int(stat.st_mtime)]
+    key += sorted(params.items())
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def is_cached(cache_dir, key):
+    """True if activations are cached under `key` in `cache_dir`."""
+    return cache_dir is not None and exists(join(cache_dir, key + '.npy'))
+
+
+def load_cached_activations(cache_dir, key, load_func, logger=None):
+    """Return activations from `cache_dir` if they have already been
+    cached under `key`, else call `load_func` and cache the result.
+
+    Parameters
+    ----------
+    cache_dir : str or None
+        If None then always call `load_func`.
+    key : str
+        See `activations_cache_key`.
+    load_func : function
+        Takes no arguments and returns an ActivationBuffer.
+    logger : logging.Logger, optional
+
+    Returns
+    -------
+    ActivationBuffer
+    """
+    if cache_dir is None:
+        return load_func()
+    filename = join(cache_dir, key + '.npy')
+    if exists(filename):
+        if logger is not None:
+            logger.info("    Loading cached activations from " + filename)
+        return ActivationBuffer.load(filename)
+    activations = load_func()
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not exists(cache_dir):
+            raise
+    activations.save(filename)
+    return activations
+
+
+def ragged_indices(lengths):
+    """Flattened indices into a set of ragged segments.
+
+    Parameters
+    ----------
+    lengths : 1D int np.ndarray
+
+    Returns
+    -------
+    segment_ids, positions : 1D int np.ndarrays
+        Each of length lengths.sum().  Element j belongs to segment
+        segment_ids[j] at position positions[j] within that segment.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    segment_ids = np.repeat(np.arange(len(lengths)), lengths)
+    segment_starts = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) - np.repeat(segment_starts, lengths)
+    return segment_ids, positions
+
+
+def find_activations(power, sample_period, on_power_threshold=5,
+                     min_on_duration=0, min_off_duration=0, border=1):
+    """Find appliance activations in a regularly sampled power array.
+
+    Gives the same activations as nilmtk's
+    `activation_series_for_chunk`, using run-lengths of the on/off
+    state instead of a list of pd.Series:
+
+    * Samples at or above `on_power_threshold` are on.  An activation
+      runs from a switch-on to the next switch-off; runs which are
+      already on at the first sample or still on at the last sample are
+      ignored.
+    * Off periods shorter than `min_off_duration` are merged into the
+      surrounding activations.
+    * Activations shorter than `min_on_duration` are dropped.
+    * Each activation is extended by `border` samples at the end and
+      `border + 1` samples at the start.
+    * Activations containing a NaN are dropped.
+
+    Parameters
+    ----------
+    power : 1D np.ndarray
+    sample_period : int
+        Seconds.
+    on_power_threshold : float
+        Watts.
+    min_on_duration, min_off_duration : int
+        Seconds.
+    border : int
+        Samples.
+
+    Returns
+    -------
+    starts, ends : 1D int np.ndarrays
+        Activation i is power[starts[i]:ends[i]].
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    power = np.asarray(power)
+    with np.errstate(invalid='ignore'):
+        when_on = power >= on_power_threshold
+    state_changes = np.diff(when_on.astype(np.int8))
+    switch_on_events = np.flatnonzero(state_changes == 1) + 1
+    switch_off_events = np.flatnonzero(state_changes == -1) + 1
+    if len(switch_on_events) == 0 or len(switch_off_events) == 0:
+        return empty, empty
+
+    # Make sure events align
+    if switch_off_events[0] < switch_on_events[0]:
+        switch_off_events = switch_off_events[1:]
+        if len(switch_off_events) == 0:
+            return empty, empty
+    if switch_on_events[-1] > switch_off_events[-1]:
+        switch_on_events = switch_on_events[:-1]
+        if len(switch_on_events) == 0:
+            return empty, empty
+
+    # Smooth over off-durations less than min_off_duration
+    if min_off_duration > 0:
+        off_durations = (
+            switch_on_events[1:] - switch_off_events[:-1]) * sample_period
+        above_threshold_off_durations = np.flatnonzero(
+            off_durations >= min_off_duration)
+        switch_off_events = switch_off_events[np.concatenate(
+            [above_threshold_off_durations, [len(switch_off_events)-1]])]
+        switch_on_events = switch_on_events[np.concatenate(
+            [[0], above_threshold_off_durations+1])]
+
+    on_durations = (switch_off_events - switch_on_events) * sample_period
+    long_enough = on_durations >= min_on_duration
+    starts = np.maximum(switch_on_events[long_enough] - 1 - border, 0)
+    ends = np.minimum(switch_off_events[long_enough] + border, len(power))
+
+    # Throw away any activation with any NaN values
+    n_nans = np.concatenate([[0], np.cumsum(np.isnan(power))])
+    no_nans = (n_nans[ends] - n_nans[starts]) == 0
+    return starts[no_nans].astype(np.int64), ends[no_nans].astype(np.int64)
+
+
+def remove_incomplete(power, sample_period, on_power_threshold=5):
+    """Zero everything in `power` except complete activations, found
+    with `find_activations`.  Where activations' borders overlap their
+    power is summed, as when adding nilmtk's activation pd.Series.
+
+    Returns
+    -------
+    1D np.ndarray, the same length as `power`.
+    """
+    starts, ends = find_activations(
+        power, sample_period, on_power_threshold=on_power_threshold)
+    segment_ids, positions = ragged_indices(ends - starts)
+    indices = starts[segment_ids] + positions
+    return np.bincount(indices, weights=power[indices],
+                       minlength=len(power)).astype(power.dtype)
@@ -0,0 +1,112 @@
+from __future__ import print_function, division
+import multiprocessing
+from Queue import Empty, Full
+from time import time
+import traceback
+from .producer import MessageLog, replay_messages
+
+
+class CheckpointWriter(object):
+    def __init__(self, net, max_backlog=2):
+        """Writes checkpoints taken by `Net.checkpoint()` in a worker
+        process, so that HDF5 writes and plotting do not stall training.
+
+        The worker is forked from the training process the first time a
+        checkpoint is submitted and writes with its own copy of the Net.
+        Each checkpoint carries everything which changes during training
+        (parameter values, network outputs, costs), so the worker never
+        runs Theano code, and is safe even if training uses the GPU.
+
+        Parameters
+        ----------
+        net : Net
+        max_backlog : int
+            Maximum number of checkpoints waiting to be written.  Once
+            the backlog is full `submit()` blocks until the worker
+            catches up.
+        """
+        self.net = net
+        self.max_backlog = max_backlog
+        self._worker = None
+
+    def start(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._checkpoints = multiprocessing.Queue(maxsize=self.max_backlog)
+        self._statuses = multiprocessing.Queue()
+        self._worker = multiprocessing.Process(
+            target=_write_checkpoints,
+            args=(self.net, self._checkpoints, self._statuses))
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, checkpoint):
+        """Queue `checkpoint` to be written, waiting if the backlog is
+        full.  Also logs the outcome of any finished checkpoints."""
+        self.poll()
+        if self._worker is not None and not self._worker.is_alive():
+            self.net.logger.error(
+                "Checkpoint writer died with exit code {}.  Restarting it."
+                .format(self._worker.exitcode))
+            self._worker = None
+        self.start()
+        try:
+            self._checkpoints.put(checkpoint, block=False)
+        except Full:
+            self.net.logger.info(
+                "Waiting for the checkpoint writer to catch up...")
+            t0 = time()
+            self._checkpoints.put(checkpoint)
+            self.net.logger.info(
+                "Waited {:.1f}s for the checkpoint writer."
+                .format(time() - t0))
+
+    def poll(self):
+        """Log the outcome of every checkpoint which has finished."""
+        if self._worker is None:
+            return
+        while True:
+            try:
+                iteration, messages, duration, error = self._statuses.get(
+                    block=False)
+            except Empty:
+                break
+            replay_messages(messages, self.net.logger)
+            if error is None:
+                self.net.logger.info(
+                    "Finished writing checkpoint for iteration {:d} in"
+                    " {:.1f}s.".format(iteration, duration))
+            else:
+                self.net.logger.error(
+                    "Failed to write checkpoint for iteration {:d}:\n{}"
+                    .format(iteration, error))
+
+    def stop(self):
+        """Wait for every queued checkpoint to be written, then stop the
+        worker."""
+        if self._worker is None:
+            return
+        if self._worker.is_alive():
+            self._checkpoints.put(None)
+            self._worker.join()
+        self.poll()
+        self._worker = None
+
+
+def _write_checkpoints(net, checkpoints, statuses):
+    """Main loop of the worker process."""
+    while True:
+        checkpoint = checkpoints.get()
+        if checkpoint is None:
+            break
+        t0 = time()
+        log = MessageLog()
+        net.logger = log
+        try:
+            net.write_checkpoint(checkpoint)
+        except Exception:
+            error = traceback.format_exc()
+        else:
+            error = None
+        statuses.put(
+            (checkpoint['iteration'], log.messages, time() - t0, error))
@@ -0,0 +1,277 @@
+from __future__ import print_function, division
+import os
+from os.path import join, exists, getsize
+import json
+import csv
+import math
+import heapq
+from collections import deque
+import numpy as np
+
+COLUMNS = 'columns.json'
+DTYPE = np.dtype('<f8')
+
+
+class CostLog(object):
+    def __init__(self, directory, columns=(), flush_interval=100, fsync=True):
+        """Append-only table of numbers, e.g. the cost at each iteration.
+
+        Each column is stored as a raw little-endian float64 file in
+        `directory`, so appending a chunk of rows is one write per column
+        and truncating the log is one `truncate()` per column.  Rows are
+        buffered in memory and written every `flush_interval` rows.
+
+        If a previous process died part-way through a flush, the columns
+        may have different lengths.  They are truncated to the shortest
+        when the log is opened, so the log always holds whole rows.
+
+        Parameters
+        ----------
+        directory : str
+            Created when the log is first flushed.  Rows already in the
+            directory are kept.
+        columns : list of str
+            Columns which every log starts with.  Other columns are added
+            when a row first has a value for them, and are NaN for
+            earlier rows.
+        flush_interval : int
+        fsync : bool
+            If True then `os.fsync` each column after it is written, so
+            flushed rows survive a crash of the machine.
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.columns = []
+        self._buffer = []
+        self._n_flushed = 0
+        self._columns_changed = False
+        if exists(join(directory, COLUMNS)):
+            with open(join(directory, COLUMNS)) as fh:
+                self.columns = json.load(fh)
+            self._n_flushed = min(
+                [self._n_rows_on_disk(column) for column in self.columns] or
+                [0])
+            self._truncate_files(self._n_flushed)
+        self._add_columns(columns)
+
+    def __len__(self):
+        return self._n_flushed + len(self._buffer)
+
+    def append(self, row):
+        """
+        Parameters
+        ----------
+        row : dict
+            Maps from column name to a number.  Missing columns are NaN.
+        """
+        self._add_columns(row.keys())
+        self._buffer.append(row)
+        if len(self._buffer) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self._columns_changed:
+            self._write_columns()
+        for column in self.columns:
+            values = np.array(
+                [row.get(column, np.nan) for row in self._buffer],
+                dtype=DTYPE)
+            with open(self._filename(column), 'ab') as fh:
+                fh.write(values.tobytes())
+                self._sync(fh)
+        self._n_flushed += len(self._buffer)
+        self._buffer = []
+
+    def read(self, columns=None):
+        """
+        Returns
+        -------
+        dict mapping from each column name to an array of all its rows,
+        including rows which have not been flushed yet.
+        """
+        if columns is None:
+            columns = self.columns
+        data = {}
+        for column in columns:
+            if self._n_flushed:
+                flushed = np.fromfile(
+                    self._filename(column), dtype=DTYPE,
+                    count=self._n_flushed)
+            else:
+                flushed = np.empty(0, dtype=DTYPE)
+            buffered = np.array(
+                [row.get(column, np.nan) for row in self._buffer],
+                dtype=DTYPE)
+            data[column] = np.concatenate([flushed, buffered])
+        return data
+
+    def truncate(self, n_rows):
+        """Keep only the first `n_rows` rows."""
+        if n_rows >= len(self):
+            return
+        if n_rows >= self._n_flushed:
+            del self._buffer[n_rows - self._n_flushed:]
+            return
+        self._buffer = []
+        self._n_flushed = n_rows
+        self._truncate_files(n_rows)
+
+    def to_csv(self, filename, columns=None):
+        """Write the log as a CSV file with a header row."""
+        if columns is None:
+            columns = self.columns
+        data = self.read(columns)
+        with open(filename, 'w') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(columns)
+            np.savetxt(fh, np.column_stack([data[c] for c in columns]),
+                       delimiter=',', fmt='%.12g')
+
+    def _add_columns(self, columns):
+        new_columns = [c for c in columns if c not in self.columns]
+        if not new_columns:
+            return
+        self.columns.extend(new_columns)
+        self._columns_changed = True
+        if self._n_flushed:
+            # Write the new columns before listing them, so a crash in
+            # between cannot make the log look empty.
+            nans = np.full(self._n_flushed, np.nan, dtype=DTYPE)
+            for column in new_columns:
+                with open(self._filename(column), 'wb') as fh:
+                    fh.write(nans.tobytes())
+                    self._sync(fh)
+            self._write_columns()
+
+    def _write_columns(self):
+        if not exists(self.directory):
+            os.makedirs(self.directory)
+        tmp_filename = join(self.directory, COLUMNS + '.tmp')
+        with open(tmp_filename, 'w') as fh:
+            json.dump(self.columns, fh)
+            self._sync(fh)
+        os.rename(tmp_filename, join(self.directory, COLUMNS))
+        self._columns_changed = False
+
+    def _truncate_files(self, n_rows):
+        for column in self.columns:
+            filename = self._filename(column)
+            if not exists(filename):
+                continue
+            with open(filename, 'r+b') as fh:
+                fh.truncate(n_rows * DTYPE.itemsize)
+                self._sync(fh)
+
+    def _n_rows_on_disk(self, column):
+        filename = self._filename(column)
+        if not exists(filename):
+            return 0
+        return getsize(filename) // DTYPE.itemsize
+
+    def _filename(self, column):
+        return join(self.directory, column + '.f8')
+
+    def _sync(self, fh):
+        if self.fsync:
+            fh.flush()
+            os.fsync(fh.fileno())
+
+
+class CostTracker(object):
+    def __init__(self, k=25, window=500):
+        """Summary statistics of a growing series of costs, updated in
+        O(log k) per cost rather than recomputed from the whole series.
+
+        Parameters
+        ----------
+        k : int
+            Keep the mean of the `k` lowest costs.
+        window : int
+            Keep the mean of the last `window` costs.
+
+        Attributes
+        ----------
+        best : float
+            Lowest cost so far (NaN costs are ignored), or None.
+        best_iteration : int
+            Iteration of the first occurrence of `best`.
+        """
+        self.k = k
+        self.window = window
+        self.best = None
+        self.best_iteration = None
+        self.n = 0
+        # Max-heap of the k lowest costs, as negative costs
+        self._lowest = []
+        self._recent = deque(maxlen=window)
+        self._recent_sum = 0.0
+        self._n_recent_nans = 0
+        self._n_since_resum = 0
+
+    @classmethod
+    def from_costs(cls, costs, iterations=None, **kwargs):
+        tracker = cls(**kwargs)
+        if iterations is None:
+            iterations = range(len(costs))
+        for cost, iteration in zip(costs, iterations):
+            tracker.append(cost, iteration)
+        return tracker
+
+    def append(self, cost, iteration=None):
+        """
+        Parameters
+        ----------
+        cost : float
+        iteration : int, optional
+            Defaults to the number of costs appended before this one.
+        """
+        if iteration is None:
+            iteration = self.n
+        self.n += 1
+        cost = float(cost)
+
+        # NaNs are counted rather than summed, so one NaN cannot poison
+        # the sum for the rest of the run
+        if len(self._recent) == self.window:
+            oldest = self._recent[0]
+            if math.isnan(oldest):
+                self._n_recent_nans -= 1
+            else:
+                self._recent_sum -= oldest
+        self._recent.append(cost)
+        if math.isnan(cost):
+            self._n_recent_nans += 1
+        else:
+            self._recent_sum += cost
+        # Re-add the window now and then, so rounding errors can't build up
+        self._n_since_resum += 1
+        if self._n_since_resum >= self.window:
+            self._recent_sum = math.fsum(
+                c for c in self._recent if not math.isnan(c))
+            self._n_since_resum = 0
+
+        if math.isnan(cost):
+            return
+        if self.best is None or cost < self.best:
+            self.best = cost
+            self.best_iteration = iteration
+        if len(self._lowest) < self.k:
+            heapq.heappush(self._lowest, -cost)
+        elif cost < -self._lowest[0]:
+            heapq.heapreplace(self._lowest, -cost)
+
+    def mean_of_lowest(self):
+        """Mean of the `k` lowest costs."""
+        if not self._lowest:
+            return np.nan
+        return -math.fsum(self._lowest) / len(self._lowest)
+
+    def mean_of_recent(self):
+        """Mean of the last `window` costs, ignoring NaNs."""
+        n_valid = len(self._recent) - self._n_recent_nans
+        if not n_valid:
+            return np.nan
+        return self._recent_sum / n_valid
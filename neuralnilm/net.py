@@ -35,6 +35,10 @@ from lasagne.updates import nesterov_momentum
 from lasagne.objectives import squared_error
 
 from .source import quantize
+from .replay import (ValidationSet, render_batches, is_rendered,
+                     validation_set_key)
+from .checkpoint import CheckpointWriter
+from .costlog import CostLog, CostTracker
 from .layers import MixtureDensityLayer
 from .utils import sfloatX, none_to_dict, ndim_tensor
 from .plot import Plotter
@@ -52,6 +56,18 @@ class TrainingError(Exception):
     pass
 
 
+TRAINING_COST_COLUMNS = ['iteration', 'train_cost', 'duration']
+VALIDATION_COST_COLUMNS = ['iteration', 'validation_cost']
+# Seconds spent in each phase of an iteration of the training loop,
+# the number of batches ready when `source.get()` was called, and the
+# seconds the producer spent generating the batch.
+PHASES = ['callbacks', 'get_batch', 'train', 'validation', 'save', 'log']
+TIMING_COLUMNS = ['iteration'] + PHASES + ['queue_depth', 'generation_time']
+# For the summary in <experiment_name>_best_costs.txt
+N_BEST_COSTS = 25
+N_RECENT_COSTS = 500
+
+
 # ####################### Neural network class ########################
 class Net(object):
     # Much of this code is adapted from craffel/nntools/examples/lstm.py
@@ -71,13 +87,66 @@ class Net(object):
                  do_save_activations=True,
                  plotter=Plotter(),
                  auto_reshape=True,
-                 logger=None):
+                 logger=None,
+                 n_validation_batches=1,
+                 validation_data_path=None,
+                 checkpoint_in_background=False,
+                 max_checkpoint_backlog=2,
+                 cost_log_flush_interval=100,
+                 profile=False,
+                 activations_n_seq=None,
+                 activations_time_steps=None,
+                 activations_dtype=None,
+                 chunk_activations=False):
         """
         Parameters
         ----------
+        source : Source or None
+            May be None if `validation_data_path` holds a saved
+            validation set, e.g. for disaggregation.
         layers_config : list of dicts.  Keys are:
             'type' : BLSTMLayer or a subclass of lasagne.layers.Layer
             'num_units' : int
+        n_validation_batches : int
+            The validation cost is the mean cost over this many batches.
+        validation_data_path : str, optional
+            Directory of a validation set saved by
+            `replay.render_batches`.  Rendered from `source` if it does
+            not exist.  If None then the validation set is saved in
+            `<experiment_name>_validation_<key>`, where the key depends
+            on the source's configuration, so it is only generated once
+            per configuration.
+        checkpoint_in_background : bool
+            If True then `save()` only takes a snapshot of the parameters,
+            network outputs and costs, and a CheckpointWriter process
+            writes the HDF5 files and plots.
+        max_checkpoint_backlog : int
+            Number of checkpoints which may wait to be written before
+            `save()` blocks.
+        cost_log_flush_interval : int
+            The training and validation costs are kept in CostLogs, which
+            are written to disk (and `<experiment_name>_best_costs.txt`
+            updated) every this many iterations, at each checkpoint and at
+            the end of `fit()`.  The CSV files are exported at the end of
+            `fit()`.  The time spent in each phase of every iteration is
+            also logged, in `<experiment_name>_timings`, and summarised at
+            the end of `fit()`.
+        profile : bool
+            If True then compile the Theano functions with profiling, and
+            write per-op summaries to `<experiment_name>_profile.txt` at
+            the end of `fit()`.
+        activations_n_seq : int, optional
+            Only save the activations (and validation data) for the first
+            this many sequences of the validation batch.
+        activations_time_steps : slice, optional
+            Only save these time steps of each sequence,
+            e.g. `slice(None, None, 4)` for every fourth time step.
+        activations_dtype : numpy dtype, optional
+            e.g. np.float16 to halve the size of the saved activations.
+        chunk_activations : bool
+            If True then store each sequence's activations as its own
+            HDF5 chunk, so one sequence can be read without decompressing
+            the others.
         """
         if logger is None:
             self.logger = logging.getLogger(experiment_name)
@@ -103,15 +172,31 @@ class Net(object):
         self.layer_changes = none_to_dict(layer_changes)
         self.epoch_callbacks = none_to_dict(epoch_callbacks)
         self.do_save_activations = do_save_activations
+        self.activations_n_seq = activations_n_seq
+        self.activations_time_steps = activations_time_steps
+        self.activations_dtype = activations_dtype
+        self.chunk_activations = chunk_activations
+        self._activations_func = None
         self.plotter = plotter
         self.plotter.net = self
         self.auto_reshape = auto_reshape
+        self.n_validation_batches = n_validation_batches
+        self.validation_data_path = validation_data_path
+        self.cost_log_flush_interval = cost_log_flush_interval
+        self.cost_logs = {}
+        self.profile = profile
+        if checkpoint_in_background:
+            self.checkpoint_writer = CheckpointWriter(
+                self, max_backlog=max_checkpoint_backlog)
+        else:
+            self.checkpoint_writer = None
 
         self.set_csv_filenames()
         self.generate_validation_data_and_set_shapes()
 
         self.validation_costs = []
         self.training_costs = []
+        self._reset_cost_trackers()
         self.training_costs_metadata = []
         self.layers = []
         self.layer_labels = {}
@@ -133,17 +218,73 @@ class Net(object):
             'training_costs_metadata':
                 self.experiment_name + "_training_costs_metadata.csv",
             'best_costs': self.experiment_name + "_best_costs.txt",
+            'profile': self.experiment_name + "_profile.txt"
+        }
+        for cost_log in self.cost_logs.values():
+            cost_log.flush()
+        self.cost_logs = {
+            'training_costs': CostLog(
+                self.experiment_name + "_training_costs",
+                columns=TRAINING_COST_COLUMNS,
+                flush_interval=self.cost_log_flush_interval),
+            'validation_costs': CostLog(
+                self.experiment_name + "_validation_costs",
+                columns=VALIDATION_COST_COLUMNS,
+                flush_interval=self.cost_log_flush_interval),
+            'timings': CostLog(
+                self.experiment_name + "_timings",
+                columns=TIMING_COLUMNS,
+                flush_interval=self.cost_log_flush_interval)
         }
 
     def generate_validation_data_and_set_shapes(self):
-        # Generate a "validation" sequence whose cost we will compute
-        self.validation_batch = self.source.validation_data()
-        self.X_val, self.y_val = self.validation_batch.data
-        self.input_shape = self.X_val.shape
+        """Open the validation set for the source's current configuration,
+        rendering it first if it has not been saved yet.  Only the shapes
+        are read now.  The batches are loaded when first used."""
+        path = self.validation_data_path
+        if path is None:
+            if self.source is None:
+                raise ValueError(
+                    "Need either a source or a validation_data_path.")
+            key = validation_set_key(self.source, self.n_validation_batches)
+            path = "{}_validation_{}".format(self.experiment_name, key[:12])
+        if not is_rendered(path):
+            if self.source is None:
+                raise ValueError(
+                    "No validation set in '{}' and no source to generate"
+                    " one from.".format(path))
+            self.logger.info("Generating validation set in " + path)
+            render_batches(self.source, path, n_batches=0,
+                           n_validation_batches=self.n_validation_batches)
+        self.validation_set = ValidationSet(path)
+        if self.source is not None:
+            # The set may have been rendered by an earlier run, from
+            # another instance of the source.
+            self.source.remove_training_data(
+                self.validation_set.removed_training_data)
+        self.input_shape = self.validation_set.input_shape
         self.n_seq_per_batch = self.input_shape[0]
-        self.output_shape = self.y_val.shape
+        self.output_shape = self.validation_set.output_shape
         self.n_outputs = self.output_shape[-1]
 
+    @property
+    def validation_batch(self):
+        return self.validation_set[0]
+
+    @property
+    def X_val(self):
+        return self.validation_batch.data[0]
+
+    @property
+    def y_val(self):
+        return self.validation_batch.data[1]
+
+    def compute_validation_cost(self):
+        """Mean cost over all validation batches."""
+        costs = [self.compute_cost(*batch.data)[0].flatten()[0]
+                 for batch in self.validation_set]
+        return np.mean(costs)
+
     def add_layers(self, layers_config):
         for layer_config in layers_config:
             layer_type = layer_config.pop('type')
@@ -157,8 +298,8 @@ class Net(object):
                 if layer_type in RECURRENT_LAYERS:
                     if n_dims == 2:
                         seq_length = int(prev_layer_output_shape[0] /
-                                         self.source.n_seq_per_batch)
-                        shape = (self.source.n_seq_per_batch,
+                                         self.n_seq_per_batch)
+                        shape = (self.n_seq_per_batch,
                                  seq_length,
                                  n_features)
                         reshape_layer = ReshapeLayer(self.layers[-1], shape)
@@ -168,7 +309,7 @@ class Net(object):
                         # The prev layer_config was a time-aware layer_config,
                         # so reshape to 2-dims.
                         seq_length = prev_layer_output_shape[1]
-                        shape = (self.source.n_seq_per_batch * seq_length,
+                        shape = (self.n_seq_per_batch * seq_length,
                                  n_features)
                         reshape_layer = ReshapeLayer(self.layers[-1], shape)
                         self.layers.append(reshape_layer)
@@ -229,8 +370,12 @@ class Net(object):
 
     def compile(self):
         self.logger.info("Compiling Theano functions...")
-        target_output = ndim_tensor(name='target_output', ndim=self.y_val.ndim)
-        network_input = ndim_tensor(name='network_input', ndim=self.X_val.ndim)
+        # Compiled on first use, for the new layers
+        self._activations_func = None
+        target_output = ndim_tensor(
+            name='target_output', ndim=len(self.output_shape))
+        network_input = ndim_tensor(
+            name='network_input', ndim=len(self.input_shape))
         output_layer = self.layers[-1]
 
         # Training
@@ -257,7 +402,8 @@ class Net(object):
             outputs=loss_train,
             updates=updates,
             on_unused_input='warn',
-            allow_input_downcast=True)
+            allow_input_downcast=True,
+            profile=self._profile('train'))
 
         deterministic_output = lasagne.layers.get_output(
             output_layer, network_input, deterministic=True)
@@ -266,26 +412,54 @@ class Net(object):
             inputs=[network_input],
             outputs=deterministic_output,
             on_unused_input='warn',
-            allow_input_downcast=True)
+            allow_input_downcast=True,
+            profile=self._profile('y_pred'))
 
         self.compute_cost = theano.function(
             inputs=[network_input, target_output],
             outputs=[loss_eval, deterministic_output],
             on_unused_input='warn',
-            allow_input_downcast=True)
+            allow_input_downcast=True,
+            profile=self._profile('compute_cost'))
 
         self.logger.info("Done compiling Theano functions.")
 
+    def _profile(self, name):
+        """The `profile` argument for `theano.function`."""
+        if not self.profile:
+            return None
+        return theano.compile.ProfileStats(
+            message="{} {}".format(self.experiment_name, name))
+
+    def write_profile(self):
+        """Write Theano's per-op profile of each compiled function."""
+        if not self.profile:
+            return
+        with open(self.csv_filenames['profile'], 'w') as fh:
+            for name in ('train', 'y_pred', 'compute_cost'):
+                func = getattr(self, name, None)
+                profile = getattr(func, 'profile', None)
+                if profile is not None and profile.fct_callcount:
+                    profile.summary(file=fh)
+        self.logger.info(
+            "Wrote Theano profile to " + self.csv_filenames['profile'])
+
     def fit(self, n_iterations=None):
         # Training loop. Need to wrap this in a try-except loop so
         # we can always call self.source.stop()
         self.source.start()
+        first_iteration = len(self.training_costs)
         try:
             self._training_loop(n_iterations)
         except:
             raise
         finally:
             self.source.stop()
+            self.export_cost_csvs()
+            self.logger.info(self.timing_report(first_iteration))
+            self.write_profile()
+            if self.checkpoint_writer is not None:
+                self.checkpoint_writer.stop()
 
     def _change_layers(self, epoch):
         self.source.stop()
@@ -304,62 +478,23 @@ class Net(object):
         self.compile()
         self.source.start()
 
-    def _save_training_costs_metadata(self):
-        if not self.training_costs_metadata:
-            return
-        keys = self.training_costs_metadata[-1].keys()
-        n_iterations = self.n_iterations()
-        if n_iterations == 0:
-            mode = 'w'
-        else:
-            mode = 'a'
-        with open(self.csv_filenames['training_costs_metadata'], mode) as fh:
-            writer = csv.DictWriter(fh, fieldnames=keys)
-            if n_iterations == 0:
-                writer.writeheader()
-            writer.writerow(self.training_costs_metadata[-1])
-
-    def print_and_save_training_progress(self, duration):
+    def print_and_save_training_progress(self, duration, metadata=None):
         iteration = self.n_iterations()
         train_cost = self.training_costs[-1]
         validation_cost = (self.validation_costs[-1] if self.validation_costs
                            else None)
-        _write_csv_row(self.csv_filenames['training_costs'],
-                       [iteration, train_cost, duration])
-        self._save_training_costs_metadata()
-        best_train_cost = min(self.training_costs)
-        best_valid_cost = min(self.validation_costs)
+        row = {'iteration': iteration, 'train_cost': train_cost,
+               'duration': duration}
+        if metadata:
+            row.update(metadata)
+        self.cost_logs['training_costs'].append(row)
+        if not iteration % self.cost_log_flush_interval:
+            self._flush_cost_logs()
+        best_train_cost = self.cost_trackers['training_costs'].best
+        best_valid_cost = self.cost_trackers['validation_costs'].best
         is_best_train = train_cost == best_train_cost
         is_best_valid = validation_cost == best_valid_cost
 
-        # write bests to disk
-        FMT = "{:14.10f}"
-        N = 500
-        K = 25
-        txt = (
-            "BEST COSTS\n" +
-            ("best train cost =" + FMT + " at iteration{:6d}\n").format(
-                best_train_cost, self.training_costs.index(best_train_cost)) +
-            ("best valid cost =" + FMT + " at iteration{:6d}\n").format(
-                best_valid_cost,
-                self.validation_costs.index(best_valid_cost) *
-                self.validation_interval) +
-            "\n" +
-            "AVERAGE FOR THE TOP {:d} ITERATIONS\n".format(K) +
-            (" avg train cost =" + FMT + "\n").format(
-                np.mean(np.sort(self.training_costs)[:K])) +
-            (" avg valid cost =" + FMT + "\n").format(
-                np.mean(np.sort(self.validation_costs)[:K])) +
-            "\n" +
-            "AVERAGE COSTS FOR THE LAST {:d} ITERATIONS\n".format(N) +
-            (" avg train cost =" + FMT + "\n").format(
-                np.mean(self.training_costs[-N:])) +
-            (" avg valid cost =" + FMT + "\n").format(
-                np.mean(self.validation_costs[-N:]))
-        )
-        with open(self.csv_filenames['best_costs'], mode='w') as fh:
-            fh.write(txt)
-
         # print bests to screen
         print("  {:>5} |  {}{:>10.6f}{}  |  {}{:>10.6f}{}  |"
               "  {:>11.6f}  |  {:>.3f}s".format(
@@ -376,19 +511,80 @@ class Net(object):
         if np.isnan(train_cost):
             msg = "training cost is NaN at iteration {}!".format(iteration)
             self.logger.error(msg)
+            self._flush_cost_logs()
             raise TrainingError(msg)
 
-    def _write_csv_headers(self, key='all'):
-        if key in ['all', 'training_costs']:
-            _write_csv_row(
-                self.csv_filenames['training_costs'],
-                row=['iteration', 'train_cost', 'duration'],
-                mode='w')
-        if key in ['all', 'validation_costs']:
-            _write_csv_row(
-                self.csv_filenames['validation_costs'],
-                row=['iteration', 'validation_cost'],
-                mode='w')
+    def _flush_cost_logs(self):
+        """Write buffered costs to disk and update the best costs file."""
+        for cost_log in self.cost_logs.values():
+            cost_log.flush()
+        if self.training_costs and self.validation_costs:
+            self._write_best_costs()
+
+    def export_cost_csvs(self):
+        """Write the cost logs as `csv_filenames['training_costs']`,
+        `['validation_costs']` and `['training_costs_metadata']`."""
+        self._flush_cost_logs()
+        training_log = self.cost_logs['training_costs']
+        training_log.to_csv(
+            self.csv_filenames['training_costs'], TRAINING_COST_COLUMNS)
+        metadata_columns = [column for column in training_log.columns
+                            if column not in TRAINING_COST_COLUMNS]
+        if metadata_columns:
+            training_log.to_csv(
+                self.csv_filenames['training_costs_metadata'],
+                metadata_columns)
+        self.cost_logs['validation_costs'].to_csv(
+            self.csv_filenames['validation_costs'], VALIDATION_COST_COLUMNS)
+
+    def _reset_cost_trackers(self):
+        """Rebuild the CostTrackers from `training_costs` and
+        `validation_costs`."""
+        self.cost_trackers = {
+            'training_costs': CostTracker.from_costs(
+                self.training_costs, k=N_BEST_COSTS,
+                window=N_RECENT_COSTS),
+            'validation_costs': CostTracker.from_costs(
+                self.validation_costs,
+                iterations=range(0, len(self.validation_costs) *
+                                 self.validation_interval,
+                                 self.validation_interval),
+                k=N_BEST_COSTS, window=N_RECENT_COSTS)
+        }
+
+    def _write_best_costs(self):
+        train = self.cost_trackers['training_costs']
+        valid = self.cost_trackers['validation_costs']
+        FMT = "{:14.10f}"
+
+        def best_cost(name, tracker):
+            line = "best {} cost =" + FMT
+            if tracker.best is None:
+                # Every cost so far is NaN
+                return (line + "\n").format(name, np.nan)
+            return (line + " at iteration{:6d}\n").format(
+                name, tracker.best, tracker.best_iteration)
+
+        txt = (
+            "BEST COSTS\n" +
+            best_cost('train', train) +
+            best_cost('valid', valid) +
+            "\n" +
+            "AVERAGE FOR THE TOP {:d} ITERATIONS\n".format(N_BEST_COSTS) +
+            (" avg train cost =" + FMT + "\n").format(
+                train.mean_of_lowest()) +
+            (" avg valid cost =" + FMT + "\n").format(
+                valid.mean_of_lowest()) +
+            "\n" +
+            "AVERAGE COSTS FOR THE LAST {:d} ITERATIONS\n".format(
+                N_RECENT_COSTS) +
+            (" avg train cost =" + FMT + "\n").format(
+                train.mean_of_recent()) +
+            (" avg valid cost =" + FMT + "\n").format(
+                valid.mean_of_recent())
+        )
+        with open(self.csv_filenames['best_costs'], mode='w') as fh:
+            fh.write(txt)
 
     @property
     def learning_rate(self):
@@ -412,10 +608,12 @@ class Net(object):
 """)
         iteration = self.n_iterations()
         if iteration == 0:
-            self._write_csv_headers()
+            for cost_log in self.cost_logs.values():
+                cost_log.truncate(0)
 
         while iteration != n_iterations:
             t0 = time()  # for calculating training duration
+            timer = _PhaseTimer(t0)
             iteration = len(self.training_costs)
             if iteration in self.learning_rate_changes_by_iteration:
                 self.learning_rate = (
@@ -424,41 +622,145 @@ class Net(object):
                 self._change_layers(iteration)
             if iteration in self.epoch_callbacks:
                 self.epoch_callbacks[iteration](self, iteration)
+            timer.end('callbacks')
+            queue_depth = self.source.qsize()
             batch = self.source.get()
+            timer.end('get_batch')
             X, y = batch.data
             train_cost = self.train(X, y).flatten()[0]
+            timer.end('train')
             self.training_costs.append(train_cost)
+            self.cost_trackers['training_costs'].append(
+                train_cost, iteration)
             if batch.metadata:
                 self.training_costs_metadata.append(batch.metadata)
             if not iteration % self.validation_interval:
-                validation_cost = self.compute_cost(self.X_val, self.y_val)[0]
-                validation_cost = validation_cost.flatten()[0]
+                validation_cost = self.compute_validation_cost()
                 self.validation_costs.append(validation_cost)
-                _write_csv_row(
-                    self.csv_filenames['validation_costs'],
-                    row=[iteration, validation_cost])
+                self.cost_trackers['validation_costs'].append(
+                    validation_cost, iteration)
+                self.cost_logs['validation_costs'].append(
+                    {'iteration': iteration,
+                     'validation_cost': validation_cost})
+            timer.end('validation')
             if not iteration % self.save_plot_interval:
                 self.save()
+            timer.end('save')
             duration = time() - t0
-            self.print_and_save_training_progress(duration)
+            self.print_and_save_training_progress(duration, batch.metadata)
+            timer.end('log')
+            timings = dict(timer.durations)
+            timings['iteration'] = iteration
+            if queue_depth is not None:
+                timings['queue_depth'] = queue_depth
+            if batch.generation_time is not None:
+                timings['generation_time'] = batch.generation_time
+            self.cost_logs['timings'].append(timings)
         self.logger.info("Finished training")
 
+    def timing_report(self, first_iteration=0):
+        """Summary of the timings logged since `first_iteration`."""
+        data = self.cost_logs['timings'].read()
+        keep = data['iteration'] >= first_iteration
+        n_iterations = keep.sum()
+        if not n_iterations:
+            return "No timings for iterations >= {:d}".format(
+                first_iteration)
+        data = dict((column, values[keep]) for column, values in data.items())
+        total = sum(data[phase].sum() for phase in PHASES)
+        lines = [
+            "Timings for {:d} iterations from iteration {:d}"
+            " ({:.1f}s in total):".format(
+                n_iterations, int(data['iteration'][0]), total),
+            "  {:>10} | {:>9} | {:>9} | {:>9} | {:>6}".format(
+                "phase", "mean (s)", "median", "max", "share")]
+        for phase in PHASES:
+            times = data[phase]
+            lines.append(
+                "  {:>10} | {:9.4f} | {:9.4f} | {:9.4f} | {:5.1f}%".format(
+                    phase, times.mean(), np.median(times), times.max(),
+                    100 * times.sum() / total if total else 0))
+        queue_depth = data['queue_depth']
+        queue_depth = queue_depth[~np.isnan(queue_depth)]
+        if len(queue_depth):
+            lines.append(
+                "  Batches ready when fetched: mean {:.2f}; queue empty for"
+                " {:.1f}% of fetches".format(
+                    queue_depth.mean(), 100 * (queue_depth == 0).mean()))
+        generation_time = data['generation_time']
+        generation_time = generation_time[~np.isnan(generation_time)]
+        if len(generation_time):
+            lines.append(
+                "  Producer: mean {:.4f}s to generate each batch".format(
+                    generation_time.mean()))
+        return "\n".join(lines)
+
     def save(self):
-        self.logger.info("Saving plots...")
+        self._flush_cost_logs()
+        checkpoint = self.checkpoint()
+        if self.checkpoint_writer is None:
+            self.write_checkpoint(checkpoint)
+        else:
+            self.checkpoint_writer.submit(checkpoint)
+
+    def checkpoint(self):
+        """Copy everything `write_checkpoint` needs which changes during
+        training.  This is the only part of `save()` which runs Theano."""
+        checkpoint = {
+            'iteration': self.n_iterations(),
+            'training_costs': list(self.training_costs),
+            'validation_costs': list(self.validation_costs),
+            'training_costs_metadata': list(self.training_costs_metadata),
+            'ylim': self.plotter.ylim,
+            'params': self._param_values(),
+            'estimates': None,
+            'activations': None
+        }
         try:
-            self.plotter.plot_all()
+            checkpoint['estimates'] = self.plotter.get_estimates()
         except:
             self.logger.exception("")
-        self.logger.info("Saving params...")
+        if self.do_save_activations:
+            try:
+                checkpoint['activations'] = self._activations()
+            except:
+                self.logger.exception("")
+        # Taken last because plotting draws training batches from the
+        # source, so a resumed run carries on with the batch which an
+        # uninterrupted run would have used next.
+        checkpoint['batch_index'] = self._source_batch_index()
+        return checkpoint
+
+    def _source_batch_index(self):
+        if self.source is None:
+            return None
+        return self.source.batch_index
+
+    def write_checkpoint(self, checkpoint):
+        """Save plots, params and activations from a checkpoint taken by
+        `checkpoint()`."""
+        self.training_costs = checkpoint['training_costs']
+        self.validation_costs = checkpoint['validation_costs']
+        self.training_costs_metadata = checkpoint['training_costs_metadata']
+        self.plotter.ylim = checkpoint['ylim']
+        iteration = checkpoint['iteration']
+        self.logger.info("Saving plots...")
         try:
-            self.save_params()
+            self.plotter.plot_all(estimates=checkpoint['estimates'])
         except:
             self.logger.exception("")
-        self.logger.info("Saving activations...")
+        self.logger.info("Saving params...")
         try:
-            self.save_activations()
+            self._write_params(checkpoint['params'], iteration,
+                               batch_index=checkpoint['batch_index'])
         except:
             self.logger.exception("")
+        if checkpoint['activations'] is not None:
+            self.logger.info("Saving activations...")
+            try:
+                self._write_activations(checkpoint['activations'], iteration)
+            except:
+                self.logger.exception("")
         self.logger.info("Finished saving.")
 
     def n_iterations(self):
@@ -469,12 +771,48 @@ class Net(object):
         Save it to HDF in the following format:
             /epoch<N>/L<I>_<type>/P<I>_<name>
         """
+        self._write_params(self._param_values(), self.n_iterations(),
+                           filename, self._source_batch_index())
+
+    def _param_values(self):
+        """
+        Returns
+        -------
+        list of (layer_name, [(param_name, value)]) for each layer with
+        params, where each value is a copy.
+        """
+        param_values = []
+        layers = get_all_layers(self.layers[-1])
+        for layer_i, layer in enumerate(layers):
+            params = layer.get_params()
+            if not params:
+                continue
+            layer_name = 'L{:02d}_{}'.format(layer_i, layer.__class__.__name__)
+            values = []
+            for param_i, param in enumerate(params):
+                param_name = 'P{:02d}'.format(param_i)
+                if param.name:
+                    param_name += "_" + param.name
+                values.append((param_name, param.get_value(borrow=False)))
+            param_values.append((layer_name, values))
+        return param_values
+
+    def _write_params(self, param_values, iteration, filename=None,
+                      batch_index=None):
+        """
+        Parameters
+        ----------
+        batch_index : int, optional
+            The source's next training batch.  Saved as the
+            'source_batch_index' attribute of the epoch group, for
+            `load_params` to seek to.
+        """
         if filename is None:
             filename = self.experiment_name + ".hdf5"
 
-        mode = 'w' if self.n_iterations() == 0 else 'a'
+        mode = 'w' if iteration == 0 else 'a'
         f = h5py.File(filename, mode=mode)
-        epoch_name = 'epoch{:06d}'.format(self.n_iterations())
+        epoch_name = 'epoch{:06d}'.format(iteration)
         try:
             epoch_group = f.create_group(epoch_name)
         except ValueError:
@@ -482,18 +820,11 @@ class Net(object):
             f.close()
             return
 
-        layers = get_all_layers(self.layers[-1])
-        for layer_i, layer in enumerate(layers):
-            params = layer.get_params()
-            if not params:
-                continue
-            layer_name = 'L{:02d}_{}'.format(layer_i, layer.__class__.__name__)
+        if batch_index is not None:
+            epoch_group.attrs['source_batch_index'] = batch_index
+        for layer_name, values in param_values:
             layer_group = epoch_group.create_group(layer_name)
-            for param_i, param in enumerate(params):
-                param_name = 'P{:02d}'.format(param_i)
-                if param.name:
-                    param_name += "_" + param.name
-                data = param.get_value()
+            for param_name, data in values:
                 layer_group.create_dataset(
                     param_name, data=data, compression="gzip")
 
@@ -513,6 +844,9 @@ class Net(object):
         f = h5py.File(filename, mode='r')
         epoch_name = 'epoch{:06d}'.format(iteration)
         epoch_group = f[epoch_name]
+        # Files saved before the batch index was recorded
+        batch_index = int(epoch_group.attrs.get(
+            'source_batch_index', iteration))
 
         layers = get_all_layers(self.layers[-1])
         for layer_i, layer in enumerate(layers):
@@ -531,43 +865,18 @@ class Net(object):
         self.logger.info('Done loading params from ' + filename + '.')
 
         # LOAD COSTS
-        def load_csv(key, limit):
-            filename = self.csv_filenames[key]
-            if path is not None:
-                filename = join(path, filename)
-            data = np.genfromtxt(filename, delimiter=',', skip_header=1)
-            data = data[:limit, :]
-
-            # overwrite costs file
-            self._write_csv_headers(key)
-            with open(filename, mode='a') as fh:
-                np.savetxt(fh, data, delimiter=',')
-            return list(data[:, 1])
-
-        self.training_costs = load_csv('training_costs', iteration)
-        self.validation_costs = load_csv(
-            'validation_costs', iteration // self.validation_interval)
-
-        # LOAD TRAINING COSTS METADATA
-        metadata_fname = self.csv_filenames['training_costs_metadata']
-        if path is not None:
-            metadata_fname = join(path, metadata_fname)
-        try:
-            metadata_fh = open(metadata_fname, 'r')
-        except IOError:
-            pass
-        else:
-            reader = csv.DictReader(metadata_fh)
-            training_costs_metadata = [row for row in reader]
-            keys = training_costs_metadata[-1].keys()
-            metadata_fh.close()
-            self.training_costs_metadata = training_costs_metadata[:iteration]
-            if len(training_costs_metadata) > iteration:
-                # Overwrite old file
-                with open(metadata_fname, 'w') as metadata_fh:
-                    writer = csv.DictWriter(metadata_fh, keys)
-                    writer.writeheader()
-                    writer.writerows(self.training_costs_metadata)
+        self.training_costs, self.training_costs_metadata = self._load_costs(
+            'training_costs', iteration, path)
+        self.validation_costs, _ = self._load_costs(
+            'validation_costs', iteration, path)
+        self._reset_cost_trackers()
+        timings = self.cost_logs['timings']
+        timings.truncate(np.searchsorted(
+            timings.read(['iteration'])['iteration'], iteration))
+
+        # Carry on with the batches which would have followed `iteration`
+        if self.source is not None:
+            self.source.seek(batch_index)
 
         # set learning rate
         if self.learning_rate_changes_by_iteration:
@@ -585,52 +894,203 @@ class Net(object):
         for callback_iteration in callbacks_to_call:
             self.epoch_callbacks[callback_iteration](self, callback_iteration)
 
+    def _load_costs(self, key, iteration, path=None):
+        """Load the costs before `iteration` from the cost log in `path`
+        (or from the CSV files saved before there were cost logs) and
+        truncate this Net's cost log to match.
+
+        Returns
+        -------
+        costs : list
+        metadata : list of dicts
+            Only for batches which had metadata.
+        """
+        cost_log = self.cost_logs[key]
+        columns = (TRAINING_COST_COLUMNS if key == 'training_costs'
+                   else VALIDATION_COST_COLUMNS)
+        if path is None:
+            source_log = cost_log
+        else:
+            source_log = CostLog(join(path, cost_log.directory))
+        if len(source_log) or path is None and not exists(
+                self.csv_filenames[key]):
+            data = source_log.read()
+        else:
+            source_log = None
+            data = _read_cost_csvs(
+                self.csv_filenames, key, columns, path)
+        n_rows = np.searchsorted(data['iteration'], iteration)
+        data = dict((column, values[:n_rows])
+                    for column, values in data.items())
+        if source_log is cost_log:
+            cost_log.truncate(n_rows)
+        else:
+            # Copy the costs into this Net's cost log
+            cost_log.truncate(0)
+            rows = zip(*[data[column] for column in data])
+            for row in rows:
+                cost_log.append(dict(zip(data.keys(), row)))
+            cost_log.flush()
+
+        metadata_columns = [
+            column for column in data if column not in columns]
+        metadata = []
+        for row_i in range(n_rows):
+            row = dict((column, data[column][row_i])
+                       for column in metadata_columns
+                       if not np.isnan(data[column][row_i]))
+            if row:
+                metadata.append(row)
+        return list(data[columns[1]]), metadata
+
     def save_activations(self):
         if not self.do_save_activations:
             return
-        filename = self.experiment_name + "_activations.hdf5"
-        mode = 'w' if self.n_iterations() == 0 else 'a'
-        f = h5py.File(filename, mode=mode)
-        epoch_name = 'epoch{:06d}'.format(self.n_iterations())
-        try:
-            epoch_group = f.create_group(epoch_name)
-        except ValueError:
-            self.logger.exception("Cannot save params!")
-            f.close()
-            return
+        self._write_activations(self._activations(), self.n_iterations())
 
-        layers = get_all_layers(self.layers[-1])
-        for layer_i, layer in enumerate(layers):
+    def _compile_activations_func(self):
+        """Compile a function which returns the output of every layer
+        with params in one forward pass.
+
+        Returns
+        -------
+        layers : list of (layer_name, layer)
+        func : theano function
+            Takes the network input and returns a list of outputs.
+        """
+        self.logger.info("Compiling activations function...")
+        network_input = ndim_tensor(
+            name='network_input', ndim=len(self.input_shape))
+        layer_names = []
+        layers = []
+        for layer_i, layer in enumerate(get_all_layers(self.layers[-1])):
             # We only care about layers with params
             if not (layer.get_params() or isinstance(layer, FeaturePoolLayer)):
                 continue
+            layer_names.append(
+                'L{:02d}_{}'.format(layer_i, layer.__class__.__name__))
+            layers.append(layer)
+        if not layers:
+            return [], lambda X: []
+        outputs = lasagne.layers.get_output(layers, network_input)
+        func = theano.function(
+            inputs=[network_input],
+            outputs=outputs,
+            on_unused_input='ignore',
+            allow_input_downcast=True)
+        return list(zip(layer_names, layers)), func
 
-            output = lasagne.layers.get_output(layer, self.X_val).eval()
+    def _activations(self):
+        """
+        Returns
+        -------
+        list of (layer_name, output for the validation batch) for each
+        layer with params.  Reduced to `activations_n_seq`,
+        `activations_time_steps` and `activations_dtype`.
+        """
+        if self._activations_func is None:
+            self._activations_func = self._compile_activations_func()
+        layers, func = self._activations_func
+        outputs = func(self.X_val)
+        activations = []
+        for (layer_name, layer), output in zip(layers, outputs):
             n_features = output.shape[-1]
-            seq_length = int(output.shape[0] / self.source.n_seq_per_batch)
+            seq_length = int(output.shape[0] / self.n_seq_per_batch)
 
             if isinstance(layer, DenseLayer):
-                shape = (self.source.n_seq_per_batch, seq_length, n_features)
+                shape = (self.n_seq_per_batch, seq_length, n_features)
                 output = output.reshape(shape)
             elif isinstance(layer, Conv1DLayer):
                 output = output.transpose(0, 2, 1)
 
-            layer_name = 'L{:02d}_{}'.format(layer_i, layer.__class__.__name__)
-            epoch_group.create_dataset(
-                layer_name, data=output, compression="gzip")
+            activations.append((layer_name, self._reduce_activations(output)))
+        return activations
+
+    def _reduce_activations(self, data):
+        """Select `activations_n_seq` sequences and
+        `activations_time_steps` from `data`, if it has shape
+        (n_seq, seq_length, n_features), and cast to `activations_dtype`."""
+        if data.ndim == 3:
+            time_steps = self.activations_time_steps
+            data = data[:self.activations_n_seq,
+                        slice(None) if time_steps is None else time_steps]
+        if self.activations_dtype is not None:
+            data = data.astype(self.activations_dtype)
+        return np.ascontiguousarray(data)
+
+    def _write_activations(self, activations, iteration):
+        filename = self.experiment_name + "_activations.hdf5"
+        mode = 'w' if iteration == 0 else 'a'
+        f = h5py.File(filename, mode=mode)
+        epoch_name = 'epoch{:06d}'.format(iteration)
+        try:
+            epoch_group = f.create_group(epoch_name)
+        except ValueError:
+            self.logger.exception("Cannot save params!")
+            f.close()
+            return
+
+        def create_dataset(group, name, data):
+            if self.chunk_activations and data.ndim == 3 and data.size:
+                chunks = (1,) + data.shape[1:]
+            else:
+                chunks = None
+            group.create_dataset(
+                name, data=data, compression="gzip", chunks=chunks)
+
+        for layer_name, output in activations:
+            create_dataset(epoch_group, layer_name, output)
 
         # save validation data
-        if self.n_iterations() == 0:
-            f.create_dataset(
-                'validation_data', data=self.X_val, compression="gzip")
+        if iteration == 0:
+            create_dataset(
+                f, 'validation_data', self._reduce_activations(self.X_val))
 
         f.close()
 
 
-def _write_csv_row(filename, row, mode='a'):
-    with open(filename, mode=mode) as csvfile:
-        csv_writer = csv.writer(csvfile)
-        csv_writer.writerow(row)
+class _PhaseTimer(object):
+    """Records the seconds between successive calls to `end()`."""
+    def __init__(self, t0=None):
+        self.t = time() if t0 is None else t0
+        self.durations = {}
+
+    def end(self, phase):
+        t = time()
+        self.durations[phase] = t - self.t
+        self.t = t
+
+
+def _read_cost_csvs(csv_filenames, key, columns, path=None):
+    """Read costs from the CSV files written before there were cost logs.
+
+    Returns
+    -------
+    dict mapping from column name to array.
+    """
+    def filename(key):
+        if path is None:
+            return csv_filenames[key]
+        return join(path, csv_filenames[key])
+
+    costs = np.genfromtxt(
+        filename(key), delimiter=',', skip_header=1).reshape(-1, len(columns))
+    data = dict((column, costs[:, i]) for i, column in enumerate(columns))
+    if key == 'training_costs':
+        try:
+            metadata_fh = open(filename('training_costs_metadata'), 'r')
+        except IOError:
+            pass
+        else:
+            with metadata_fh:
+                metadata = list(csv.DictReader(metadata_fh))
+            # Only batches with metadata were recorded, so we can only use
+            # the metadata if every batch had some.
+            if metadata and len(metadata) >= len(costs):
+                for column in metadata[0]:
+                    data[column] = np.array(
+                        [float(row[column]) for row in metadata[:len(costs)]])
+    return data
 
 
 """
@@ -6,6 +6,7 @@ from matplotlib.pyplot import cm
 import numpy as np
 import h5py
 from scipy.stats import norm
+from .source import Batch
 
 
 def plot_activations(filename, epoch, seq_i=0, normalise=False):
@@ -38,9 +39,9 @@ class Plotter(object):
     def target_labels(self):
         return self.net.source.get_labels() if self.net is not None else []
 
-    def plot_all(self):
+    def plot_all(self, estimates=None):
         self.plot_costs()
-        self.plot_estimates()
+        self.plot_estimates(estimates)
 
     def plot_costs(self):
         fig, ax = plt.subplots(1)
@@ -91,10 +92,42 @@ class Plotter(object):
             'costs', fig, include_epochs=False, suffix='png', dpi=300)
         return ax
 
-    def plot_estimates(self):
-        validation_batch = self.net.validation_batch
+    def get_estimates(self):
+        """Network outputs for the validation batch and for
+        `n_training_examples_to_plot` training batches.
+
+        Returns
+        -------
+        (validation_batch, output), [(training_batch, output)]
+            The batches are copies, so they stay valid after the source
+            reuses its buffers.
+        """
+        def estimate(batch):
+            X, y = batch.data
+            target = batch.target_power_timeseries
+            batch = Batch(
+                data=(np.array(X), np.array(y)),
+                target_power_timeseries=(
+                    None if target is None else np.array(target)),
+                metadata=batch.metadata, index=batch.index)
+            return batch, self.net.y_pred(batch.data[0])
+
+        validation = estimate(self.net.validation_batch)
+        training = [estimate(self.net.source.get())
+                    for batch_i in range(self.n_training_examples_to_plot)]
+        return validation, training
+
+    def plot_estimates(self, estimates=None):
+        """
+        Parameters
+        ----------
+        estimates : optional
+            As returned by `get_estimates()`.  If None then call it.
+        """
+        if estimates is None:
+            estimates = self.get_estimates()
+        (validation_batch, output), training = estimates
         X, y = validation_batch.data
-        output = self.net.y_pred(X)
         X, y, output = self._process(X, y, output)
         sequences = range(min(self.net.n_seq_per_batch, self.n_seq_to_plot))
         for seq_i in sequences:
@@ -104,11 +137,9 @@ class Plotter(object):
                 metadata=validation_batch.metadata)
 
         # Training examples
-        for batch_i in range(self.n_training_examples_to_plot):
+        for batch_i, (train_batch, output) in enumerate(training):
             self.seq_i = 0
-            train_batch = self.net.source.get()
             X, y = train_batch.data
-            output = self.net.y_pred(X)
             X, y, output = self._process(X, y, output)
             fig, axes = self.create_estimates_fig(
                 X, y, output, train_batch.target_power_timeseries,
@@ -0,0 +1,276 @@
+from __future__ import print_function, division
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from Queue import Empty
+import traceback
+import logging
+from time import time
+import numpy as np
+
+# Positions of the arrays held in each shared-memory slot.
+X, Y, TARGET_POWER_TIMESERIES = range(3)
+
+
+class ProcessPoolProducer(object):
+    def __init__(self, source, n_workers=2, prefetch=2):
+        """Generates batches for `source` in a pool of worker processes.
+
+        Each worker writes finished batches into one of a fixed number of
+        shared-memory slots and only sends the slot number (and the batch
+        metadata) back to the trainer, so the arrays are never pickled.
+        Workers are forked, so they inherit `source` as it was when
+        `start()` was called.
+
+        Workers take consecutive batch indices from a shared counter,
+        starting at `source.batch_index`, and `get()` returns batches in
+        index order.  Because `source.get_batch(batch_index=i)` is a pure
+        function of i, the sequence of batches does not depend on the
+        number of workers.
+
+        The arrays returned by `get()` are views onto a slot and are only
+        valid until the next call to `get()`.
+
+        Parameters
+        ----------
+        source : Source
+        n_workers : int
+        prefetch : int
+            Number of finished batches which may be waiting for the trainer.
+        """
+        self.source = source
+        self.n_workers = n_workers
+        self.prefetch = prefetch
+        self._slots = None
+        self._workers = []
+        self._held_slot = None
+        self._pending = {}
+
+    def _allocate_slots(self, template):
+        """
+        Parameters
+        ----------
+        template : Batch
+            Used to find the shape and dtype of each array.
+        """
+        arrays = [template.data[0], template.data[1],
+                  template.target_power_timeseries]
+        n_slots = self.n_workers + self.prefetch + 1
+        self._slots = []
+        for slot_i in range(n_slots):
+            slot = []
+            for array in arrays:
+                if array is None:
+                    slot.append(None)
+                    continue
+                array = np.asarray(array)
+                shared = RawArray('b', max(array.nbytes, 1))
+                shared = np.frombuffer(shared, dtype=np.uint8)
+                shared = shared[:array.nbytes].view(array.dtype)
+                slot.append(shared.reshape(array.shape))
+            self._slots.append(slot)
+
+    def start(self):
+        if self._workers:
+            return
+        if self._slots is None:
+            self._allocate_slots(self.source.get_batch())
+        self._stop = multiprocessing.Event()
+        self._free_slots = multiprocessing.Queue()
+        self._ready = multiprocessing.Queue()
+        self._next_batch_index = multiprocessing.Value(
+            'l', self.source.batch_index)
+        self._expected_batch_index = self.source.batch_index
+        self._pending = {}
+        for slot_i in range(len(self._slots)):
+            self._free_slots.put(slot_i)
+        for worker_i in range(self.n_workers):
+            worker = multiprocessing.Process(
+                target=_produce, args=(self, worker_i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        if not self._workers:
+            return
+        self._stop.set()
+        self.empty_queue()
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+        self._held_slot = None
+
+    def is_running(self):
+        return bool(self._workers)
+
+    def get(self, timeout=30):
+        """
+        Returns
+        -------
+        data, target_power_timeseries, metadata, batch_index,
+        generation_time
+            `generation_time` is the number of seconds the worker spent
+            generating the batch.
+        """
+        self._release_held_slot()
+        batch_index = self._expected_batch_index
+        while batch_index not in self._pending:
+            slot_i, payload, overflow, ready_index, generation_time = (
+                self._ready.get(timeout=timeout))
+            if slot_i is None:
+                raise RuntimeError("Producer process failed:\n" + payload)
+            self._pending[ready_index] = (
+                slot_i, payload, overflow, generation_time)
+        slot_i, metadata, overflow, generation_time = self._pending.pop(
+            batch_index)
+        self._expected_batch_index += 1
+        self._held_slot = slot_i
+        arrays = list(self._slots[slot_i])
+        for array_i, array in overflow.items():
+            arrays[array_i] = array
+        return ((arrays[X], arrays[Y]), arrays[TARGET_POWER_TIMESERIES],
+                metadata, batch_index, generation_time)
+
+    def empty_queue(self):
+        """Discard all generated batches.  Only call after `stop()`,
+        otherwise `get()` will wait for a batch which has been discarded."""
+        self._release_held_slot()
+        for slot_i, _, _, _ in self._pending.values():
+            self._free_slots.put(slot_i)
+        self._pending = {}
+        while True:
+            try:
+                slot_i, _, _, _, _ = self._ready.get(block=False)
+            except Empty:
+                break
+            if slot_i is not None:
+                self._free_slots.put(slot_i)
+
+    def qsize(self):
+        try:
+            return self._ready.qsize() + len(self._pending)
+        except NotImplementedError:
+            return None
+
+    def _release_held_slot(self):
+        if self._held_slot is not None:
+            self._free_slots.put(self._held_slot)
+            self._held_slot = None
+
+    def _write(self, slot_i, batch):
+        """Copies `batch` into slot `slot_i`.
+
+        Returns
+        -------
+        overflow : dict
+            Maps from array position to any array which does not fit its
+            slot.  These are sent through the queue instead.
+        """
+        arrays = [batch.data[0], batch.data[1],
+                  batch.target_power_timeseries]
+        overflow = {}
+        for array_i, (array, shared) in enumerate(
+                zip(arrays, self._slots[slot_i])):
+            if array is None and shared is None:
+                continue
+            fits = (array is not None and shared is not None and
+                    np.shape(array) == shared.shape and
+                    np.asarray(array).dtype == shared.dtype)
+            if fits:
+                shared[...] = array
+            else:
+                overflow[array_i] = array
+        return overflow
+
+
+def _produce(producer, worker_i):
+    """Main loop of each worker process."""
+    source = producer.source
+    while not producer._stop.is_set():
+        try:
+            slot_i = producer._free_slots.get(timeout=0.1)
+        except Empty:
+            continue
+        # Only claim a batch index once we hold a slot, so the batch which
+        # `get()` is waiting for can always be written.
+        with producer._next_batch_index.get_lock():
+            batch_index = producer._next_batch_index.value
+            producer._next_batch_index.value += 1
+        try:
+            t0 = time()
+            batch = source.get_batch(batch_index=batch_index)
+            generation_time = time() - t0
+            overflow = producer._write(slot_i, batch)
+        except Exception:
+            producer._ready.put(
+                (None, traceback.format_exc(), None, batch_index, None))
+            return
+        producer._ready.put(
+            (slot_i, batch.metadata, overflow, batch_index, generation_time))
+
+
+class MessageLog(object):
+    """Stands in for a logging.Logger in a worker process.  Keeps the
+    messages, as (level, message) pairs, so the parent process can log
+    them with `replay()`."""
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append((logging.INFO, message))
+
+    def warning(self, message):
+        self.messages.append((logging.WARNING, message))
+
+    def error(self, message):
+        self.messages.append((logging.ERROR, message))
+
+    def exception(self, message):
+        self.error(message + "\n" + traceback.format_exc())
+
+    def replay(self, logger):
+        replay_messages(self.messages, logger)
+
+
+def replay_messages(messages, logger):
+    for level, message in messages:
+        logger.log(level, message)
+
+
+def map_in_processes(func, jobs, n_processes, logger):
+    """Apply `func(job, log)` to each job in a pool of worker processes.
+
+    Parameters
+    ----------
+    func : function
+        Must be defined at module level, so it can be pickled.  `log` is
+        a MessageLog.
+    jobs : list
+    n_processes : int
+    logger : logging.Logger
+        Messages logged by each job are logged here, in job order.
+
+    Returns
+    -------
+    list of results, in the same order as `jobs`.
+    """
+    pool = multiprocessing.Pool(n_processes)
+    results = []
+    try:
+        for result, messages in pool.imap(
+                _run_job, [(func, job) for job in jobs]):
+            replay_messages(messages, logger)
+            results.append(result)
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+
+def _run_job(args):
+    func, job = args
+    log = MessageLog()
+    result = func(job, log)
+    return result, log.messages
@@ -1,121 +1,177 @@
 from __future__ import print_function, division
 import numpy as np
-import sys
 from nilmtk.electric import activation_series_for_chunk
 
+THRESHOLD = 0.01
+ZERO_TOLERANCE = 1e-10
+
 
 def rectangularise(data, n_segments, format='proportional'):
+    """Approximate each sequence by `n_segments` constant segments.
+
+    Segments are split greedily: at each step the segment with the
+    largest sum of squared errors about its mean is split at the point
+    which minimises the summed squared error of the two halves.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Either one sequence (1D) or a batch of shape
+        (n_seq_per_batch, seq_length, n_outputs), of which only the first
+        output is used.
+    n_segments : int
+    format : {'proportional', 'changepoints', 'changepoints [0,1]'}
+
+    Returns
+    -------
+    For 1D data, the output for that sequence.  Otherwise a float32 array
+    of shape (n_seq_per_batch, n_features, 1) where n_features is
+    n_segments for 'proportional' and n_segments - 1 for the changepoint
+    formats.
+    """
     if data.ndim == 1:
-        return _rectangularise(data, n_segments=n_segments, format=format)
+        output = _rectangularise(data[np.newaxis, :], n_segments, format)
+        return output[0].tolist() if format == 'changepoints' else output[0]
     else:
-        n_seq_per_batch = data.shape[0]
-        n_features = n_segments if format == 'proportional' else n_segments - 1
-        output = np.empty((n_seq_per_batch, n_features, 1), dtype=np.float32)
-        for batch_i in range(n_seq_per_batch):
-            output[batch_i, :, 0] = _rectangularise(
-                data[batch_i, :, 0], n_segments=n_segments, format=format)
-        return output
+        output = _rectangularise(data[:, :, 0], n_segments, format)
+        return output[:, :, np.newaxis].astype(np.float32)
 
 
 def _rectangularise(data, n_segments, format='proportional'):
     """
     Parameters
     ----------
+    data : 2D np.ndarray of shape (n_seqs, seq_length)
     n_segments : int
     format : {'proportional', 'changepoints', 'changepoints [0,1]'}
     """
-    changepoints = []
+    n_seqs, n_samples = data.shape
+    cumsum, cumsum_sq = _prefix_sums(data)
+    # Sums of squared errors smaller than this are rounding error
+    tolerance = ZERO_TOLERANCE * cumsum_sq[:, -1:]
+    seq_i = np.arange(n_seqs)
+    changepoints = np.zeros((n_seqs, 0), dtype=np.int64)
+    zeros = np.zeros((n_seqs, 1), dtype=np.int64)
+    finished = np.zeros(n_seqs, dtype=bool)
     for segment_i in range(n_segments-1):
-        slice_with_highest_variance = _get_slice_with_highest_variance(
-            changepoints, data)
-        if slice_with_highest_variance is None:
-            # fill changepoints with zeros
-            n_zeros = n_segments - len(changepoints) - 1
-            changepoints += [0] * n_zeros
-            changepoints.sort()
-            break
-        chunk_with_highest_variance = data[slice_with_highest_variance]
-        changepoint = (_get_changepoint(chunk_with_highest_variance)
-                       + slice_with_highest_variance.start)
-        changepoints.append(changepoint)
-        changepoints.sort()
-    segment_widths = [end - start for start, end in
-                      zip([0] + changepoints, changepoints + [len(data)])]
-    segment_widths = np.array(segment_widths)
+        # The last segment stops one sample short of the end
+        starts = np.hstack([zeros, changepoints])
+        ends = np.hstack([changepoints, zeros + max(n_samples - 1, 0)])
+        errors = _sum_squared_error(
+            cumsum, cumsum_sq, seq_i[:, np.newaxis], starts, ends)
+        errors[errors <= tolerance] = 0
+        # Split the first segment with the largest error.  Sequences
+        # whose segments are all constant get changepoints at zero.
+        segment_to_split = errors.argmax(axis=1)
+        finished |= errors[seq_i, segment_to_split] == 0
+        changepoint = _get_changepoints(
+            cumsum, cumsum_sq, starts[seq_i, segment_to_split],
+            ends[seq_i, segment_to_split], tolerance[:, 0])
+        changepoint[finished] = 0
+        changepoints = np.sort(
+            np.hstack([changepoints, changepoint[:, np.newaxis]]), axis=1)
+
     if format == 'proportional':
-        total = segment_widths.sum()
-        if total == 0:
+        boundaries = np.hstack([zeros, changepoints, zeros + n_samples])
+        segment_widths = np.diff(boundaries, axis=1)
+        if n_samples == 0:
             return segment_widths
         else:
-            return segment_widths / total
+            return segment_widths / n_samples
     elif format == 'changepoints':
         return changepoints
     elif format == 'changepoints [0,1]':
-        return np.array(changepoints) / len(data)
+        return changepoints / n_samples
     else:
         raise RuntimeError("Unknown format: '{}'".format(format))
 
 
-def _get_changepoint(data):
-    n_samples = len(data)
-    best_error = sys.float_info.max
-    best_i = 0
-    for i in range(2, n_samples-2):
-        chunk1 = data[:i]
-        chunk2 = data[i:]
-        error = (chunk1.var() * (len(chunk1) / n_samples) +
-                 chunk2.var() * (len(chunk2) / n_samples))
-        if error < best_error:
-            best_error = error
-            best_i = i
-    return best_i
-
-
-def _get_slice_with_highest_variance(changepoints, data):
-    prev_changepoint = 0
-    highest_variance = -1.0
-    slice_with_highest_variance = None
-    for changepoint in changepoints + [-1]:
-        this_slice = slice(prev_changepoint, changepoint)
-        chunk = data[this_slice]
-        prev_changepoint = changepoint
-        variance = chunk.var() * (len(chunk) / len(data))
-        if variance > highest_variance:
-            highest_variance = variance
-            slice_with_highest_variance = this_slice
-    if highest_variance == 0:
-        return None
-    else:
-        return slice_with_highest_variance
+def _prefix_sums(data):
+    """Cumulative sums of `data` and `data`**2 along axis 1, with a
+    leading zero, so the sum over [a, b) is cumsum[:, b] - cumsum[:, a]."""
+    data = data.astype(np.float64)
+    shape = (data.shape[0], data.shape[1] + 1)
+    cumsum = np.zeros(shape)
+    cumsum_sq = np.zeros(shape)
+    np.cumsum(data, axis=1, out=cumsum[:, 1:])
+    np.cumsum(data ** 2, axis=1, out=cumsum_sq[:, 1:])
+    return cumsum, cumsum_sq
+
+
+def _sum_squared_error(cumsum, cumsum_sq, seq_i, starts, ends):
+    """Sum of squared errors about the mean of data[seq_i, start:end].
+    Zero for empty segments.  All index arguments broadcast together."""
+    n = np.maximum(ends - starts, 1)
+    total = cumsum[seq_i, ends] - cumsum[seq_i, starts]
+    total_sq = cumsum_sq[seq_i, ends] - cumsum_sq[seq_i, starts]
+    return np.maximum(total_sq - (total ** 2) / n, 0)
+
+
+def _get_changepoints(cumsum, cumsum_sq, starts, ends, tolerance):
+    """For each sequence, the split of data[start:end] which minimises the
+    summed squared error of the two halves.  Each half has at least two
+    samples and the second at least three.  If no split is possible then
+    return `start`.  Ties go to the earliest split.
+
+    Parameters
+    ----------
+    cumsum, cumsum_sq : 2D np.ndarrays from `_prefix_sums`
+    starts, ends : 1D int np.ndarrays, one element per sequence
+    tolerance : 1D np.ndarray
+        Errors within this of the minimum count as ties.
+    """
+    n_seqs, n_splits = cumsum.shape
+    seq_i = np.arange(n_seqs)[:, np.newaxis]
+    splits = np.arange(n_splits)[np.newaxis, :]
+    starts = starts[:, np.newaxis]
+    ends = ends[:, np.newaxis]
+    errors = (
+        _sum_squared_error(cumsum, cumsum_sq, seq_i, starts, splits) +
+        _sum_squared_error(cumsum, cumsum_sq, seq_i, splits, ends))
+    valid = (splits >= starts + 2) & (splits <= ends - 3)
+    errors[~valid] = np.inf
+    min_errors = errors.min(axis=1)[:, np.newaxis]
+    best = (errors <= min_errors + tolerance[:, np.newaxis]).argmax(axis=1)
+    return np.where(valid.any(axis=1), best, starts[:, 0])
 
 
 def start_and_end_and_mean(data):
-    if data.ndim == 1:
-        return _start_and_end_and_mean(data)
-    else:
-        n_seq_per_batch = data.shape[0]
-        n_outputs = data.shape[2]
-        output = np.empty((n_seq_per_batch, 3, n_outputs), dtype=np.float32)
-        for batch_i in range(n_seq_per_batch):
-            for output_i in range(n_outputs):
-                output[batch_i, :, output_i] = _start_and_end_and_mean(
-                    data[batch_i, :, output_i])
-        return output
+    """Index of the first and last sample above THRESHOLD (as a fraction
+    of the sequence length) and the mean from the first up to (not
+    including) the last.  All zeros if fewer than two samples are above
+    THRESHOLD.
 
+    Parameters
+    ----------
+    data : np.ndarray
+        Either one sequence (1D) or a batch of shape
+        (n_seq_per_batch, seq_length, n_outputs).
 
-def _start_and_end_and_mean(data):
-    THRESHOLD = 0.01
-    when_on = np.where(data > THRESHOLD)[0]
-    n = len(data)
-    if n < 2 or len(when_on) < 2:
-        start = end = mean = 0.0
-    else:
-        start = when_on[0]
-        end = when_on[-1]
-        mean = data[start:end].mean()
-        start /= n
-        end /= n
-    return np.array([start, end, mean], dtype=np.float32)
+    Returns
+    -------
+    float32 np.ndarray of shape (3,) for 1D data, otherwise
+    (n_seq_per_batch, 3, n_outputs).
+    """
+    if data.ndim == 1:
+        return start_and_end_and_mean(data[np.newaxis, :, np.newaxis])[0, :, 0]
+    n_seq_per_batch, n_samples, n_outputs = data.shape
+    output = np.zeros((n_seq_per_batch, 3, n_outputs), dtype=np.float32)
+    if n_samples < 2:
+        return output
+    when_on = data > THRESHOLD
+    valid = when_on.sum(axis=1) >= 2
+    start = when_on.argmax(axis=1)
+    end = n_samples - 1 - when_on[:, ::-1, :].argmax(axis=1)
+    cumsum = np.zeros((n_seq_per_batch, n_samples + 1, n_outputs))
+    np.cumsum(data, axis=1, out=cumsum[:, 1:, :])
+    seq_i = np.arange(n_seq_per_batch)[:, np.newaxis]
+    output_i = np.arange(n_outputs)[np.newaxis, :]
+    mean = ((cumsum[seq_i, end, output_i] - cumsum[seq_i, start, output_i]) /
+            np.maximum(end - start, 1))
+    output[:, 0, :] = np.where(valid, start / n_samples, 0)
+    output[:, 1, :] = np.where(valid, end / n_samples, 0)
+    output[:, 2, :] = np.where(valid, mean, 0)
+    return output
 
 
 """
@@ -0,0 +1,339 @@
+from __future__ import print_function, division
+import os
+from os.path import join, exists
+import json
+import pickle
+import hashlib
+import numpy as np
+from .source import Source, Batch
+
+# Increment when the layout of rendered batches changes.
+FORMAT_VERSION = 2
+MANIFEST = 'manifest.json'
+TRAIN, VALIDATION = 'train', 'validation'
+
+
+def render_batches(source, directory, n_batches, n_validation_batches=1,
+                   batches_per_shard=100, logger=None):
+    """Generate batches from `source` and save them in `directory`, for
+    `ReplaySource` to read back.
+
+    Training batch i is `source.get_batch(batch_index=i)` and validation
+    batch i is `source.get_batch(validation=True, batch_index=i)`, so
+    rendering the same source twice gives the same files.
+
+    Each shard of up to `batches_per_shard` batches is saved as one .npy
+    file per array (X, y and target_power_timeseries), each of shape
+    (n_batches_in_shard,) + the shape of one batch's array, plus a pickle
+    of each batch's metadata.  `manifest.json` is written last, so a
+    directory without one holds an incomplete set.
+
+    The validation batches are rendered first, and the training data
+    they removed from `source` is recorded in the manifest, so none of
+    it appears in the training batches or in a later run's source.
+
+    Parameters
+    ----------
+    source : Source
+    directory : str
+        Created if it does not exist.
+    n_batches, n_validation_batches : int
+    batches_per_shard : int
+    logger : logging.Logger, optional
+    """
+    if not exists(directory):
+        os.makedirs(directory)
+    if exists(join(directory, MANIFEST)):
+        os.remove(join(directory, MANIFEST))
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'source': source.__class__.__name__,
+        'seed': source.seed,
+        'seq_length': source.seq_length,
+        'n_seq_per_batch': source.n_seq_per_batch,
+        'n_inputs': source.n_inputs,
+        'n_outputs': source.n_outputs,
+        'batches_per_shard': batches_per_shard
+    }
+    for name, validation, n in [(VALIDATION, True, n_validation_batches),
+                                (TRAIN, False, n_batches)]:
+        manifest[name] = _render_set(
+            source, directory, name, validation, n, batches_per_shard,
+            logger)
+    manifest['removed_training_data'] = source.removed_training_data()
+    tmp_filename = join(directory, MANIFEST + '.tmp')
+    with open(tmp_filename, 'w') as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+    os.rename(tmp_filename, join(directory, MANIFEST))
+
+
+def _render_set(source, directory, name, validation, n_batches,
+                batches_per_shard, logger):
+    """
+    Returns
+    -------
+    dict with keys 'n_batches' and 'arrays', which maps from each
+    array name to its [shape, dtype] for one batch (or None if the
+    source's batches do not have that array).
+    """
+    arrays = None
+    shard = None
+    metadata = []
+    for batch_i in range(n_batches):
+        batch = source.get_batch(validation=validation, batch_index=batch_i)
+        batch_arrays = _arrays(batch)
+        if arrays is None:
+            arrays = dict(
+                (array_name, None if array is None else
+                 [list(array.shape), array.dtype.str])
+                for array_name, array in batch_arrays.items())
+        shard_i, i = divmod(batch_i, batches_per_shard)
+        if i == 0:
+            n_in_shard = min(batches_per_shard, n_batches - batch_i)
+            shard = _open_shard(directory, name, shard_i, arrays, n_in_shard)
+            metadata = []
+        for array_name, array in batch_arrays.items():
+            if shard[array_name] is None:
+                continue
+            if array is None or array.shape != shard[array_name].shape[1:]:
+                raise ValueError(
+                    "Batch {:d} has a different shape to the first batch for"
+                    " '{}'".format(batch_i, array_name))
+            shard[array_name][i] = array
+        metadata.append(batch.metadata)
+        if i == n_in_shard - 1:
+            _close_shard(directory, name, shard_i, shard, metadata)
+            if logger is not None:
+                logger.info("Rendered {} batches {:d} to {:d}".format(
+                    name, batch_i - i, batch_i))
+    return {'n_batches': n_batches, 'arrays': arrays}
+
+
+def _arrays(batch):
+    X, y = batch.data
+    target = batch.target_power_timeseries
+    return {'X': np.asarray(X),
+            'y': np.asarray(y),
+            'target_power_timeseries': (
+                None if target is None else np.asarray(target))}
+
+
+def _shard_filename(directory, name, shard_i, array_name):
+    if array_name == 'metadata':
+        ext = '.pkl'
+    else:
+        ext = '.npy'
+    return join(directory, '{}_{:05d}_{}{}'.format(
+        name, shard_i, array_name, ext))
+
+
+def _open_shard(directory, name, shard_i, arrays, n_batches):
+    shard = {}
+    for array_name, shape_and_dtype in arrays.items():
+        if shape_and_dtype is None:
+            shard[array_name] = None
+            continue
+        shape, dtype = shape_and_dtype
+        shard[array_name] = np.lib.format.open_memmap(
+            _shard_filename(directory, name, shard_i, array_name),
+            mode='w+', dtype=np.dtype(dtype), shape=tuple([n_batches] + shape))
+    return shard
+
+
+def _close_shard(directory, name, shard_i, shard, metadata):
+    for array in shard.values():
+        if array is not None:
+            array.flush()
+    with open(_shard_filename(directory, name, shard_i, 'metadata'),
+              'wb') as fh:
+        pickle.dump(metadata, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class ReplaySource(Source):
+    DATA_FIELDS = Source.DATA_FIELDS + ('directory', 'shuffle', 'manifest')
+
+    def __init__(self, directory, shuffle=True, seed=42, **kwargs):
+        """Streams batches saved by `render_batches`.
+
+        Shards are memory-mapped read-only, so each batch's arrays are
+        views onto the page cache rather than copies, and runs which
+        replay the same directory at the same time share that memory.
+
+        Parameters
+        ----------
+        directory : str
+        shuffle : bool
+            If True then each pass over the training batches visits them
+            in a new random order.  The order is a function of `seed`
+            and the pass number, so `seek()` works as for other sources.
+        seed : int
+        **kwargs
+            Passed to Source, e.g. logger, prefetch.
+        """
+        self.manifest = load_manifest(directory)
+        self.directory = directory
+        self.shuffle = shuffle
+        self.n_batches = self.manifest[TRAIN]['n_batches']
+        self.n_validation_batches = self.manifest[VALIDATION]['n_batches']
+        self._shards = {}
+        self._order = None
+        super(ReplaySource, self).__init__(
+            seq_length=self.manifest['seq_length'],
+            n_seq_per_batch=self.manifest['n_seq_per_batch'],
+            n_inputs=self.manifest['n_inputs'],
+            n_outputs=self.manifest['n_outputs'],
+            seed=seed,
+            **kwargs)
+
+    def input_shape_after_processing(self):
+        return tuple(self.manifest[TRAIN]['arrays']['X'][0])
+
+    def output_shape_after_processing(self):
+        return tuple(self.manifest[TRAIN]['arrays']['y'][0])
+
+    def get_batch(self, validation=False, batch_index=None):
+        """
+        Parameters
+        ----------
+        validation : bool
+        batch_index : int, optional
+            Training batch `batch_index` is drawn from pass
+            `batch_index // n_batches` over the rendered batches.
+            Validation batches are returned in rendered order.  If None
+            then pick a batch at random.
+        """
+        if validation:
+            name = VALIDATION
+            n_batches = self.n_validation_batches
+        else:
+            name = TRAIN
+            n_batches = self.n_batches
+        if n_batches == 0:
+            raise ValueError("No {} batches were rendered.".format(name))
+        if batch_index is None:
+            rendered_i = self.rng.randint(n_batches)
+        elif validation:
+            rendered_i = batch_index % n_batches
+        else:
+            rendered_i = self._rendered_index(batch_index)
+        shard_i, i = divmod(rendered_i, self.manifest['batches_per_shard'])
+        return _batch(self._shard(name, shard_i), i, batch_index)
+
+    def _rendered_index(self, batch_index):
+        if not self.shuffle:
+            return batch_index % self.n_batches
+        pass_i, i = divmod(batch_index, self.n_batches)
+        order = self._order
+        if order is None or order[0] != pass_i:
+            rng = np.random.RandomState([self.seed, pass_i])
+            order = self._order = (pass_i, rng.permutation(self.n_batches))
+        return order[1][i]
+
+    def _shard(self, name, shard_i):
+        shard = self._shards.get((name, shard_i))
+        if shard is None:
+            shard = self._shards[(name, shard_i)] = _load_shard(
+                self.directory, self.manifest, name, shard_i)
+        return shard
+
+
+class ValidationSet(object):
+    def __init__(self, directory):
+        """The validation batches saved by `render_batches`.
+
+        Only the manifest is read here, so the shapes are available at
+        once.  The batches are memory-mapped the first time they are used.
+
+        Attributes
+        ----------
+        removed_training_data
+            The source's `removed_training_data()` after rendering, for
+            `Source.remove_training_data`.
+        """
+        self.directory = directory
+        self.manifest = load_manifest(directory)
+        self.removed_training_data = self.manifest['removed_training_data']
+        arrays = self.manifest[VALIDATION]['arrays']
+        if arrays is None:
+            raise ValueError(
+                "No validation batches were rendered in '{}'"
+                .format(directory))
+        self.input_shape = tuple(arrays['X'][0])
+        self.output_shape = tuple(arrays['y'][0])
+        self._batches = None
+
+    def __len__(self):
+        return self.manifest[VALIDATION]['n_batches']
+
+    def __getitem__(self, i):
+        return self.batches[i]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    @property
+    def batches(self):
+        if self._batches is None:
+            batches = []
+            batches_per_shard = self.manifest['batches_per_shard']
+            for batch_i in range(len(self)):
+                shard_i, i = divmod(batch_i, batches_per_shard)
+                if i == 0:
+                    shard = _load_shard(
+                        self.directory, self.manifest, VALIDATION, shard_i)
+                batches.append(_batch(shard, i, batch_i))
+            self._batches = batches
+        return self._batches
+
+
+def is_rendered(directory):
+    return exists(join(directory, MANIFEST))
+
+
+def load_manifest(directory):
+    with open(join(directory, MANIFEST)) as fh:
+        manifest = json.load(fh)
+    if manifest['format_version'] != FORMAT_VERSION:
+        raise ValueError(
+            "'{}' was rendered in format version {:d}, expected {:d}"
+            .format(directory, manifest['format_version'], FORMAT_VERSION))
+    return manifest
+
+
+def validation_set_key(source, n_validation_batches):
+    """Key for `n_validation_batches` validation batches from `source` in
+    its current configuration (see `Source.data_key`), including its
+    standardisation stats."""
+    key = hashlib.sha1()
+    key.update(str(FORMAT_VERSION).encode('utf-8'))
+    key.update(source.data_key().encode('utf-8'))
+    key.update(str(n_validation_batches).encode('utf-8'))
+    for stats in (source.input_stats, source.target_stats):
+        if stats is not None:
+            for name in sorted(stats):
+                key.update(np.asarray(stats[name], dtype=np.float64).tobytes())
+    return key.hexdigest()
+
+
+def _load_shard(directory, manifest, name, shard_i):
+    shard = {}
+    for array_name, shape_and_dtype in manifest[name]['arrays'].items():
+        if shape_and_dtype is None:
+            shard[array_name] = None
+        else:
+            shard[array_name] = np.load(
+                _shard_filename(directory, name, shard_i, array_name),
+                mmap_mode='r')
+    with open(_shard_filename(directory, name, shard_i, 'metadata'),
+              'rb') as fh:
+        shard['metadata'] = pickle.load(fh)
+    return shard
+
+
+def _batch(shard, i, batch_index):
+    target = shard['target_power_timeseries']
+    return Batch(
+        data=(shard['X'][i], shard['y'][i]),
+        target_power_timeseries=None if target is None else target[i],
+        metadata=shard['metadata'][i],
+        index=batch_index)
@@ -1,31 +1,70 @@
 from __future__ import print_function, division
 from Queue import Queue, Empty
 import threading
+import time
 import numpy as np
 import pandas as pd
 from nilmtk import DataSet, TimeFrame, MeterGroup
 from datetime import timedelta
+from os.path import exists
 from sys import stdout
 from collections import OrderedDict
 from lasagne.utils import floatX
 from warnings import warn
 import gc
-from nilmtk.electric import activation_series_for_chunk
 from nilmtk.timeframegroup import TimeFrameGroup
 import logging
 from .rectangulariser import rectangularise, start_and_end_and_mean
+from .producer import ProcessPoolProducer, map_in_processes
+from .activations import (ActivationBuffer, ragged_indices,
+                          find_activations, remove_incomplete, is_cached,
+                          activations_cache_key, load_cached_activations)
+from .timeseries import GridSeries, SectionIndex, BlockCache, NS_PER_SEC
+from .stats import (RunningStats, stats_key, stats_filename, save_stats,
+                    load_stats)
 
 SECS_PER_DAY = 60 * 60 * 24
+TRAIN_STREAM = 0
+VALIDATION_STREAM = 1
 
 
 class Batch(object):
-    def __init__(self, data, target_power_timeseries, metadata=None):
+    def __init__(self, data, target_power_timeseries, metadata=None,
+                 index=None, generation_time=None):
+        """
+        Parameters
+        ----------
+        generation_time : float, optional
+            Seconds the producer spent generating this batch.
+        """
         self.data = data
         self.target_power_timeseries = target_power_timeseries
         self.metadata = OrderedDict({} if metadata is None else metadata)
+        self.index = index
+        self.generation_time = generation_time
+
+
+def batch_rng(seed, batch_index, validation=False):
+    """The random state used to generate a batch is a pure function of
+    (seed, batch_index, validation) so any worker can generate any batch."""
+    stream = VALIDATION_STREAM if validation else TRAIN_STREAM
+    return np.random.RandomState([seed, stream, batch_index])
 
 
 class Source(object):
+    # Attributes which change the batches a source generates.  They key
+    # the standardisation stats cache, so settings which only change how
+    # batches are produced (prefetch, n_producer_processes, caches...)
+    # are not listed.  Sub-classes add their own.
+    DATA_FIELDS = (
+        'seq_length', 'n_seq_per_batch', 'n_inputs', 'n_outputs', 'seed',
+        'input_padding', 'reshape_target_to_2D', 'output_central_value',
+        'classification', 'random_window', 'subsample_target',
+        'n_rectangular_segments', 'rectangular_kwargs',
+        'target_is_start_and_end_and_mean', 'independently_center_inputs',
+        'standardise_input', 'standardise_targets', 'unit_variance_targets',
+        'n_stats_batches')
+
     def __init__(self, seq_length, n_seq_per_batch, n_inputs, n_outputs,
                  logger=None,
                  X_processing_func=lambda X: X,
@@ -48,11 +87,44 @@ class Source(object):
                  subsample_target=1,
                  n_rectangular_segments=None,
                  rectangular_kwargs=None,
-                 target_is_start_and_end_and_mean=False):
+                 target_is_start_and_end_and_mean=False,
+                 n_producer_processes=0,
+                 prefetch=2,
+                 preallocate=False,
+                 check_nan_every=1,
+                 n_stats_batches=1,
+                 stats_cache_dir=None,
+                 n_loading_processes=0):
         """
         Parameters
         ----------
         clock_type : {'one_hot', 'ramp'}
+        seed : int or None
+            Batch k is generated from `batch_rng(seed, k)`.  If None then
+            a seed is drawn at random.
+        n_producer_processes : int
+            If > 0 then generate training batches in this many worker
+            processes (see `ProcessPoolProducer`) instead of in a thread.
+        prefetch : int
+            Maximum number of generated batches waiting to be consumed.
+        preallocate : bool
+            If True then `_process_data` writes training batches into a
+            ring of `prefetch + 2` reusable float32 buffers instead of
+            allocating new arrays for every batch.  So each training batch
+            is only valid until `prefetch + 2` more have been generated.
+        check_nan_every : int
+            Only check every n-th batch for NaNs.  0 disables the check.
+        n_stats_batches : int
+            Number of batches used to estimate `input_stats` and
+            `target_stats` if they are not given.
+        stats_cache_dir : str, optional
+            If set then estimated stats are saved in this directory, in a
+            file keyed by the source's configuration, and loaded from there
+            by later runs with the same configuration.
+        n_loading_processes : int
+            If > 0 then sub-classes which load data from a nilmtk dataset
+            load each building (and appliance) in a pool of this many
+            processes, each with its own read-only handle on the dataset.
         """
         self._set_logger(logger)
 
@@ -61,13 +133,30 @@ class Source(object):
         self.n_inputs = n_inputs
         self.n_outputs = n_outputs
         self.input_padding = input_padding
-        self.queue = Queue(maxsize=2)
+        self.queue = Queue(maxsize=prefetch)
         self._stop = threading.Event()
         self._thread = None
+        self.n_producer_processes = n_producer_processes
+        self.prefetch = prefetch
+        self._producer = None
+        self.preallocate = preallocate
+        self.check_nan_every = check_nan_every
+        self._buffer_ring = [{} for _ in range(prefetch + 2)]
+        self._ring_i = 0
+        self._n_batches_processed = 0
+        self._clock = None
         self.X_processing_func = X_processing_func
         self.y_processing_func = y_processing_func
         self.reshape_target_to_2D = reshape_target_to_2D
+        if seed is None:
+            # `batch_rng` needs a concrete seed, so draw one from the OS.
+            seed = np.random.RandomState().randint(2 ** 31 - 1)
+            self.logger.info("Using random seed {:d}".format(seed))
+        self.seed = seed
+        self._local = threading.local()
         self.rng = np.random.RandomState(seed)
+        self.batch_index = 0
+        self.validation_batch_index = 0
         self.output_central_value = output_central_value
         self.classification = classification
         self.random_window = random_window
@@ -96,6 +185,9 @@ class Source(object):
         self.standardise_input = standardise_input
         self.standardise_targets = standardise_targets
         self.unit_variance_targets = unit_variance_targets
+        self.n_stats_batches = n_stats_batches
+        self.stats_cache_dir = stats_cache_dir
+        self.n_loading_processes = n_loading_processes
 
         self._init_data()
         self._initialise_standardisation()
@@ -120,7 +212,31 @@ class Source(object):
     def _init_data(self):
         pass
 
+    def _map_buildings(self, func, jobs):
+        """Apply `func(job, logger, dataset=None)` to each job.
+
+        If `n_loading_processes` > 0 then the jobs run in a pool of
+        processes, each of which opens `job['filename']` itself, and each
+        job's log messages are logged here once it finishes.  Otherwise
+        the jobs run here, using `self.dataset`.
+
+        Returns
+        -------
+        list of results, in the same order as `jobs`.
+        """
+        if self.n_loading_processes:
+            return map_in_processes(
+                func, jobs, self.n_loading_processes, self.logger)
+        return [func(job, self.logger, dataset=self.dataset) for job in jobs]
+
     def start(self):
+        if self.n_producer_processes:
+            if self._producer is None:
+                self._producer = ProcessPoolProducer(
+                    self, n_workers=self.n_producer_processes,
+                    prefetch=self.prefetch)
+            self._producer.start()
+            return
         if self._thread is not None:
             return
         self._stop.clear()
@@ -129,8 +245,12 @@ class Source(object):
 
     def run(self):
         """Puts training data into a Queue"""
+        batch_index = self.batch_index
         while not self._stop.is_set():
-            batch = self.get_batch()
+            t0 = time.time()
+            batch = self.get_batch(batch_index=batch_index)
+            batch.generation_time = time.time() - t0
+            batch_index += 1
             self.queue.put(batch)
         self.empty_queue()
 
@@ -138,12 +258,24 @@ class Source(object):
         if not (self.standardise_input or self.standardise_targets):
             return
 
+        filename = None
+        if self.stats_cache_dir is not None:
+            filename = stats_filename(self.stats_cache_dir, self.data_key())
+            if exists(filename):
+                self.logger.info(
+                    "Loading standardisation stats from " + filename)
+                input_stats, target_stats = load_stats(filename)
+                if self.input_stats is None:
+                    self.input_stats = input_stats
+                if self.target_stats is None:
+                    self.target_stats = target_stats
+
         if self.input_stats is None:
-            X, y = self._gen_data()
-            X = X.reshape(
-                self.n_seq_per_batch * (self.seq_length + self.input_padding),
-                self.n_inputs)
-            self.input_stats = {'mean': X.mean(axis=0), 'std': X.std(axis=0)}
+            stats = RunningStats(self.n_inputs)
+            for batch_i in range(self.n_stats_batches):
+                X, y = self._gen_data()
+                stats.update(X)
+            self.input_stats = stats.as_dict()
 
         if self.target_stats is None:
             # Get targets.  Temporarily turn off skip probability
@@ -154,23 +286,56 @@ class Source(object):
                 skip_prob_for_first_appliance = (
                     self.skip_probability_for_first_appliance)
                 self.skip_probability_for_first_appliance = 0
-            X, y = self._gen_data()
+            stats = RunningStats(self.n_outputs)
+            for batch_i in range(self.n_stats_batches):
+                X, y = self._gen_data()
+                stats.update(y)
             if 'skip_probability' in self.__dict__:
                 self.skip_probability = skip_prob
             if 'skip_probability_for_first_appliance' in self.__dict__:
                 self.skip_probability_for_first_appliance = (
                     skip_prob_for_first_appliance)
 
-            y = y.reshape(self.n_seq_per_batch * self.seq_length,
-                          self.n_outputs)
-            self.target_stats = {'mean': y.mean(axis=0), 'std': y.std(axis=0)}
-
-        np.save('target_stats_mean', self.target_stats['mean'])
-        np.save('target_stats_std', self.target_stats['std'])
-        np.save('input_stats_mean', self.input_stats['mean'])
-        np.save('input_stats_std', self.input_stats['std'])
+            self.target_stats = stats.as_dict()
+
+        if filename is not None and not exists(filename):
+            save_stats(filename, self.input_stats, self.target_stats)
+
+    def data_key(self):
+        """Hash of the class, the attributes in `DATA_FIELDS` and the
+        dataset file (if the source has a `filename`).  Attributes whose
+        values are not plain numbers, strings or containers of these are
+        ignored, so list the raw argument (e.g. `_window`) instead."""
+        config = dict((name.lstrip('_'), getattr(self, name, None))
+                      for name in self.DATA_FIELDS)
+        config['class'] = self.__class__.__name__
+        return stats_key(config, filename=getattr(self, 'filename', None))
+
+    @property
+    def rng(self):
+        """Random state for the current thread.  While `get_batch` is
+        generating a numbered batch this is `batch_rng(...)` for that
+        batch, otherwise it is the source's own random state."""
+        return getattr(self._local, 'rng', self._rng)
+
+    @rng.setter
+    def rng(self, rng):
+        self._rng = rng
+
+    def seek(self, batch_index):
+        """Make `batch_index` the next training batch returned by `get()`.
+        Used to resume training from a checkpoint without replaying
+        earlier batches."""
+        running = self._thread is not None or (
+            self._producer is not None and self._producer.is_running())
+        self.stop()
+        self.batch_index = batch_index
+        if running:
+            self.start()
 
     def stop(self):
+        if self._producer is not None:
+            self._producer.stop()
         self.empty_queue()
         self._stop.set()
         if self._thread is not None:
@@ -178,65 +343,173 @@ class Source(object):
             self._thread = None
 
     def get(self, timeout=30, **kwargs):
-        if self._thread is None:
+        if self.n_producer_processes:
             self.start()
-        return self.queue.get(timeout=timeout, **kwargs)
+            (data, target_power_timeseries, metadata, batch_index,
+             generation_time) = self._producer.get(timeout=timeout)
+            batch = Batch(data=data,
+                          target_power_timeseries=target_power_timeseries,
+                          metadata=metadata, index=batch_index,
+                          generation_time=generation_time)
+        else:
+            if self._thread is None:
+                self.start()
+            batch = self.queue.get(timeout=timeout, **kwargs)
+        if batch.index is not None:
+            self.batch_index = batch.index + 1
+        return batch
+
+    def qsize(self):
+        """Number of training batches ready for `get()`, or None if
+        unknown."""
+        if self.n_producer_processes:
+            if self._producer is None:
+                return 0
+            return self._producer.qsize()
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            return None
 
     def empty_queue(self):
+        if self._producer is not None:
+            self._producer.empty_queue()
         while True:
             try:
                 self.queue.get(block=False)
             except Empty:
                 break
 
+    def removed_training_data(self):
+        """Training data which generating validation batches has removed
+        from this source, so it is never trained on, or None.
+
+        Returns
+        -------
+        JSON-serialisable record for `remove_training_data`.
+        """
+        return None
+
+    def remove_training_data(self, removed):
+        """Remove the training data recorded by `removed_training_data`,
+        e.g. when re-using validation batches saved by an earlier run."""
+        pass
+
     def validation_data(self):
-        return self.get_batch(validation=True)
+        batch = self.get_batch(
+            validation=True, batch_index=self.validation_batch_index)
+        self.validation_batch_index += 1
+        return batch
 
-    def get_batch(self, validation=False):
-        X, y = self._gen_data(validation=validation)
-        X_processed, y_processed = self._process_data(X, y)
+    def get_batch(self, validation=False, batch_index=None):
+        """
+        Parameters
+        ----------
+        validation : bool
+        batch_index : int, optional
+            If given then the batch is generated using
+            `batch_rng(self.seed, batch_index, validation)`, so the same
+            index always gives the same batch, whichever thread or
+            process generates it.
+        """
+        if batch_index is not None:
+            self._local.rng = batch_rng(self.seed, batch_index, validation)
+        try:
+            X, y = self._gen_data(validation=validation)
+            X_processed, y_processed = self._process_data(
+                X, y, validation=validation)
+        finally:
+            if batch_index is not None:
+                del self._local.rng
         data = (X_processed, y_processed)
-        batch = Batch(data=data, target_power_timeseries=y)
+        batch = Batch(data=data, target_power_timeseries=y, index=batch_index)
         return batch
 
-    def _process_data(self, X, y):
+    def _buffer(self, name, shape):
+        """Returns a reusable float32 array from the current slot of the
+        buffer ring.  Contents are whatever was last written to it."""
+        slot = self._buffer_ring[self._ring_i % len(self._buffer_ring)]
+        key = (name, shape)
+        buffer = slot.get(key)
+        if buffer is None:
+            buffer = slot[key] = np.zeros(shape, dtype=np.float32)
+        return buffer
+
+    def _get_clock(self):
+        if self._clock is not None:
+            return self._clock
+
+        if self.clock_type == 'one_hot':
+            clock = np.zeros(
+                shape=(self.n_seq_per_batch, self.seq_length, self.n_inputs),
+                dtype=np.float32)
+
+            for i in range(self.clock_period):
+                clock[:, i::self.clock_period, i] = 1
+
+        elif self.clock_type == 'ramp':
+            ramp = np.linspace(start=-1, stop=1, num=self.clock_period,
+                               dtype=np.float32)
+            n_ramps = int(np.ceil(self.seq_length / self.clock_period))
+            ramp_for_one_seq = np.tile(ramp, n_ramps)[:self.seq_length]
+            clock = np.tile(ramp_for_one_seq, (self.n_seq_per_batch, 1))
+            clock = clock.reshape((self.n_seq_per_batch, self.seq_length, 1))
+
+        self._clock = clock
+        return clock
+
+    def _process_data(self, X, y, validation=False):
+        # Validation batches are kept by the Net, so never put them
+        # in buffers which will be overwritten.
+        use_buffers = self.preallocate and not validation
+
+        def empty(name, shape):
+            if use_buffers:
+                return self._buffer(name, shape)
+            else:
+                return np.empty(shape, dtype=np.float32)
+
         if self.subsample_target > 1:
             y = y.reshape(self.n_seq_per_batch, -1,
                           self.subsample_target, self.n_outputs)
-            y = y.mean(axis=2)
+            if use_buffers:
+                y = y.mean(axis=2, out=self._buffer(
+                    'y_subsampled', y.shape[:2] + y.shape[3:]))
+            else:
+                y = y.mean(axis=2)
 
         if self.input_padding:
             pad = self.input_padding // 2
-            X = np.pad(
-                X,
-                pad_width=((0, 0), (pad, pad), (0, 0)),
-                mode='constant'
-            )
-
-        def _standardise(n, stats, data):
-            for i in range(n):
-                mean = stats['mean'][i]
-                std = stats['std'][i]
-                data[:, :, i] = standardise(
-                    data[:, :, i], how='std=1', mean=mean, std=std)
+            n_seq_per_batch, seq_length, n_inputs = X.shape
+            X_padded = empty(
+                'X_padded', (n_seq_per_batch, seq_length + (pad * 2),
+                             n_inputs))
+            X_padded[:, :pad, :] = 0
+            X_padded[:, pad:pad+seq_length, :] = X
+            X_padded[:, pad+seq_length:, :] = 0
+            X = X_padded
+
+        def _standardise(stats, data):
+            # Standardise every feature in place.  Features with zero std
+            # are only centered.  Stats are cast to the dtype of `data`
+            # first to avoid numpy allocating casting buffers.
+            std = np.asarray(stats['std'], dtype=data.dtype)
+            data -= np.asarray(stats['mean'], dtype=data.dtype)
+            data /= np.where(std == 0, 1, std).astype(data.dtype)
             return data
 
         if self.independently_center_inputs:
-            for seq_i in range(self.n_seq_per_batch):
-                for input_i in range(self.n_inputs):
-                    X[seq_i, :, input_i] = standardise(
-                        X[seq_i, :, input_i], how='std=1',
-                        std=self.input_stats['std'])
+            X -= X.mean(axis=1, keepdims=True)
+            std = np.asarray(self.input_stats['std'], dtype=X.dtype)
+            X /= np.where(std == 0, 1, std).astype(X.dtype)
 
         elif self.standardise_input:
-            X = _standardise(self.n_inputs, self.input_stats, X)
+            X = _standardise(self.input_stats, X)
 
         if self.unit_variance_targets:
-            for i in range(self.n_outputs):
-                std = self.target_stats['std'][i]
-                y[:, :, i] /= std
+            y /= self.target_stats['std']
         elif self.standardise_targets:
-            y = _standardise(self.n_outputs, self.target_stats, y)
+            y = _standardise(self.target_stats, y)
 
         if self.random_window:
             y_seq_length = self.seq_length // self.subsample_target
@@ -270,37 +543,39 @@ class Source(object):
             half_seq_length = seq_length // 2
             y = y[:, half_seq_length:half_seq_length+1, :]
 
-        if self.clock_type == 'one_hot':
-            clock = np.zeros(
-                shape=(self.n_seq_per_batch, self.seq_length, self.n_inputs),
-                dtype=np.float32)
-
-            for i in range(self.clock_period):
-                clock[:, i::self.clock_period, i] = 1
-
-        elif self.clock_type == 'ramp':
-            ramp = np.linspace(start=-1, stop=1, num=self.clock_period,
-                               dtype=np.float32)
-            n_ramps = np.ceil(self.seq_length / self.clock_period)
-            ramp_for_one_seq = np.tile(ramp, n_ramps)[:self.seq_length]
-            clock = np.tile(ramp_for_one_seq, (self.n_seq_per_batch, 1))
-            clock = clock.reshape((self.n_seq_per_batch, self.seq_length, 1))
-
         if self.clock_type is not None:
-            X = np.concatenate((X, clock), axis=2)
+            clock = self._get_clock()
+            n_inputs = X.shape[2]
+            X_with_clock = empty(
+                'X_with_clock',
+                X.shape[:2] + (n_inputs + clock.shape[2],))
+            X_with_clock[:, :, :n_inputs] = X
+            X_with_clock[:, :, n_inputs:] = clock
+            X = X_with_clock
 
         if self.two_pass:
-            X = np.tile(X, (1, 2, 1))
-            shape = (self.n_seq_per_batch, self.seq_length * 2, 1)
-            encode_flag = np.zeros(shape)
-            encode_flag[:, :self.seq_length, :] = 0
-            encode_flag[:, self.seq_length:, :] = 1
-            X = np.concatenate((X, encode_flag), axis=2)
-            X[:, self.seq_length:, 0] = 0
-            y = np.tile(y, (1, 2, 1))
+            n_seq_per_batch, seq_length, n_inputs = X.shape
+            X_two_pass = empty(
+                'X_two_pass', (n_seq_per_batch, seq_length * 2, n_inputs + 1))
+            X_two_pass[:, :seq_length, :n_inputs] = X
+            X_two_pass[:, seq_length:, :n_inputs] = X
+            # Encode flag
+            X_two_pass[:, :self.seq_length, n_inputs] = 0
+            X_two_pass[:, self.seq_length:, n_inputs] = 1
+            X_two_pass[:, self.seq_length:, 0] = 0
+            X = X_two_pass
+            y_length = y.shape[1]
+            y_two_pass = empty(
+                'y_two_pass', (y.shape[0], y_length * 2) + y.shape[2:])
+            y_two_pass[:, :y_length] = y
+            y_two_pass[:, y_length:] = y
+            y = y_two_pass
 
         X, y = floatX(X), floatX(y)
         self._check_data(X, y)
+        self._n_batches_processed += 1
+        if use_buffers:
+            self._ring_i += 1
         return X, y
 
     def _gen_data(self, validation=False):
@@ -362,10 +637,16 @@ class Source(object):
 
     def _check_data(self, X, y):
         assert X.shape == self.input_shape_after_processing()
-        assert not any(np.isnan(X.flatten()))
         if y is not None:
             assert y.shape == self.output_shape_after_processing()
-            assert not any(np.isnan(y.flatten()))
+        if not self.check_nan_every:
+            return
+        if self._n_batches_processed % self.check_nan_every:
+            return
+        # np.min propagates NaNs without allocating a temporary array
+        assert not np.isnan(np.min(X))
+        if y is not None:
+            assert not np.isnan(np.min(y))
 
 
 def none_to_list(x):
@@ -373,56 +654,91 @@ def none_to_list(x):
 
 
 class ToySource(Source):
+    DATA_FIELDS = Source.DATA_FIELDS + (
+        'powers', 'on_durations', 'all_hot', 'fdiff', 'min_off_duration',
+        'on_probability')
+
     def __init__(self, seq_length, n_seq_per_batch, n_inputs=1,
                  powers=None, on_durations=None, all_hot=True,
-                 fdiff=False):
+                 fdiff=False, min_off_duration=20, on_probability=0.2,
+                 **kwargs):
         """
         Parameters
         ----------
         n_inputs : int
             if > 1 then will quantize inputs
         powers : list of numbers
+            One per synthetic appliance.  The first is the target.
         on_durations : list of numbers
+            One per synthetic appliance, in samples.
+        min_off_duration : int
+            Samples between the end of one activation and the earliest
+            start of the next.
+        on_probability : float
+            Probability of switching on at each sample where an appliance
+            could switch on.
         """
         self.powers = [10, 40] if powers is None else powers
         self.on_durations = [3, 10] if on_durations is None else on_durations
         self.all_hot = all_hot
         self.fdiff = fdiff
+        self.min_off_duration = min_off_duration
+        self.on_probability = on_probability
         super(ToySource, self).__init__(
             seq_length=seq_length,
             n_seq_per_batch=n_seq_per_batch,
             n_inputs=n_inputs,
-            n_outputs=1)
+            n_outputs=1,
+            **kwargs)
 
-    def _gen_single_appliance(self, power, on_duration,
-                              min_off_duration=20, p=0.2):
-        length = self.seq_length + 1 if self.fdiff else self.seq_length
-        appliance_power = np.zeros(length)
-        i = 0
-        while i < length:
-            if self.rng.binomial(n=1, p=p):
-                end = min(i + on_duration, length)
-                appliance_power[i:end] = power
-                i += on_duration + min_off_duration
-            else:
-                i += 1
-        return np.diff(appliance_power) if self.fdiff else appliance_power
+    def _gen_appliances(self):
+        """Power of every appliance for a whole batch at once.
 
-    def _gen_batches_of_single_appliance(self, *args, **kwargs):
-        batches = np.empty(shape=(self.n_seq_per_batch, self.seq_length, 1))
-        for i in range(self.n_seq_per_batch):
-            single_appliance = self._gen_single_appliance(*args, **kwargs)
-            batches[i, :, :] = single_appliance.reshape(self.seq_length, 1)
-        return batches
+        Each appliance switches on with probability `on_probability` at
+        every sample where it may, so the number of samples waited before
+        each activation is geometric.  All activation starts are drawn at
+        once, and the pulses are written by adding +1 at each start
+        and -1 at each end, taking the cumulative sum and scaling by power.
 
-    def _gen_unquantized_data(self, validation=False):
-        y = self._gen_batches_of_single_appliance(
-            power=self.powers[0], on_duration=self.on_durations[0])
-        X = y.copy()
-        for power, on_duration in zip(self.powers, self.on_durations)[1:]:
-            X += self._gen_batches_of_single_appliance(
-                power=power, on_duration=on_duration)
+        Returns
+        -------
+        np.ndarray of shape (n_appliances, n_seq_per_batch, seq_length)
+        """
+        length = self.seq_length + 1 if self.fdiff else self.seq_length
+        n_appliances = len(self.powers)
+        n_seqs = n_appliances * self.n_seq_per_batch
+        on_durations = np.array(self.on_durations, dtype=np.int64)
+        steps = on_durations + self.min_off_duration
+        max_activations = ((length - 1) // max(steps.min(), 1)) + 1
+        waits = self.rng.geometric(
+            self.on_probability,
+            size=(n_appliances, self.n_seq_per_batch, max_activations)) - 1
+        steps = steps[:, None, None]
+        starts = np.cumsum(waits + steps, axis=2) - steps
+        ends = np.minimum(starts + on_durations[:, None, None], length)
+
+        # Flat index of each start and end within an array of shape
+        # (n_appliances, n_seq_per_batch, length + 1)
+        seq_offsets = (np.arange(n_seqs) * (length + 1)).reshape(
+            n_appliances, self.n_seq_per_batch, 1)
+        in_seq = starts < length
+        starts = (seq_offsets + starts)[in_seq]
+        ends = (seq_offsets + ends)[in_seq]
+        changes = (np.bincount(starts, minlength=n_seqs * (length + 1)) -
+                   np.bincount(ends, minlength=n_seqs * (length + 1)))
+        changes = changes.reshape(n_appliances, self.n_seq_per_batch,
+                                  length + 1)
+        is_on = np.cumsum(changes[:, :, :length], axis=2)
+        powers = np.array(self.powers, dtype=np.float64)
+        appliance_power = is_on * powers[:, None, None]
+        if self.fdiff:
+            appliance_power = np.diff(appliance_power, axis=2)
+        return appliance_power
 
+    def _gen_unquantized_data(self, validation=False):
+        appliance_power = self._gen_appliances()[:, :, :, np.newaxis]
+        y = appliance_power[0]
+        X = appliance_power.sum(axis=0)
         return X / np.max(X), y / np.max(y)
 
     def _gen_data(self, *args, **kwargs):
@@ -433,6 +749,17 @@ class ToySource(Source):
 
 
 class RealApplianceSource(Source):
+    DATA_FIELDS = Source.DATA_FIELDS + (
+        'filename', 'appliances', 'window', 'window_per_building',
+        'train_buildings', 'validation_buildings', 'min_on_durations',
+        'min_off_durations', 'on_power_thresholds', 'max_appliance_powers',
+        'max_input_power', 'divide_input_by_max_input_power', 'clip_input',
+        'output_one_appliance', 'sample_period', 'boolean_targets',
+        'skip_probability', 'skip_probability_for_first_appliance',
+        'include_diff', 'include_power', 'target_is_diff', 'max_diff',
+        'clip_appliance_power', 'lag', 'target_is_prediction',
+        'one_target_per_seq', 'ensure_all_appliances_represented', 'border')
+
     def __init__(self, filename, appliances,
                  min_on_durations,
                  logger=None,
@@ -463,6 +790,7 @@ class RealApplianceSource(Source):
                  ensure_all_appliances_represented=True,
                  border=5,
                  window_per_building=None,
+                 activations_cache_dir=None,
                  **kwargs):
         """
         Parameters
@@ -485,8 +813,15 @@ class RealApplianceSource(Source):
             Must have one for each building.
             Values are (<start>, <end>) dates (or whatever 
             nilmtk.DataSet.set_window() accepts)
+        activations_cache_dir : str, optional
+            If set then processed activations are cached in this directory
+            and re-used by later runs with the same load parameters.
         """
         self._set_logger(logger)
+        self.filename = filename
+        self.window = window
+        self.activations_cache_dir = activations_cache_dir
+        self.n_loading_processes = kwargs.get('n_loading_processes', 0)
         self.dataset = DataSet(filename)
         self.appliances = appliances
 
@@ -550,6 +885,10 @@ class RealApplianceSource(Source):
         self.on_power_thresholds = on_power_thresholds
         if min_on_durations is None:
             min_on_durations = [0] * len(self.appliances)
+        self.min_on_durations = min_on_durations
+        self.min_off_durations = min_off_durations
+        self.train_buildings = train_buildings
+        self.validation_buildings = validation_buildings
 
         self.train_activations = self._load_activations(
             train_buildings, min_on_durations, min_off_durations,
@@ -581,12 +920,37 @@ class RealApplianceSource(Source):
     def get_labels(self):
         return self.train_activations.keys()
 
+    def removed_training_data(self):
+        """
+        Returns
+        -------
+        dict mapping from each appliance to a list of the ids of the
+        training activations used for validation, or None if the
+        validation activations are not taken from the training
+        activations.
+        """
+        if not self.remove_used_activations:
+            return None
+        return dict(
+            (appliance, activations.popped_ids().tolist())
+            for appliance, activations in self.train_activations.items())
+
+    def remove_training_data(self, removed):
+        if not removed:
+            return
+        for appliance, activation_ids in removed.items():
+            activations = self.train_activations[appliance]
+            activations.remove(activation_ids)
+            self.logger.info(
+                "{}: {:d} train activations".format(
+                    appliance, len(activations)))
+
     def _load_activations(self, buildings, min_on_durations, min_off_durations,
                           on_power_thresholds):
-        activations = OrderedDict()
+        jobs = []
         for building_i in buildings:
+            window = self._window_for_building(building_i)
             if self.window_per_building:
-                window = self.window_per_building[building_i]
                 self.logger.info(
                     "Setting window for building {} to (start={}, end={})"
                     .format(building_i, *window))
@@ -594,28 +958,59 @@ class RealApplianceSource(Source):
             elec = self.dataset.buildings[building_i].elec
             meters = get_meters_for_appliances(
                 elec, self.appliances, self.logger)
-            for appliance_i, meter in enumerate(meters):
+            for appliance_i in range(len(meters)):
                 appliance = self.appliances[appliance_i]
                 if isinstance(appliance, list):
                     appliance = appliance[0]
-                self.logger.info(
-                    "  Loading activations for {} from building {}..."
-                    .format(appliance, building_i))
-                activation_series = meter.activation_series(
+                load_kwargs = dict(
+                    sample_period=self.sample_period,
                     on_power_threshold=on_power_thresholds[appliance_i],
                     min_on_duration=min_on_durations[appliance_i],
                     min_off_duration=min_off_durations[appliance_i],
-                    resample=True)
-                activations[appliance] = _preprocess_activations(
-                    activation_series,
                     max_power=self.max_appliance_powers[appliance],
-                    sample_period=self.sample_period,
                     clip_appliance_power=self.clip_appliance_power)
-                self.logger.info(
-                    "    Loaded {:d} activations."
-                    .format(len(activation_series)))
+                key = activations_cache_key(
+                    self.filename, building=building_i, appliance=appliance,
+                    window=window, **load_kwargs)
+                jobs.append(dict(
+                    filename=self.filename, window=window,
+                    building_i=building_i, appliances=self.appliances,
+                    meter_i=appliance_i, load_kwargs=load_kwargs,
+                    appliance=appliance, key=key))
+
+        # Load everything which isn't cached, in parallel if configured
+        to_load = [job_i for job_i, job in enumerate(jobs)
+                   if not is_cached(self.activations_cache_dir, job['key'])]
+        loaded = self._map_buildings(
+            _load_appliance_activations, [jobs[i] for i in to_load])
+        loaded = dict(zip(to_load, loaded))
+
+        activations = OrderedDict()
+        for job_i, job in enumerate(jobs):
+            appliance = job['appliance']
+            self.logger.info(
+                "  Loading activations for {} from building {}..."
+                .format(appliance, job['building_i']))
+            if job_i in loaded:
+                def load(activation_buffer=loaded.pop(job_i)):
+                    return activation_buffer
+            else:
+                def load(job=job):
+                    return _load_appliance_activations(
+                        job, self.logger, dataset=self.dataset)
+            activations[appliance] = load_cached_activations(
+                self.activations_cache_dir, job['key'], load, self.logger)
+            self.logger.info(
+                "    Loaded {:d} activations."
+                .format(len(activations[appliance])))
         return activations
 
+    def _window_for_building(self, building_i):
+        if self.window_per_building:
+            return tuple(self.window_per_building[building_i])
+        else:
+            return tuple(self.window)
+
     def _gen_single_example(self, validation=False, appliances=None):
         if appliances is None:
             appliances = []
@@ -669,7 +1064,7 @@ class RealApplianceSource(Source):
             activation_start_i = -min(0, start_i)
             activation_end_i = (
                 activation_start_i + self.seq_length - X_start_i - self.lag)
-            target = activation.values[activation_start_i:activation_end_i]
+            target = activation[activation_start_i:activation_end_i]
             X_end_i = X_start_i + len(target)
             assert X_end_i <= self.seq_length
             X[X_start_i:X_end_i, 0] += target
@@ -746,7 +1141,133 @@ class RealApplianceSource(Source):
             appliances_for_sequence[i] = appliances
         return appliances_for_sequence
 
+    def _select_appliances(self, n_appliances):
+        """Returns a boolean array of shape (n_seq_per_batch, n_appliances)
+        which is True where an appliance must be included in a sequence.
+        """
+        include = np.zeros((self.n_seq_per_batch, n_appliances), dtype=bool)
+        if not self.one_target_per_seq:
+            empty = np.ones(self.n_seq_per_batch, dtype=bool)
+            while empty.any():
+                n_empty = empty.sum()
+                draws = np.empty((n_empty, n_appliances), dtype=bool)
+                draws[:, 0] = self.rng.binomial(
+                    n=1, p=self.skip_probability_for_first_appliance,
+                    size=n_empty) == 0
+                draws[:, 1:] = self.rng.binomial(
+                    n=1, p=self.skip_probability,
+                    size=(n_empty, n_appliances-1)) == 0
+                include[empty] = draws
+                empty = ~include.any(axis=1)
+        for seq_i, appliances in self._appliances_for_sequence().items():
+            for appliance_i, appliance in appliances:
+                include[seq_i, appliance_i] = True
+        return include
+
+    def _gen_batch(self, validation=False):
+        """Vectorised equivalent of calling `_gen_single_example` for each
+        sequence.  Draws all activations and start offsets for an appliance
+        at once and scatters them into X and y."""
+        X = np.zeros(self.input_shape(), dtype=np.float32)
+        y = np.zeros(self.output_shape(), dtype=np.float32)
+        POWER_THRESHOLD = 1
+        if validation and self.validation_activations:
+            activations = self.validation_activations
+        else:
+            activations = self.train_activations
+        appliance_names = list(activations.keys())
+        include = self._select_appliances(len(appliance_names))
+
+        for appliance_i, appliance in enumerate(appliance_names):
+            seqs = np.flatnonzero(include[:, appliance_i])
+            buffer = activations[appliance]
+            n_examples = len(seqs)
+            if n_examples == 0 or len(buffer) == 0:
+                continue
+            activation_ids = buffer.ids[
+                self.rng.randint(0, len(buffer), size=n_examples)]
+            lengths = buffer.lengths[activation_ids]
+            if self.output_one_appliance and appliance_i > 0:
+                # Allow appliance to start before the start of the target seq
+                # and end after the end of the target seq
+                latest_start_i = np.empty(n_examples, dtype=np.int64)
+                latest_start_i[:] = self.seq_length - (self.border + self.lag)
+                earliest_start_i = self.border - lengths
+            else:
+                # Try to fit the appliance into the target seq
+                latest_start_i = ((self.seq_length - lengths) -
+                                  (self.border + self.lag))
+                latest_start_i = np.maximum(latest_start_i, self.border)
+                earliest_start_i = np.zeros(n_examples, dtype=np.int64)
+            start_i = earliest_start_i + (
+                self.rng.random_sample(n_examples) *
+                (latest_start_i - earliest_start_i)).astype(np.int64)
+            X_start_i = np.maximum(start_i, 0)
+            activation_start_i = -np.minimum(start_i, 0)
+            n_samples = np.minimum(
+                lengths - activation_start_i,
+                np.minimum(self.seq_length - X_start_i - self.lag,
+                           self.seq_length - X_start_i))
+            n_samples = np.maximum(n_samples, 0)
+
+            example_i, position = ragged_indices(n_samples)
+            seq_i = seqs[example_i]
+            time_i = X_start_i[example_i] + position
+            target = buffer.values[
+                buffer.offsets[activation_ids][example_i] +
+                activation_start_i[example_i] + position]
+            X[seq_i, time_i, 0] += target
+            if (not self.target_is_prediction and
+                    (appliance_i == 0 or not self.output_one_appliance)):
+                if self.boolean_targets:
+                    target = (target > POWER_THRESHOLD).astype(np.float32)
+                else:
+                    max_appliance_power = self.max_appliance_powers[appliance]
+                    if max_appliance_power is not None:
+                        target = target / max_appliance_power
+                if self.target_is_diff:
+                    has_next = position < (n_samples[example_i] - 1)
+                    diff = np.zeros_like(target)
+                    diff[:-1] = target[1:] - target[:-1]
+                    y[seq_i[has_next], time_i[has_next] + self.lag,
+                      appliance_i] = diff[has_next]
+                else:
+                    y[seq_i, time_i + self.lag, appliance_i] = target
+
+        if self.clip_input:
+            np.clip(X, 0, self.max_input_power, out=X)
+
+        fdiff = np.diff(X[:, :, 0], axis=1) / self.max_diff
+        if (self.divide_input_by_max_input_power and
+                self.max_input_power is not None):
+            X[:, :, 0] /= self.max_input_power
+
+        if self.target_is_prediction:
+            if self.target_is_diff:
+                data = np.zeros(y.shape, dtype=np.float32)
+                data[:, :-1, 0] = fdiff
+            else:
+                data = np.copy(X[:, :, :1])
+
+            if self.lag > 0:
+                y[:, self.lag:, :] = data[:, :-self.lag, :]
+            elif self.lag == 0:
+                y = data
+            else:
+                y[:, :self.lag, :] = data[:, -self.lag:, :]
+
+        if self.include_diff:
+            feature_i = int(self.include_power)
+            X[:, :-1, feature_i] = fdiff
+
+        return X, y
+
     def _gen_data(self, validation=False):
+        if not (self.remove_used_activations and validation):
+            return self._gen_batch(validation)
+
+        # Validation activations are popped one at a time so the same
+        # activation is never used twice.
         X = np.zeros(self.input_shape(), dtype=np.float32)
         y = np.zeros(self.output_shape(), dtype=np.float32)
         deterministic_appliances = self._appliances_for_sequence()
@@ -764,16 +1285,33 @@ class RealApplianceSource(Source):
 
 
 class NILMTKSource(Source):
+    DATA_FIELDS = Source.DATA_FIELDS + (
+        'filename', 'appliances', '_window', 'train_buildings',
+        'validation_buildings', 'sample_period')
+
     def __init__(self, filename, appliances,
                  train_buildings, validation_buildings,
                  window=(None, None),
                  sample_period=6,
+                 block_cache_mb=None,
+                 block_duration=6*60*60,
                  **kwargs):
+        """
+        Parameters
+        ----------
+        block_cache_mb : int, optional
+            If set then read data through a BlockCache of this size
+            instead of querying the dataset for every example.
+        block_duration : int
+            Seconds of data in each cached block.
+        """
         super(NILMTKSource, self).__init__(
             n_outputs=len(appliances),
             n_inputs=1,
             **kwargs)
         self.window = window
+        self._window = window
+        self.filename = filename
         self.dataset = DataSet(filename)
         self.dataset.set_window(*window)
         self.tz = self.dataset.metadata['timezone']
@@ -782,6 +1320,14 @@ class NILMTKSource(Source):
         self.train_buildings = train_buildings
         self.validation_buildings = validation_buildings
         self.sample_period = sample_period
+        self.block_cache_mb = block_cache_mb
+        if block_cache_mb:
+            self._block_cache = BlockCache(
+                self._load_block, sample_period,
+                block_duration=block_duration,
+                max_bytes=block_cache_mb * (2 ** 20))
+        else:
+            self._block_cache = None
         self._init_meter_groups()
         self._init_good_sections()
 
@@ -799,17 +1345,14 @@ class NILMTKSource(Source):
         return buildings
 
     def _init_good_sections(self):
-        self.good_sections = {}
+        buildings = self._all_buildings()
         min_duration_secs = self.sample_period * self.seq_length
-        min_duration = timedelta(seconds=min_duration_secs)
-        for building_i in self._all_buildings():
-            self.logger.info(
-                "init good sections for building {}".format(building_i))
-            mains = self.dataset.buildings[building_i].elec.mains()
-            self.good_sections[building_i] = [
-                section for section in mains.good_sections()
-                if section.timedelta > min_duration
-            ]
+        jobs = [dict(filename=self.filename, window=tuple(self._window),
+                     building_i=building_i,
+                     min_duration=timedelta(seconds=min_duration_secs))
+                for building_i in buildings]
+        good_sections = self._map_buildings(_load_mains_good_sections, jobs)
+        self.good_sections = dict(zip(buildings, good_sections))
 
     def _gen_single_example(self, validation=False):
         buildings = (self.validation_buildings if validation
@@ -823,11 +1366,16 @@ class NILMTKSource(Source):
         relative_start = self.rng.randint(0, latest_start)
         start = section.start + timedelta(seconds=relative_start)
         end = start + timedelta(seconds=max_duration)
-        sections = [TimeFrame(start, end)]
-        mains_power = elec.mains().power_series(
-            sample_period=self.sample_period, sections=sections).next()
-        appliances_power = self.metergroups[building_i].dataframe_of_meters(
-            sample_period=self.sample_period, sections=sections)
+        if self._block_cache is None:
+            sections = [TimeFrame(start, end)]
+            mains_power = elec.mains().power_series(
+                sample_period=self.sample_period, sections=sections).next()
+            metergroup = self.metergroups[building_i]
+            appliances_power = metergroup.dataframe_of_meters(
+                sample_period=self.sample_period, sections=sections)
+        else:
+            mains_power, appliances_power = self._load_from_cache(
+                building_i, start)
 
         def truncate(data):
             n = len(data)
@@ -846,6 +1394,30 @@ class NILMTKSource(Source):
 
         return appliances_power, mains_power, time_of_day
 
+    def _load_from_cache(self, building_i, start):
+        start_secs = start.value // NS_PER_SEC
+        mains_power = self._block_cache.series(
+            (building_i, 'mains'), start_secs, self.seq_length, tz=self.tz)
+        meters = self.metergroups[building_i].meters
+        appliances_power = pd.DataFrame(
+            OrderedDict(
+                (meter.identifier, self._block_cache.window(
+                    (building_i, meter_i), start_secs, self.seq_length))
+                for meter_i, meter in enumerate(meters)),
+            index=mains_power.index)
+        return mains_power, appliances_power
+
+    def _load_block(self, key, start, end):
+        building_i, meter_i = key
+        if meter_i == 'mains':
+            meter = self.dataset.buildings[building_i].elec.mains()
+        else:
+            meter = self.metergroups[building_i].meters[meter_i]
+        timeframe = TimeFrame(
+            start.tz_convert(self.tz), end.tz_convert(self.tz))
+        return meter.power_series_all_data(
+            sections=[timeframe], sample_period=self.sample_period)
+
 
 def timestamp_to_int(ts):
     ts = pd.Timestamp(ts)
@@ -954,21 +1526,42 @@ class NILMTKSourceOld(Source):
         else:
             y = None
         X_quantized = np.empty(shape=self.input_shape())
-        for i in range(self.n_seq_per_batch):
-            X_quantized[i, :, 0] = X[i, :, 0]  # time of day
-            X_quantized[i, :, 1:] = quantize(X[i, :, 1], self.n_inputs)
+        X_quantized[:, :, 0] = X[:, :, 0]  # time of day
+        X_quantized[:, :, 1:] = quantize(X[:, :, 1], self.n_inputs)
 
         return X_quantized, y
 
 
 class RandomSegments(Source):
+    DATA_FIELDS = Source.DATA_FIELDS + (
+        'filename', 'target_appliance', '_window', 'train_buildings',
+        'validation_buildings', 'sample_period', 'ignore_incomplete',
+        'on_power_threshold')
+    # Attempts at each example before it is left as zeros
+    N_RETRIES = 10
+
     def __init__(self, filename, target_appliance,
                  train_buildings, validation_buildings,
                  window=(None, None),
                  sample_period=6,
                  ignore_incomplete=False,
                  on_power_threshold=50,
+                 block_cache_mb=None,
+                 block_duration=6*60*60,
                  **kwargs):
+        """
+        Parameters
+        ----------
+        block_cache_mb : int, optional
+            If set then `_load_data` reads through a BlockCache of this
+            size, and the windows for each batch are read block by block,
+            instead of querying the dataset for every example.  Lets
+            datasets larger than RAM be sampled quickly.
+        block_duration : int
+            Seconds of data in each cached block.
+        """
+        self.filename = filename
+        self._window = window
         self.dataset = DataSet(filename)
         self.dataset.set_window(*window)
         self.window = self.dataset.store.window
@@ -979,37 +1572,66 @@ class RandomSegments(Source):
         self.sample_period = sample_period
         self.ignore_incomplete = ignore_incomplete
         self.on_power_threshold = on_power_threshold
+        self.block_cache_mb = block_cache_mb
+        if block_cache_mb:
+            self._block_cache = BlockCache(
+                self._load_block, sample_period,
+                block_duration=block_duration,
+                max_bytes=block_cache_mb * (2 ** 20))
+        else:
+            self._block_cache = None
         super(RandomSegments, self).__init__(n_outputs=1, n_inputs=1, **kwargs)
 
     def _init_data(self):
         """Overridden by sub-classes."""
         self.good_sections = {}
-        seq_duration_secs = self.seq_length * self.sample_period
-        for building_i in self.get_all_buildings():
-            elec = self.dataset.buildings[building_i].elec
-            try:
-                target_meter, _ = get_meter_for_appliance(
-                    elec, self.target_appliance)
-            except KeyError:
-                self.logger.info(
-                    "Building {} has no {}"
-                    .format(building_i, self.target_appliance))
+        buildings = self.get_all_buildings()
+        jobs = [dict(filename=self.filename,
+                     window=self._window_for_building(building_i),
+                     building_i=building_i,
+                     target_appliance=self.target_appliance,
+                     min_duration=self.seq_length * self.sample_period)
+                for building_i in buildings]
+        results = self._map_buildings(_load_good_sections, jobs)
+        for building_i, good_sections in zip(buildings, results):
+            if good_sections is None:
                 self._remove_building(building_i)
-                continue
-            mains_good_sections = elec.mains().good_sections()
-            target_good_sections = target_meter.good_sections()
-            good_sections = mains_good_sections.intersection(
-                target_good_sections)
-            good_sections = good_sections.remove_shorter_than(
-                seq_duration_secs)
-
-            if len(good_sections) > 0:
+            elif len(good_sections) > 0:
                 self.good_sections[building_i] = good_sections
             else:
                 self.logger.info(
                     "Building {} has no good sections in window."
                     .format(building_i))
                 self._remove_building(building_i)
+        self._good_section_index = self._section_indexes(self.good_sections)
+
+    def _section_indexes(self, sections):
+        """
+        Parameters
+        ----------
+        sections : dict
+            Maps building_i to a TimeFrameGroup.
+
+        Returns
+        -------
+        dict mapping building_i to {validation: SectionIndex}.  If the
+        train and validation buildings are the same then the last section
+        of each building is kept for validation.
+        """
+        seq_duration_secs = self.seq_length * self.sample_period
+        same_buildings = (
+            set(self.train_buildings) == set(self.validation_buildings))
+        indexes = {}
+        for building_i, timeframes in sections.items():
+            index = SectionIndex.from_timeframes(
+                timeframes, self.sample_period, seq_duration_secs)
+            if same_buildings:
+                indexes[building_i] = {
+                    False: index.subset(slice(None, -1)),
+                    True: index.subset(slice(-1, None))}
+            else:
+                indexes[building_i] = {False: index, True: index}
+        return indexes
 
     def _remove_building(self, building_i):
         def remove(lst):
@@ -1026,71 +1648,150 @@ class RandomSegments(Source):
     def get_all_buildings(self):
         return list(set(self.train_buildings + self.validation_buildings))
 
-    def _gen_single_example(self, validation=False):
-        # Select a building
-        buildings = (self.validation_buildings if validation
-                     else self.train_buildings)
-        building_i = self.rng.choice(buildings, 1)[0]
+    def _window_for_building(self, building_i):
+        """(start, end) to load for `building_i`, as passed to
+        `DataSet.set_window`."""
+        window_per_building = getattr(self, 'window_per_building', None)
+        if window_per_building:
+            return tuple(window_per_building[building_i])
+        return tuple(self._window)
 
-        # Select a good section from building
-        good_sections = self.good_sections[building_i]
-        timeframe = self._select_section_and_time_and_load(
-            validation, good_sections)
+    def _gen_single_example(self, validation=False, building_i=None,
+                            start=None):
+        """
+        Parameters
+        ----------
+        validation : bool
+        building_i : int, optional
+            If None then select a building at random.
+        start : int, optional
+            Start of the window in seconds since the epoch.  If None then
+            select a window at random from the building's good sections.
+        """
+        # Select a building
+        if building_i is None:
+            buildings = (self.validation_buildings if validation
+                         else self.train_buildings)
+            building_i = self.rng.choice(buildings, 1)[0]
+
+        # Select a time window from the building's good sections
+        if start is None:
+            timeframe = self._select_section_and_time_and_load(
+                validation, self._good_section_index[building_i])
+        else:
+            timeframe = self._timeframe(start)
         mains = self._load_data('mains', building_i, timeframe)
         appliance = self._load_data('target', building_i, timeframe)
         return mains, appliance
 
-    def _select_section_and_time_and_load(self, validation, good_sections):
-        if set(self.train_buildings) == set(self.validation_buildings):
-            if validation:
-                good_sections = good_sections[-1:]
-            else:
-                good_sections = good_sections[:-1]
-        if len(good_sections) > 1:
-            good_section_i = self.rng.randint(low=0, high=len(good_sections)-1)
-        else:
-            good_section_i = 0
-        good_section = good_sections[good_section_i]
+    def _select_section_and_time_and_load(self, validation, section_index):
+        """
+        Parameters
+        ----------
+        validation : bool
+        section_index : dict
+            Maps validation to a SectionIndex.  See `_section_indexes`.
 
-        # Select a time window from within good section
-        seq_duration_secs = self.seq_length * self.sample_period
-        max_start_offset_secs = (good_section.timedelta.total_seconds() -
-                                 seq_duration_secs)
-        if max_start_offset_secs > 0:
-            offset_secs = self.rng.randint(0, max_start_offset_secs)
-        else:
-            offset_secs = 0
-        offset = timedelta(seconds=offset_secs)
-        start = good_section.start + offset
-        end = start + timedelta(seconds=seq_duration_secs)
-        timeframe = TimeFrame(start, end)
-        return timeframe
+        Returns
+        -------
+        TimeFrame drawn uniformly from all windows in all sections.
+        """
+        return self._timeframe(section_index[validation].sample(self.rng))
 
-    def _load_data(self, mains_or_target, building_i, timeframe):
+    def _timeframe(self, start):
+        """TimeFrame of one sequence starting at `start` seconds since
+        the epoch."""
+        start = pd.Timestamp(int(start) * NS_PER_SEC, tz='UTC')
+        start = start.tz_convert(self.tz)
+        end = start + timedelta(seconds=self.seq_length * self.sample_period)
+        return TimeFrame(start, end)
+
+    def _electric(self, mains_or_target, building_i):
         elec = self.dataset.buildings[building_i].elec
         if mains_or_target == 'mains':
-            electric = elec.mains()
+            return elec.mains()
         elif mains_or_target == 'target':
-            electric = elec[self.target_appliance]
+            return elec[self.target_appliance]
         else:
             raise RuntimeError("Unrecognised: '" + mains_or_target + "'")
-        data = electric.power_series_all_data(
+
+    def _load_block(self, key, start, end):
+        building_i, mains_or_target = key
+        timeframe = TimeFrame(
+            start.tz_convert(self.tz), end.tz_convert(self.tz))
+        electric = self._electric(mains_or_target, building_i)
+        return electric.power_series_all_data(
             sections=[timeframe], sample_period=self.sample_period)
+
+    def _load_data(self, mains_or_target, building_i, timeframe):
+        if self._block_cache is not None:
+            return self._load_data_from_cache(
+                mains_or_target, building_i, timeframe)
+        electric = self._electric(mains_or_target, building_i)
+        data = electric.power_series_all_data(
+            sections=[timeframe], sample_period=self.sample_period).values
         if mains_or_target == 'target' and self.ignore_incomplete:
             data = self._remove_incomplete(data)
-        data.fillna(0, inplace=True)
-        data = data.values[:self.seq_length]
+        data = np.nan_to_num(data[:self.seq_length])
         pad_width = self.seq_length - len(data)
         data = np.pad(data, (0, pad_width), 'constant')
         return data
 
+    def _load_data_from_cache(self, mains_or_target, building_i, timeframe):
+        key = (building_i, mains_or_target)
+        start = timeframe.start.value // NS_PER_SEC
+        data = self._block_cache.window(key, start, self.seq_length)
+        if mains_or_target == 'target' and self.ignore_incomplete:
+            data = self._remove_incomplete(data)
+        return np.nan_to_num(data)
+
     def _gen_data(self, validation=False):
+        # Draw the building and window of every example at once
+        buildings = (self.validation_buildings if validation
+                     else self.train_buildings)
+        building_ids = self.rng.choice(buildings, self.n_seq_per_batch)
+        starts = np.zeros(self.n_seq_per_batch, dtype=np.int64)
+        for building_i in np.unique(building_ids):
+            in_building = building_ids == building_i
+            index = self._good_section_index[building_i][validation]
+            starts[in_building] = index.sample(
+                self.rng, n=in_building.sum())
+        if self._block_cache is not None:
+            self._block_cache.prefetch(
+                ((building_i, mains_or_target), start, self.seq_length)
+                for building_i, start in zip(building_ids, starts)
+                for mains_or_target in ['mains', 'target'])
+
+        return self._gen_examples(validation, zip(building_ids, starts))
+
+    def _gen_examples(self, validation, first_attempts=None):
+        """Generate a batch one example at a time with
+        `_gen_single_example`, making up to `N_RETRIES` attempts at each
+        example.  Examples which fail every attempt are left as zeros.
+
+        Parameters
+        ----------
+        validation : bool
+        first_attempts : list of tuples, optional
+            One per example.  Extra arguments for the first attempt at
+            each example, e.g. (building_i, start).  Retries are drawn at
+            random.
+
+        Returns
+        -------
+        X, y
+        """
         X = np.zeros(self.input_shape(), dtype=np.float32)
         y = np.zeros(self.output_shape(), dtype=np.float32)
-        N_RETRIES = 10
+        if first_attempts is not None:
+            first_attempts = list(first_attempts)
         for i in range(self.n_seq_per_batch):
-            for retry in range(N_RETRIES):
-                single_X, single_y = self._gen_single_example(validation)
+            for retry in range(self.N_RETRIES):
+                if retry == 0 and first_attempts is not None:
+                    single_X, single_y = self._gen_single_example(
+                        validation, *first_attempts[i])
+                else:
+                    single_X, single_y = self._gen_single_example(validation)
                 if single_X is not None and single_y is not None:
                     X[i, :, 0], y[i, :, 0] = single_X, single_y
                     break
@@ -1100,61 +1801,63 @@ class RandomSegments(Source):
         return [self.target_appliance]
 
     def _remove_incomplete(self, data):
-        activations = activation_series_for_chunk(
-            data, on_power_threshold=self.on_power_threshold)
-        new_data = pd.Series(0, index=data.index)
-        for activation in activations:
-            if activation is not None:
-                new_data = new_data.add(activation, fill_value=0)
-        return new_data
+        """
+        Parameters
+        ----------
+        data : 1D np.ndarray
+
+        Returns
+        -------
+        `data` with everything except complete activations set to zero.
+        """
+        return remove_incomplete(
+            data, self.sample_period,
+            on_power_threshold=self.on_power_threshold)
 
 
 class RandomSegmentsInMemory(RandomSegments):
     def _init_data(self):
         super(RandomSegmentsInMemory, self)._init_data()
         self.data = OrderedDict()
-        for building_i in self.get_all_buildings():
-            elec = self.dataset.buildings[building_i].elec
-            try:
-                meter, target_app = get_meter_for_appliance(
-                    elec, self.target_appliance)
-            except KeyError:
-                self.logger.info(
-                    "Building {} has no {}"
-                    .format(building_i, self.target_appliance))
-                self._remove_building(building_i)
-                continue
-            target = meter.power_series_all_data(
-                sample_period=self.sample_period)
-            if target is None:
-                self.logger.info(
-                    "Building {} has no target data in time window."
-                    .format(building_i))
+        buildings = self.get_all_buildings()
+        jobs = [dict(filename=self.filename,
+                     window=self._window_for_building(building_i),
+                     building_i=building_i,
+                     target_appliance=self.target_appliance,
+                     sample_period=self.sample_period)
+                for building_i in buildings]
+        results = self._map_buildings(_load_mains_and_target, jobs)
+        for building_i, data in zip(buildings, results):
+            if data is None:
                 self._remove_building(building_i)
             else:
-                target.fillna(0, inplace=True)
-                self.data[building_i] = {
-                    'mains': elec.mains().power_series_all_data(
-                        sample_period=self.sample_period).dropna(),
-                    'target': target
-                }
-            gc.collect()
+                self.data[building_i] = data
+        gc.collect()
 
     def _load_data(self, mains_or_target, building_i, timeframe):
         try:
             building_data = self.data[building_i]
         except KeyError:
             return
-        data = building_data[mains_or_target][timeframe.start:timeframe.end]
+        data = building_data[mains_or_target]
+        start_i = data.index_of(timeframe.start)
+        data = data.window(start_i, self.seq_length)
         if mains_or_target == 'target' and self.ignore_incomplete:
             data = self._remove_incomplete(data)
-        data = data.values[:self.seq_length]
         pad_width = self.seq_length - len(data)
         data = np.pad(data, (0, pad_width), 'constant')
         return data
 
 
 class SameLocation(RandomSegments):
+    N_LEAD_IN = 50  # number of samples to lead in with
+    DATA_FIELDS = RandomSegments.DATA_FIELDS + (
+        'offset_probability', 'ignore_offset_activations',
+        'clip_appliance_power', 'max_appliance_power', 'skip_probability',
+        'allow_incomplete', 'include_all', 'divide_target_by',
+        'window_per_building', 'load_mains', 'min_on_duration',
+        'min_off_duration')
+
     def __init__(self,
                  offset_probability=0,
                  ignore_offset_activations=False,
@@ -1171,6 +1874,7 @@ class SameLocation(RandomSegments):
                  on_power_threshold=40,
                  min_on_duration=12,
                  min_off_duration=12,
+                 activations_cache_dir=None,
                  *args,
                  **kwargs):
         self.offset_probability = offset_probability
@@ -1188,6 +1892,8 @@ class SameLocation(RandomSegments):
             raise ValueError(
                 "Cannot set both `window_per_building` and `window`")
         self.window_per_building = window_per_building
+        self.activations_cache_dir = activations_cache_dir
+        self._window = window
         kwargs['ignore_incomplete'] = ignore_incomplete
         kwargs['window'] = window
         kwargs['on_power_threshold'] = on_power_threshold
@@ -1201,15 +1907,21 @@ class SameLocation(RandomSegments):
         self._load_activations()
         if self.load_mains:
             self._load_mains()
+            self._init_placements()
+            if self.include_all:
+                self._init_activation_index()
         if self.skip_probability and self.load_mains:
             self._load_sections_without_target()
         self.dataset.store.close()
 
+    def _gen_data(self, validation=False):
+        return self._gen_examples(validation)
+
     def _load_sections_without_target(self):
         self.sections_without_target = {}
         for building_i in self.get_all_buildings():
             sections_without_target = TimeFrameGroup()
-            mains_start = self.mains[building_i].index[0]
+            mains_start = self.mains[building_i].timestamp(0)
             prev_end = mains_start
             for activation in self.activations[building_i]:
                 activation_start = activation.index[0]
@@ -1227,7 +1939,8 @@ class SameLocation(RandomSegments):
                 else:
                     sections_without_target.append(timeframe)
                 prev_end = activation.index[-1]
-            mains_end = self.mains[building_i].index[-1]
+            mains_end = self.mains[building_i].timestamp(
+                len(self.mains[building_i]) - 1)
             if prev_end < mains_end:
                 sections_without_target.append(
                     TimeFrame(prev_end, mains_end))
@@ -1239,6 +1952,83 @@ class SameLocation(RandomSegments):
             if len(sections_without_target) > 0:
                 self.sections_without_target[building_i] = (
                     sections_without_target)
+        self._sections_without_target_index = self._section_indexes(
+            self.sections_without_target)
+
+    def _init_placements(self):
+        """For each activation, find the range of window starts (mains
+        grid indices) which `_gen_single_example_` may use: gap-free
+        mains, no earlier activation in the window, and reachable with the
+        configured offsets.  Activations whose un-offset window is not
+        valid are never selected, so sampling never needs to retry.
+
+        Sets `self._placements` and `self.n_valid_placements`, which maps
+        building_i to the number of distinct valid windows.
+        """
+        self._placements = {}
+        self.n_valid_placements = {}
+        same_buildings = (
+            set(self.validation_buildings) == set(self.train_buildings))
+        for building_i in self.get_all_buildings():
+            activations = self.activations[building_i]
+            mains = self.mains[building_i]
+            n_activations = len(activations)
+            starts = np.array([a.index[0].value for a in activations],
+                              dtype=np.int64)
+            ends = np.array([a.index[-1].value for a in activations],
+                            dtype=np.int64)
+            lengths = np.array([len(a) for a in activations], dtype=np.int64)
+            base = mains.indices_of(starts) - self.N_LEAD_IN
+
+            # Window starts reachable with the offsets in
+            # `_gen_single_example_`
+            lo = base.copy()
+            hi = base.copy()
+            if self.offset_probability:
+                if self.allow_incomplete:
+                    max_backwards = self.N_LEAD_IN + lengths
+                    max_forwards = np.zeros(n_activations, dtype=np.int64)
+                    max_forwards += self.seq_length - self.N_LEAD_IN
+                else:
+                    max_backwards = np.zeros(n_activations, dtype=np.int64)
+                    max_backwards += self.N_LEAD_IN
+                    max_forwards = (
+                        self.seq_length - self.N_LEAD_IN - lengths)
+                hi += np.maximum(max_backwards - 1, 0)
+                lo -= np.maximum(max_forwards - 1, 0)
+
+            # Window must lie in the gap-free run containing `base`
+            run_starts, run_ends = mains.complete_runs()
+            run_i = np.searchsorted(run_starts, base, side='right') - 1
+            run_i = np.clip(run_i, 0, len(run_starts) - 1)
+            lo = np.maximum(lo, run_starts[run_i])
+            hi = np.minimum(hi, run_ends[run_i] - self.seq_length)
+
+            # Window must start at or after the end of the previous
+            # activation
+            if n_activations > 1:
+                lo[1:] = np.maximum(lo[1:], mains.indices_of(ends[:-1]))
+
+            valid = (lo <= base) & (base <= hi)
+            ids = np.arange(n_activations)
+            if same_buildings:
+                n_validation_activations = (
+                    self.n_seq_per_batch // len(self.validation_buildings))
+                is_validation = ids < n_validation_activations
+                train_ids = ids[valid & ~is_validation]
+                validation_ids = ids[valid & is_validation]
+            else:
+                train_ids = validation_ids = ids[valid]
+            self._placements[building_i] = {
+                'base': base, 'lo': lo, 'hi': hi,
+                'train_ids': train_ids, 'validation_ids': validation_ids}
+            self.n_valid_placements[building_i] = int(
+                (hi[valid] - lo[valid] + 1).sum())
+            self.logger.info(
+                "Building {:d}: {:d} of {:d} activations have valid"
+                " placements ({:d} windows)."
+                .format(building_i, int(valid.sum()), n_activations,
+                        self.n_valid_placements[building_i]))
 
     def _gen_single_example(self, validation=False):
         N_RETRIES = 256
@@ -1259,8 +2049,10 @@ class SameLocation(RandomSegments):
         * pick building at random
         * pick an activation at random
         * data is that activation, padded at the end, plus mains at same time.
+
+        Only activations and offsets found by `_init_placements` are used.
         """
-        N_LEAD_IN = 50  # number of samples to lead in with
+        N_LEAD_IN = self.N_LEAD_IN
 
         # pick a building
         buildings = (self.validation_buildings if validation
@@ -1269,18 +2061,16 @@ class SameLocation(RandomSegments):
 
         # pick an activation
         activations = self.activations[building_i]
-        if set(self.validation_buildings) == set(self.train_buildings):
-            n_validation_activations = (
-                self.n_seq_per_batch // len(self.validation_buildings))
-            if validation:
-                activations = activations[:n_validation_activations]
-            else:
-                activations = activations[n_validation_activations:]
-        if len(activations) == 0:
+        placements = self._placements[building_i]
+        ids = placements['validation_ids' if validation else 'train_ids']
+        if len(ids) == 0:
             raise RuntimeError(
                 "No activations.  validation={}".format(validation))
-        activation_i = self.rng.randint(low=0, high=len(activations)-1)
+        activation_i = ids[self.rng.randint(low=0, high=len(ids))]
         activation = activations[activation_i]
+        base = placements['base'][activation_i]
+        max_backwards = placements['hi'][activation_i] - base + 1
+        max_forwards = base - placements['lo'][activation_i] + 1
 
         if self.rng.binomial(n=1, p=self.skip_probability):
             return self._seq_without_target(building_i, validation)
@@ -1298,7 +2088,11 @@ class SameLocation(RandomSegments):
                     max_offset = N_LEAD_IN + len(activation)
                 else:
                     max_offset = N_LEAD_IN
-                offset = self.rng.randint(low=1, high=max_offset)
+                max_offset = min(max_offset, max_backwards)
+                if max_offset > 1:
+                    offset = self.rng.randint(low=1, high=max_offset)
+                else:
+                    offset = 0
                 if self.ignore_incomplete and offset >= N_LEAD_IN:
                     y = zeros()
                 else:
@@ -1310,6 +2104,7 @@ class SameLocation(RandomSegments):
                     max_offset = self.seq_length - N_LEAD_IN
                 else:
                     max_offset = self.seq_length - N_LEAD_IN - len(activation)
+                max_offset = min(max_offset, max_forwards)
                 if max_offset > 1:
                     offset = self.rng.randint(low=1, high=max_offset)
                 else:
@@ -1339,74 +2134,96 @@ class SameLocation(RandomSegments):
 
         # get mains
         mains = self.mains[building_i]
-        start = activation.index[0] - timedelta(
-            seconds=N_LEAD_IN * self.sample_period)
+        start_i = base
         if offset:
-            offset_timedelta = timedelta(seconds=offset * self.sample_period)
             if offset_direction == 'backwards':
-                start += offset_timedelta
+                start_i += offset
             else:
-                start -= offset_timedelta
-
-        end = start + timedelta(
-            seconds=(self.seq_length * self.sample_period) - 1)
-        X = mains[start:end]
-
-        if len(X) != self.seq_length:
+                start_i -= offset
+        if not mains.is_complete(start_i, self.seq_length):
             return None, None
+        X = mains.window(start_i, self.seq_length)
 
         # Check previous activation isn't in mains
         if activation_i > 0:
-            if activations[activation_i-1].index[-1] > X.index[0]:
+            if activations[activation_i-1].index[-1] > mains.timestamp(
+                    start_i):
                 return None, None
 
         if self.include_all:
-            y_series = pd.Series(y, index=X.index)
-            # check activations backwards
-            for i in range(activation_i-1, -1, -1):
-                other_activation = activations[i]
-                if (other_activation.index[-1] > start and
-                    (not self.ignore_incomplete or
-                     other_activation.index[0] > start)):
-                    y_series = y_series.add(
-                        other_activation[start:end], fill_value=0)
-                else:
-                    break
+            y = self._add_overlapping_activations(
+                y, building_i, activation_i, start_i)
 
-            # check activations forwards
-            for i in range(activation_i+1, len(activations)):
-                other_activation = activations[i]
-                if (other_activation.index[0] < end and
-                    (not self.ignore_incomplete or
-                     other_activation.index[-1] < end)):
-                    y_series = y_series.add(
-                        other_activation[start:end], fill_value=0)
-                else:
-                    break
-
-            y = y_series.values
+        return X, y
 
-        return X.values, y
+    def _init_activation_index(self):
+        """Index each building's activations by their first and last
+        mains grid index, and hold their values in one ragged buffer, so
+        `include_all` can find the activations which overlap a window with
+        `searchsorted`.  Assumes activations are sorted and do not overlap
+        each other."""
+        self._activation_index = {}
+        for building_i in self.get_all_buildings():
+            buffer = ActivationBuffer.from_series(
+                self.activations[building_i], self.sample_period)
+            first = self.mains[building_i].indices_of(buffer.starts)
+            self._activation_index[building_i] = {
+                'buffer': buffer,
+                'first': first,
+                'last': first + buffer.lengths - 1}
+
+    def _add_overlapping_activations(self, y, building_i, activation_i,
+                                     start_i):
+        """Add every other activation which overlaps the window starting
+        at mains grid index `start_i` to `y`, in place.  If
+        `ignore_incomplete` then only add activations which lie entirely
+        after the start (for earlier activations) or before the end (for
+        later activations) of the window."""
+        index = self._activation_index[building_i]
+        first, last = index['first'], index['last']
+        end_i = start_i + self.seq_length
+        if self.ignore_incomplete:
+            lo = np.searchsorted(first, start_i, side='right')
+            hi = np.searchsorted(last, end_i, side='left')
+        else:
+            lo = np.searchsorted(last, start_i, side='right')
+            hi = np.searchsorted(first, end_i, side='left')
+        lo = min(lo, activation_i)
+        hi = max(hi, activation_i + 1)
+        for other_i in range(lo, hi):
+            if other_i == activation_i:
+                continue
+            values = index['buffer'][other_i]
+            offset = first[other_i] - start_i
+            src_start = max(-offset, 0)
+            src_end = min(len(values), end_i - first[other_i])
+            y[offset+src_start:offset+src_end] += values[src_start:src_end]
+        return y
 
     def _seq_without_target(self, building_i, validation):
         try:
-            sections_without_target = self.sections_without_target[building_i]
+            section_index = self._sections_without_target_index[building_i]
         except KeyError:
             return None, None
+        if section_index[validation].n_total_windows == 0:
+            return None, None
 
         timeframe = self._select_section_and_time_and_load(
-            validation, sections_without_target)
+            validation, section_index)
 
         y = np.zeros(self.seq_length, dtype=np.float32)
-        X = self.mains[building_i][timeframe.start:timeframe.end]
+        mains = self.mains[building_i]
+        start_i = mains.index_of(timeframe.start)
+        if not mains.is_complete(start_i, self.seq_length):
+            return None, None
+        X = mains.window(start_i, self.seq_length)
         return X, y
 
     def _load_activations(self):
-        activations = OrderedDict()
-        self.target_good_sections = {}
+        jobs = []
         for building_i in self.get_all_buildings():
+            window = self._window_for_building(building_i)
             if self.window_per_building:
-                window = self.window_per_building[building_i]
                 self.logger.info(
                     "Setting window for building {} to (start={}, end={})"
                     .format(building_i, *window))
@@ -1421,49 +2238,79 @@ class SameLocation(RandomSegments):
                     .format(building_i, self.target_appliance))
                 self._remove_building(building_i)
                 continue
-            self.target_good_sections[building_i] = meter.good_sections()
-            activation_series = meter.activation_series(
+            load_kwargs = dict(
+                sample_period=self.sample_period,
                 on_power_threshold=self.on_power_threshold,
+                min_on_duration=self.min_on_duration,
                 min_off_duration=self.min_off_duration,
-                min_on_duration=self.min_on_duration)
-            activations[building_i] = _preprocess_activations(
-                activation_series,
                 max_power=self.max_appliance_power,
                 clip_appliance_power=self.clip_appliance_power)
+            key = activations_cache_key(
+                self.filename, building=building_i, appliance=target_app,
+                window=window, **load_kwargs)
+            jobs.append(dict(
+                filename=self.filename, window=window, building_i=building_i,
+                target_appliance=self.target_appliance,
+                load_kwargs=load_kwargs, target_app=target_app, key=key,
+                cached=is_cached(self.activations_cache_dir, key)))
+
+        # Good sections, and activations which aren't cached, are loaded in
+        # parallel if configured
+        results = self._map_buildings(_load_target_activations, jobs)
+
+        activations = OrderedDict()
+        self.target_good_sections = {}
+        for job, (good_sections, loaded) in zip(jobs, results):
+            building_i = job['building_i']
+            self.target_good_sections[building_i] = good_sections
+
+            def load(job=job, loaded=loaded):
+                if loaded is None:
+                    job = dict(job, cached=False)
+                    _, loaded = _load_target_activations(
+                        job, self.logger, dataset=self.dataset)
+                return loaded
+
+            activation_buffer = load_cached_activations(
+                self.activations_cache_dir, job['key'], load, self.logger)
+            activations[building_i] = activation_buffer.to_series_list()
             self.logger.info(
                 "Loaded {:d} {:s} activations from house {:d}.".
-                format(len(activation_series), target_app, building_i))
-            if len(activation_series) == 0:
+                format(len(activation_buffer), job['target_app'], building_i))
+            if len(activation_buffer) == 0:
                 del activations[building_i]
                 self._remove_building(building_i)
-            gc.collect()
+        gc.collect()
         self.activations = activations
 
     def _load_mains(self):
-        mains = OrderedDict()
-        for building_i in self.get_all_buildings():
+        buildings = self.get_all_buildings()
+        jobs = []
+        for building_i in buildings:
             self.logger.info(
                 "Loading mains data for building {:d}...".format(building_i))
+            window = self._window_for_building(building_i)
             if self.window_per_building:
-                window = self.window_per_building[building_i]
                 self.logger.info(
                     "  Setting window for building {} to (start={}, end={})"
                     .format(building_i, *window))
-                self.dataset.set_window(*window)
-            elec = self.dataset.buildings[building_i].elec
-            meter = elec.mains()
-            mains_data = meter.power_series_all_data(
-                sample_period=self.sample_period)
-            mains_data = mains_data.dropna()
+            jobs.append(dict(filename=self.filename, window=window,
+                             building_i=building_i,
+                             sample_period=self.sample_period))
+        results = self._map_buildings(_load_mains_grid, jobs)
+
+        mains = OrderedDict()
+        for building_i, mains_data in zip(buildings, results):
             mains[building_i] = mains_data
             self.logger.info(
-                "  Loaded mains data for building {:d}.".format(building_i))
-            gc.collect()
+                "  Loaded mains data for building {:d} ({:.1f} MB)."
+                .format(building_i, mains_data.nbytes / 1E6))
 
             # Check if any activations start *before* mains starts
             remove_activations_before_index = 0
+            mains_start = mains_data.timestamp(0)
             for i, activation in enumerate(self.activations[building_i]):
-                if activation.index[0] < mains_data.index[0]:
+                if activation.index[0] < mains_start:
                     remove_activations_before_index = i + 1
             if remove_activations_before_index > 0:
                 self.logger.info(
@@ -1471,13 +2318,32 @@ class SameLocation(RandomSegments):
                     " activations.".format(remove_activations_before_index))
                 self.activations[building_i] = self.activations[building_i][
                     remove_activations_before_index:]
+        gc.collect()
 
         self.mains = mains
 
 
 class MultiSource(Source):
-    def __init__(self, sources, standardisation_source, **kwargs):
-        """
+    # Seconds between checks of the sub-sources' queues while none of
+    # them has a batch ready.
+    POLL_INTERVAL = 0.001
+
+    def __init__(self, sources, standardisation_source, report_every=None,
+                 **kwargs):
+        """Mixes training batches from several sources.
+
+        Each sub-source generates training batches concurrently in its own
+        producer (a thread, or a process pool if the sub-source has
+        `n_producer_processes` set) into its own prefetch queue.  `get()`
+        interleaves them so that, in the long run, source i provides a
+        `train_probability` share of the batches: every call adds each
+        source's share to its credit and takes a batch from the source
+        with the most credit which has a batch ready.  So `get()` only
+        waits if no source has a batch ready, and a source which cannot
+        keep up with its share is used as often as it can be.
+
+        Validation batches are generated on demand by `get_batch`.
+
         Parameters
         ----------
         sources : list of dicts
@@ -1487,6 +2353,8 @@ class MultiSource(Source):
             - validation_probability : float [0, 1]
         standardisation_source : Source
             The source to take standardisation stats from
+        report_every : int, optional
+            If set then log `production_rates()` every this many batches.
         """
         for source_dict in sources:
             source = source_dict['source']
@@ -1494,6 +2362,15 @@ class MultiSource(Source):
             source.target_stats = standardisation_source.target_stats
         self.sources = sources
         self.standardisation_source = standardisation_source
+        self.report_every = report_every
+        train_probabilities = np.array(
+            [source_dict['train_probability'] for source_dict in sources],
+            dtype=np.float64)
+        self._train_shares = train_probabilities / train_probabilities.sum()
+        self._credit = np.zeros(len(sources))
+        self._n_batches = np.zeros(len(sources), dtype=np.int64)
+        self._n_waits = np.zeros(len(sources), dtype=np.int64)
+        self._start_time = None
         super(MultiSource, self).__init__(
             seq_length=standardisation_source.seq_length,
             n_seq_per_batch=standardisation_source.n_seq_per_batch,
@@ -1502,12 +2379,138 @@ class MultiSource(Source):
             **kwargs
         )
 
-    def get_batch(self, validation=False):
+    def data_key(self):
+        """As `Source.data_key`, plus the `data_key` and probabilities of
+        every sub-source and of the standardisation source."""
+        config = {
+            'key': super(MultiSource, self).data_key(),
+            'sources': [
+                [source_dict['source'].data_key(),
+                 source_dict['train_probability'],
+                 source_dict['validation_probability']]
+                for source_dict in self.sources],
+            'standardisation_source': self.standardisation_source.data_key()
+        }
+        return stats_key(config)
+
+    def _training_sources(self):
+        return [source_i for source_i, share in enumerate(self._train_shares)
+                if share > 0]
+
+    def start(self):
+        if self._start_time is not None:
+            return
+        for source_i in self._training_sources():
+            self.sources[source_i]['source'].start()
+        self._start_time = time.time()
+
+    def stop(self):
+        for source_dict in self.sources:
+            source_dict['source'].stop()
+        self._start_time = None
+
+    def seek(self, batch_index):
+        """Resume after `batch_index` batches.  Which source provided
+        each earlier batch depends on how fast each source was, so each
+        sub-source resumes at its expected share of `batch_index`."""
+        running = self._start_time is not None
+        self.stop()
+        self.batch_index = batch_index
+        for source_i, share in enumerate(self._train_shares):
+            self.sources[source_i]['source'].seek(
+                int(round(batch_index * share)))
+        self._credit[:] = 0
+        if running:
+            self.start()
+
+    def empty_queue(self):
+        for source_dict in self.sources:
+            source_dict['source'].empty_queue()
+
+    def qsize(self):
+        sizes = [self.sources[source_i]['source'].qsize()
+                 for source_i in self._training_sources()]
+        if None in sizes:
+            return None
+        return sum(sizes)
+
+    def get(self, timeout=30):
+        self.start()
+        # Credit is capped so a source which has fallen behind
+        # does not then provide a long run of batches.
+        self._credit = np.minimum(self._credit + self._train_shares, 1)
+        training_sources = self._training_sources()
+        by_credit = sorted(training_sources, key=lambda i: -self._credit[i])
+        deadline = time.time() + timeout
+        batch = None
+        while batch is None:
+            for source_i in by_credit:
+                try:
+                    batch = self.sources[source_i]['source'].get(timeout=0)
+                    break
+                except Empty:
+                    pass
+            else:
+                if time.time() > deadline:
+                    raise Empty()
+                time.sleep(self.POLL_INTERVAL)
+        if source_i != by_credit[0]:
+            self._n_waits[by_credit[0]] += 1
+        self._credit[source_i] -= 1
+        self._n_batches[source_i] += 1
+        self.batch_index += 1
+        batch.metadata['source_i'] = source_i
+        if self.report_every and not self.batch_index % self.report_every:
+            self._report()
+        return batch
+
+    def production_rates(self):
+        """
+        Returns
+        -------
+        list of dicts, one per source, with keys:
+        - n_batches : training batches provided since `start()`
+        - batches_per_sec : n_batches / seconds since `start()`
+        - share : fraction of all training batches provided
+        - target_share : normalised `train_probability`
+        - n_waits : number of times the source was due to provide a
+          batch but had none ready, so another source was used
+        """
+        if self._start_time is None:
+            duration = 0
+        else:
+            duration = time.time() - self._start_time
+        n_total = max(self._n_batches.sum(), 1)
+        rates = []
+        for source_i in range(len(self.sources)):
+            n_batches = int(self._n_batches[source_i])
+            rates.append({
+                'n_batches': n_batches,
+                'batches_per_sec': n_batches / duration if duration else 0.0,
+                'share': n_batches / n_total,
+                'target_share': self._train_shares[source_i],
+                'n_waits': int(self._n_waits[source_i])
+            })
+        return rates
+
+    def _report(self):
+        for source_i, rate in enumerate(self.production_rates()):
+            self.logger.info(
+                "Source {:d}: {:.2f} batches/sec, share {:.3f} (target"
+                " {:.3f}), {:d} waits".format(
+                    source_i, rate['batches_per_sec'], rate['share'],
+                    rate['target_share'], rate['n_waits']))
+
+    def get_batch(self, validation=False, batch_index=None):
         key = 'validation_probability' if validation else 'train_probability'
         probabilities = [source_dict[key] for source_dict in self.sources]
-        source_i = self.rng.choice(len(self.sources), p=probabilities)
+        if batch_index is None:
+            rng = self.rng
+        else:
+            rng = batch_rng(self.seed, batch_index, validation)
+        source_i = rng.choice(len(self.sources), p=probabilities)
         source = self.sources[source_i]['source']
-        batch = source.get_batch(validation)
+        batch = source.get_batch(validation, batch_index=batch_index)
         batch.metadata['source_i'] = source_i
         return batch
 
@@ -1516,21 +2519,43 @@ class MultiSource(Source):
 
 
 def quantize(data, n_bins, all_hot=True, range=(-1, 1), length=None):
-    midpoint = n_bins // 2
-    if length is None:
-        length = len(data)
-    out = np.empty(shape=(length, n_bins))
-    for i in np.arange(length):
-        d = data[i]
-        hist, _ = np.histogram(d, bins=n_bins, range=range)
-        if all_hot:
-            where = np.where(hist == 1)[0][0]
-            if where > midpoint:
-                hist[midpoint:where] = 1
-            elif where < midpoint:
-                hist[where:midpoint] = 1
-        out[i, :] = hist
-    return (out * 2) - 1
+    """One-hot encode each element of `data` into one of `n_bins` equal
+    width bins spanning `range`.  Elements outside `range` fall in no bin.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        If the last axis has length 1 (e.g. shape (batch, time, 1)) then
+        it is replaced by the bins, otherwise a bins axis is appended.
+    all_hot : bool
+        If True then also set every bin between the element's bin and
+        the middle bin.
+    length : int, optional
+        Only quantize data[:length].
+
+    Returns
+    -------
+    float32 np.ndarray in which each bin is -1 or 1.
+    """
+    data = np.asarray(data)
+    if length is not None:
+        data = data[:length]
+    if data.ndim > 1 and data.shape[-1] == 1:
+        data = data[..., 0]
+    edges = np.linspace(range[0], range[1], n_bins + 1)
+    bin_i = np.digitize(data, edges) - 1
+    # The last bin includes its right edge, as in np.histogram
+    bin_i[data == edges[-1]] = n_bins - 1
+    bin_i[(data < edges[0]) | (data > edges[-1])] = -1
+    bin_i = bin_i[..., np.newaxis]
+    bins = np.arange(n_bins)
+    hot = bins == bin_i
+    if all_hot:
+        midpoint = n_bins // 2
+        in_range = bin_i >= 0
+        hot |= in_range & (bins >= bin_i) & (bins < midpoint)
+        hot |= in_range & (bins >= midpoint) & (bins <= bin_i)
+    return (hot.astype(np.float32) * 2) - 1
 
 
 def standardise(X, how='range=2', mean=None, std=None, midrange=None,
@@ -1586,34 +2611,197 @@ def discretize_scalar(X, n_bins=10, all_hot=False, boolean=True):
     return output
 
 
-def discretize(X, n_bins=10, **kwargs):
+def discretize(X, n_bins=10, all_hot=False, boolean=True):
+    """Vectorised `discretize_scalar` for X of shape (batch, time, 1).
+
+    Returns
+    -------
+    float32 np.ndarray of shape (batch, time, n_bins)
+    """
     assert X.shape[2] == 1
-    output = np.zeros((X.shape[0], X.shape[1], n_bins))
-    for i in range(X.shape[0]):
-        for j in range(X.shape[1]):
-            for k in range(X.shape[2]):
-                output[i, j, :] = discretize_scalar(
-                    X[i, j, k], n_bins, **kwargs)
-    return output
+    scaled = X[:, :, 0] * n_bins
+    bin_i = np.minimum(np.trunc(scaled).astype(np.int64), n_bins - 1)
+    value = 1 if boolean else (scaled - bin_i)
+    # Negative bins count from the end, as in `discretize_scalar`
+    bin_i = np.where(bin_i < 0, bin_i + n_bins, bin_i)[:, :, np.newaxis]
+    bins = np.arange(n_bins)
+    output = np.where(bins == bin_i, np.asarray(value)[..., np.newaxis], 0)
+    if all_hot:
+        output[bins < bin_i] = 1
+    return output.astype(np.float32)
 
 
 def fdiff(X):
-    assert X.shape[2] == 1
-    output = np.zeros(X.shape)
-    for i in range(X.shape[0]):
-        output[i, :-1, 0] = np.diff(X[i, :, 0])
+    """First difference along the time axis of X, which has shape
+    (batch, time, features).  The last time step is zero.
+
+    Returns
+    -------
+    float32 np.ndarray the same shape as X.
+    """
+    output = np.zeros(X.shape, dtype=np.float32)
+    output[:, :-1, :] = np.diff(X, axis=1)
     return output
 
 
 def power_and_fdiff(X):
-    assert X.shape[2] == 1
-    output = np.zeros((X.shape[0], X.shape[1], 2))
-    for i in range(X.shape[0]):
-        output[i, :, 0] = X[i, :, 0]
-        output[i, :-1, 1] = np.diff(X[i, :, 0])
+    """X followed by `fdiff(X)` along the feature axis.
+
+    Returns
+    -------
+    float32 np.ndarray of shape (batch, time, 2 * features)
+    """
+    n_features = X.shape[2]
+    output = np.zeros((X.shape[0], X.shape[1], 2 * n_features),
+                      dtype=np.float32)
+    output[:, :, :n_features] = X
+    output[:, :-1, n_features:] = np.diff(X, axis=1)
     return output
 
 
+def load_activations(meter, sample_period, on_power_threshold,
+                     min_on_duration, min_off_duration, max_power=None,
+                     clip_appliance_power=False):
+    """Load all of `meter`'s data in the current window, resampled to
+    `sample_period`, and find its activations with `find_activations`.
+
+    Returns
+    -------
+    ActivationBuffer
+    """
+    power = meter.power_series_all_data(sample_period=sample_period)
+    if power is None or len(power) == 0:
+        return ActivationBuffer.from_series([], sample_period=sample_period)
+    power = GridSeries.from_series(power, sample_period)
+    values = power.values_with_nans()
+    starts, ends = find_activations(
+        values, sample_period, on_power_threshold=on_power_threshold,
+        min_on_duration=min_on_duration, min_off_duration=min_off_duration)
+    if clip_appliance_power:
+        values = np.maximum(values, 0)
+        if max_power is not None:
+            values = np.minimum(values, max_power)
+    return ActivationBuffer.from_array(
+        values, starts, ends, sample_period,
+        start=power.start * NS_PER_SEC, tz=power.tz)
+
+
+# Datasets opened by the loading functions below, when they run in a
+# worker process.  One read-only handle per file per process.
+_datasets = {}
+
+
+def _open_dataset(job, dataset=None):
+    if dataset is None:
+        filename = job['filename']
+        if filename not in _datasets:
+            _datasets[filename] = DataSet(filename)
+        dataset = _datasets[filename]
+    dataset.set_window(*job['window'])
+    return dataset
+
+
+def _load_appliance_activations(job, logger, dataset=None):
+    """Used by `RealApplianceSource._load_activations`."""
+    dataset = _open_dataset(job, dataset)
+    elec = dataset.buildings[job['building_i']].elec
+    meters = get_meters_for_appliances(elec, job['appliances'], logger)
+    return load_activations(meters[job['meter_i']], **job['load_kwargs'])
+
+
+def _load_target_activations(job, logger, dataset=None):
+    """Used by `SameLocation._load_activations`.
+
+    Returns
+    -------
+    good_sections, activations
+    activations : ActivationBuffer or None if `job['cached']`
+    """
+    dataset = _open_dataset(job, dataset)
+    elec = dataset.buildings[job['building_i']].elec
+    meter, _ = get_meter_for_appliance(elec, job['target_appliance'])
+    good_sections = meter.good_sections()
+    if job['cached']:
+        activations = None
+    else:
+        activations = load_activations(meter, **job['load_kwargs'])
+    return good_sections, activations
+
+
+def _load_good_sections(job, logger, dataset=None):
+    """Used by `RandomSegments._init_data`.
+
+    Returns
+    -------
+    TimeFrameGroup of sections where both mains and target are good, or
+    None if the building has no target appliance.
+    """
+    dataset = _open_dataset(job, dataset)
+    building_i = job['building_i']
+    elec = dataset.buildings[building_i].elec
+    try:
+        target_meter, _ = get_meter_for_appliance(
+            elec, job['target_appliance'])
+    except KeyError:
+        logger.info("Building {} has no {}".format(
+            building_i, job['target_appliance']))
+        return None
+    mains_good_sections = elec.mains().good_sections()
+    target_good_sections = target_meter.good_sections()
+    good_sections = mains_good_sections.intersection(target_good_sections)
+    return good_sections.remove_shorter_than(job['min_duration'])
+
+
+def _load_mains_and_target(job, logger, dataset=None):
+    """Used by `RandomSegmentsInMemory._init_data`.
+
+    Returns
+    -------
+    dict with keys 'mains' and 'target', each a GridSeries, or None if
+    the building has no target data.
+    """
+    dataset = _open_dataset(job, dataset)
+    building_i = job['building_i']
+    sample_period = job['sample_period']
+    elec = dataset.buildings[building_i].elec
+    try:
+        meter, _ = get_meter_for_appliance(elec, job['target_appliance'])
+    except KeyError:
+        logger.info("Building {} has no {}".format(
+            building_i, job['target_appliance']))
+        return None
+    target = meter.power_series_all_data(sample_period=sample_period)
+    if target is None:
+        logger.info(
+            "Building {} has no target data in time window."
+            .format(building_i))
+        return None
+    target.fillna(0, inplace=True)
+    target = GridSeries.from_series(target, sample_period)
+    mains = elec.mains().power_series_all_data(
+        sample_period=sample_period).dropna()
+    mains = GridSeries.from_series(mains, sample_period)
+    return {'mains': mains, 'target': target}
+
+
+def _load_mains_grid(job, logger, dataset=None):
+    """Used by `SameLocation._load_mains`.  Returns a GridSeries."""
+    dataset = _open_dataset(job, dataset)
+    meter = dataset.buildings[job['building_i']].elec.mains()
+    mains = meter.power_series_all_data(sample_period=job['sample_period'])
+    return GridSeries.from_series(mains.dropna(), job['sample_period'])
+
+
+def _load_mains_good_sections(job, logger, dataset=None):
+    """Used by `NILMTKSource._init_good_sections`."""
+    dataset = _open_dataset(job, dataset)
+    building_i = job['building_i']
+    logger.info("init good sections for building {}".format(building_i))
+    mains = dataset.buildings[building_i].elec.mains()
+    return [section for section in mains.good_sections()
+            if section.timedelta > job['min_duration']]
+
+
 def get_meters_for_appliances(elec, appliances, logger):
     meters = []
     for appliance_i, apps in enumerate(appliances):
@@ -1673,24 +2861,6 @@ def unstandardise(data, std, mean, maximum=None):
     return unstandardised_data
 
 
-def _preprocess_activations(activations, max_power=None, sample_period=6,
-                            clip_appliance_power=False):
-    for i, activation in enumerate(activations):
-        # tz_convert(None) is a workaround for Pandas bug #5172
-        # (AmbiguousTimeError: Cannot infer dst time from Timestamp)
-        tz = activation.index.tz.zone
-        activation = activation.tz_convert('UTC')
-        freq = "{:d}S".format(sample_period)
-        activation = activation.resample(freq)
-        activation.fillna(method='ffill', inplace=True)
-        activation.fillna(method='bfill', inplace=True)
-        if clip_appliance_power:
-            activation = activation.clip(0, max_power)
-        activation = activation.tz_convert(tz)
-        activations[i] = activation.astype(np.float32)
-    return activations
-
-
 """
 Emacs variables
 Local Variables:
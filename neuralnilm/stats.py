@@ -0,0 +1,136 @@
+from __future__ import print_function, division
+import os
+from os.path import join, exists, abspath
+import hashlib
+from datetime import date
+import numpy as np
+
+
+class RunningStats(object):
+    def __init__(self, n_features):
+        """Mean and standard deviation of each feature, accumulated one
+        chunk at a time in bounded memory.
+
+        Uses the pairwise form of Welford's algorithm (Chan et al. 1979),
+        so accumulators filled by different workers can be combined with
+        `merge()`.
+
+        Parameters
+        ----------
+        n_features : int
+        """
+        self.n_features = n_features
+        self.n = 0
+        self.mean = np.zeros(n_features, dtype=np.float64)
+        self.m2 = np.zeros(n_features, dtype=np.float64)
+
+    def update(self, data):
+        """
+        Parameters
+        ----------
+        data : np.ndarray
+            Last dimension must be n_features.  e.g. a whole batch of
+            shape (n_seq_per_batch, seq_length, n_features).
+        """
+        data = np.asarray(data, dtype=np.float64).reshape(
+            -1, self.n_features)
+        if len(data) == 0:
+            return
+        mean = data.mean(axis=0)
+        m2 = ((data - mean) ** 2).sum(axis=0)
+        self._combine(len(data), mean, m2)
+
+    def merge(self, other):
+        self._combine(other.n, other.mean, other.m2)
+
+    def _combine(self, n, mean, m2):
+        if n == 0:
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + (delta * (n / total))
+        self.m2 = self.m2 + m2 + ((delta ** 2) * (self.n * n / total))
+        self.n = total
+
+    @property
+    def std(self):
+        if self.n == 0:
+            return np.zeros(self.n_features)
+        return np.sqrt(self.m2 / self.n)
+
+    def as_dict(self):
+        return {'mean': self.mean.copy(), 'std': self.std}
+
+
+def stats_key(config, filename=None):
+    """Hash of a source's configuration.
+
+    Parameters
+    ----------
+    config : dict
+        Only values which are numbers, strings, None, dates and times
+        (e.g. pd.Timestamp), or lists, tuples and dicts of these are used.
+        Anything else (loggers, functions, loaded data) is ignored.
+    filename : str, optional
+        The dataset file.  Its path, size and modification time are part
+        of the key, so the key changes when the dataset changes.
+    """
+    def with_dates_as_strings(value):
+        if isinstance(value, date):
+            return value.isoformat()
+        if isinstance(value, (list, tuple)):
+            return [with_dates_as_strings(v) for v in value]
+        if isinstance(value, dict):
+            return dict((with_dates_as_strings(k), with_dates_as_strings(v))
+                        for k, v in value.items())
+        return value
+
+    def is_simple(value):
+        if value is None or isinstance(
+                value, (bool, int, long, float, basestring)):
+            return True
+        if isinstance(value, (list, tuple)):
+            return all(is_simple(v) for v in value)
+        if isinstance(value, dict):
+            return all(is_simple(k) and is_simple(v)
+                       for k, v in value.items())
+        return False
+
+    config = dict((key, with_dates_as_strings(value))
+                  for key, value in config.items())
+    simple = sorted(
+        (key, value) for key, value in config.items()
+        if not key.startswith('_') and is_simple(value))
+    if filename is not None and exists(filename):
+        stat = os.stat(filename)
+        simple.append(
+            (abspath(filename), stat.st_size, int(stat.st_mtime)))
+    return hashlib.sha1(repr(simple).encode('utf-8')).hexdigest()
+
+
+def save_stats(filename, input_stats, target_stats):
+    directory = os.path.dirname(filename)
+    if directory and not exists(directory):
+        os.makedirs(directory)
+    tmp_filename = filename + '.tmp.npz'
+    np.savez(tmp_filename,
+             input_mean=input_stats['mean'], input_std=input_stats['std'],
+             target_mean=target_stats['mean'], target_std=target_stats['std'])
+    os.rename(tmp_filename, filename)
+
+
+def load_stats(filename):
+    """
+    Returns
+    -------
+    input_stats, target_stats : dicts with keys 'mean' and 'std'
+    """
+    data = np.load(filename)
+    input_stats = {'mean': data['input_mean'], 'std': data['input_std']}
+    target_stats = {'mean': data['target_mean'], 'std': data['target_std']}
+    data.close()
+    return input_stats, target_stats
+
+
+def stats_filename(cache_dir, key):
+    return join(cache_dir, 'stats_' + key + '.npz')
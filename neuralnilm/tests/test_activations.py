@@ -0,0 +1,71 @@
+#!/usr/bin/python
+from __future__ import print_function, division
+import unittest
+import numpy as np
+import pandas as pd
+from nilmtk.electric import activation_series_for_chunk
+from neuralnilm.activations import find_activations, remove_incomplete
+
+SAMPLE_PERIOD = 6
+N_SAMPLES = 5000
+
+
+def gen_power(seed, nan_probability=0.0):
+    """Fridge-like power with short cycles, noise and some NaNs."""
+    rng = np.random.RandomState(seed)
+    power = np.zeros(N_SAMPLES)
+    i = rng.randint(0, 20)
+    while i < N_SAMPLES:
+        duration = min(rng.randint(1, 60), N_SAMPLES - i)
+        power[i:i+duration] = rng.uniform(20, 200, size=duration)
+        i += duration + rng.randint(1, 40)
+    power += rng.uniform(0, 8, size=N_SAMPLES)
+    power[rng.rand(N_SAMPLES) < nan_probability] = np.nan
+    index = pd.date_range('2014-01-01', periods=N_SAMPLES,
+                          freq='{:d}S'.format(SAMPLE_PERIOD), tz='UTC')
+    return pd.Series(power, index=index)
+
+
+class TestActivations(unittest.TestCase):
+    KWARGS = [
+        dict(),
+        dict(on_power_threshold=50),
+        dict(on_power_threshold=50, min_on_duration=60),
+        dict(on_power_threshold=30, min_off_duration=30),
+        dict(on_power_threshold=30, min_on_duration=120,
+             min_off_duration=60, border=3)
+    ]
+
+    def test_find_activations_matches_nilmtk(self):
+        for seed in range(3):
+            for nan_probability in (0.0, 0.001):
+                chunk = gen_power(seed, nan_probability)
+                for kwargs in self.KWARGS:
+                    expected = activation_series_for_chunk(chunk, **kwargs)
+                    starts, ends = find_activations(
+                        chunk.values, SAMPLE_PERIOD, **kwargs)
+                    self.assertEqual(len(starts), len(expected))
+                    for start, end, activation in zip(
+                            starts, ends, expected):
+                        self.assertEqual(chunk.index[start],
+                                         activation.index[0])
+                        self.assertEqual(end - start, len(activation))
+
+    def test_remove_incomplete_matches_nilmtk(self):
+        chunk = gen_power(seed=0)
+        expected = pd.Series(0, index=chunk.index)
+        for activation in activation_series_for_chunk(
+                chunk, on_power_threshold=50):
+            expected = expected.add(activation, fill_value=0)
+        result = remove_incomplete(
+            chunk.values, SAMPLE_PERIOD, on_power_threshold=50)
+        np.testing.assert_allclose(result, expected.values)
+
+    def test_no_activations(self):
+        starts, ends = find_activations(np.zeros(100), SAMPLE_PERIOD)
+        self.assertEqual(len(starts), 0)
+        self.assertEqual(len(ends), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
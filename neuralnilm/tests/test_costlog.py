@@ -0,0 +1,122 @@
+#!/usr/bin/python
+from __future__ import print_function, division
+import unittest
+import shutil
+import tempfile
+from os.path import join
+import numpy as np
+from neuralnilm.costlog import CostLog, CostTracker
+
+
+class TestCostLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.directory = join(self.tmp, 'costs')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def fill(self, cost_log, n_rows):
+        for i in range(n_rows):
+            cost_log.append({'iteration': i, 'cost': i / 10})
+
+    def test_read_includes_buffered_rows(self):
+        cost_log = CostLog(self.directory, ['iteration', 'cost'],
+                           flush_interval=4)
+        self.fill(cost_log, 10)
+        self.assertEqual(len(cost_log), 10)
+        data = cost_log.read()
+        np.testing.assert_array_equal(data['iteration'], np.arange(10))
+        # Only whole chunks of 4 have been flushed
+        self.assertEqual(len(CostLog(self.directory)), 8)
+
+    def test_reopen_and_truncate(self):
+        cost_log = CostLog(self.directory, ['iteration', 'cost'])
+        self.fill(cost_log, 10)
+        cost_log.flush()
+        cost_log.truncate(6)
+        cost_log.append({'iteration': 6, 'cost': -1})
+        cost_log.flush()
+        data = CostLog(self.directory).read()
+        np.testing.assert_array_equal(data['iteration'], np.arange(7))
+        self.assertEqual(data['cost'][-1], -1)
+
+    def test_new_columns_are_nan_for_earlier_rows(self):
+        cost_log = CostLog(self.directory, ['iteration'], flush_interval=2)
+        self.fill(cost_log, 3)
+        cost_log.append({'iteration': 3, 'source_i': 1})
+        cost_log.flush()
+        data = CostLog(self.directory).read()
+        np.testing.assert_array_equal(data['source_i'][:3], np.nan)
+        self.assertEqual(data['source_i'][3], 1)
+        self.assertTrue(np.isnan(data['cost'][3]))
+
+    def test_partial_flush_is_discarded(self):
+        cost_log = CostLog(self.directory, ['iteration', 'cost'])
+        self.fill(cost_log, 5)
+        cost_log.flush()
+        # Simulate a crash after writing only one column of a chunk
+        with open(join(self.directory, 'iteration.f8'), 'ab') as fh:
+            fh.write(np.zeros(3).tobytes())
+        cost_log = CostLog(self.directory)
+        self.assertEqual(len(cost_log), 5)
+        cost_log.append({'iteration': 5, 'cost': 0.5})
+        cost_log.flush()
+        np.testing.assert_array_equal(
+            cost_log.read()['iteration'], np.arange(6))
+
+    def test_to_csv(self):
+        cost_log = CostLog(self.directory, ['iteration', 'cost'])
+        self.fill(cost_log, 3)
+        filename = join(self.tmp, 'costs.csv')
+        cost_log.to_csv(filename)
+        data = np.genfromtxt(filename, delimiter=',', skip_header=1)
+        np.testing.assert_allclose(data, [[0, 0], [1, 0.1], [2, 0.2]])
+
+
+class TestCostTracker(unittest.TestCase):
+    def test_matches_full_history(self):
+        rng = np.random.RandomState(0)
+        costs = list(np.round(rng.rand(1000), 2))
+        tracker = CostTracker(k=25, window=100)
+        for i, cost in enumerate(costs):
+            tracker.append(cost)
+            history = costs[:i+1]
+            self.assertEqual(tracker.best, min(history))
+            self.assertEqual(tracker.best_iteration,
+                             history.index(min(history)))
+            self.assertAlmostEqual(tracker.mean_of_lowest(),
+                                   np.mean(np.sort(history)[:25]))
+            self.assertAlmostEqual(tracker.mean_of_recent(),
+                                   np.mean(history[-100:]))
+
+    def test_nan_costs_are_ignored(self):
+        costs = [1, np.nan, 3, 5, np.nan, 7]
+        tracker = CostTracker(k=2, window=3)
+        for i, cost in enumerate(costs):
+            tracker.append(cost)
+            history = np.array(costs[:i+1])
+            self.assertEqual(tracker.best, np.nanmin(history))
+            not_nan = history[~np.isnan(history)]
+            self.assertEqual(tracker.mean_of_lowest(),
+                             np.mean(np.sort(not_nan)[:2]))
+            self.assertAlmostEqual(tracker.mean_of_recent(),
+                                   np.nanmean(history[-3:]))
+        # The recent mean recovers once the NaNs leave the window
+        tracker.append(9)
+        tracker.append(11)
+        self.assertEqual(tracker.mean_of_recent(), 9)
+        tracker = CostTracker.from_costs([np.nan, np.nan])
+        self.assertTrue(np.isnan(tracker.mean_of_recent()))
+        self.assertIsNone(tracker.best)
+
+    def test_from_costs_with_iterations(self):
+        tracker = CostTracker.from_costs(
+            [3, 1, 2], iterations=[0, 10, 20], k=2)
+        self.assertEqual(tracker.best, 1)
+        self.assertEqual(tracker.best_iteration, 10)
+        self.assertEqual(tracker.mean_of_lowest(), 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+from __future__ import print_function, division
+import unittest
+import numpy as np
+from neuralnilm.source import (quantize, discretize, discretize_scalar,
+                               fdiff, power_and_fdiff)
+
+N_SEQ_PER_BATCH = 4
+SEQ_LENGTH = 64
+
+
+def gen_input(seed=0):
+    X = np.random.RandomState(seed).rand(N_SEQ_PER_BATCH, SEQ_LENGTH, 1)
+    X[0, :3, 0] = [0, 1, 0.5]  # bin edges
+    return X
+
+
+def quantize_one(x, n_bins, all_hot, range=(-1, 1)):
+    midpoint = n_bins // 2
+    hist, _ = np.histogram(x, bins=n_bins, range=range)
+    if all_hot:
+        where = np.where(hist == 1)[0][0]
+        if where > midpoint:
+            hist[midpoint:where] = 1
+        elif where < midpoint:
+            hist[where:midpoint] = 1
+    return (hist * 2) - 1
+
+
+class TestEncoders(unittest.TestCase):
+    def test_quantize(self):
+        X = (gen_input() * 2) - 1
+        for n_bins in (2, 5, 10):
+            for all_hot in (True, False):
+                output = quantize(X, n_bins, all_hot)
+                self.assertEqual(output.shape,
+                                 (N_SEQ_PER_BATCH, SEQ_LENGTH, n_bins))
+                for i in range(N_SEQ_PER_BATCH):
+                    for j in range(SEQ_LENGTH):
+                        np.testing.assert_array_equal(
+                            output[i, j],
+                            quantize_one(X[i, j, 0], n_bins, all_hot))
+
+    def test_discretize(self):
+        X = gen_input()
+        for all_hot in (True, False):
+            for boolean in (True, False):
+                output = discretize(X, 10, all_hot=all_hot, boolean=boolean)
+                for i in range(N_SEQ_PER_BATCH):
+                    for j in range(SEQ_LENGTH):
+                        expected = discretize_scalar(
+                            X[i, j, 0], 10, all_hot=all_hot, boolean=boolean)
+                        np.testing.assert_allclose(
+                            output[i, j], expected, rtol=1e-6)
+
+    def test_fdiff(self):
+        X = gen_input()
+        output = power_and_fdiff(X)
+        self.assertEqual(output.dtype, np.float32)
+        np.testing.assert_allclose(output[:, :, 0], X[:, :, 0], rtol=1e-6)
+        np.testing.assert_array_equal(output[:, :, 1:], fdiff(X))
+        for i in range(N_SEQ_PER_BATCH):
+            np.testing.assert_allclose(
+                output[i, :-1, 1], np.diff(X[i, :, 0]), rtol=1e-5)
+        np.testing.assert_array_equal(output[:, -1, 1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+from __future__ import print_function, division
+import unittest
+import shutil
+import tempfile
+from os.path import join
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from neuralnilm import source
+from neuralnilm.source import RealApplianceSource, ToySource
+from neuralnilm.activations import ActivationBuffer
+from neuralnilm.replay import validation_set_key
+from neuralnilm.net import Net
+
+APPLIANCES = ['kettle', 'toaster']
+
+
+class FakeDataSet(object):
+    """Just enough of nilmtk.DataSet for RealApplianceSource.__init__."""
+    metadata = {'timezone': 'UTC'}
+
+    def __init__(self, filename):
+        self.store = self
+
+    def set_window(self, start=None, end=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class SyntheticApplianceSource(RealApplianceSource):
+    """RealApplianceSource with random activations instead of ones loaded
+    from a dataset."""
+    def _load_activations(self, buildings, min_on_durations,
+                          min_off_durations, on_power_thresholds):
+        rng = np.random.RandomState(0)
+        activations = OrderedDict()
+        for appliance in self.appliances:
+            lengths = rng.randint(5, 20, size=40)
+            activations[appliance] = ActivationBuffer(
+                rng.uniform(10, 100, size=lengths.sum()),
+                offsets=np.cumsum(lengths) - lengths, lengths=lengths)
+        return activations
+
+
+class TestValidationSet(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.DataSet = source.DataSet
+        source.DataSet = FakeDataSet
+
+    def tearDown(self):
+        source.DataSet = self.DataSet
+        shutil.rmtree(self.tmp)
+
+    def appliance_source(self, **kwargs):
+        return SyntheticApplianceSource(
+            filename=None, appliances=APPLIANCES, min_on_durations=[0, 0],
+            seq_length=32, n_seq_per_batch=4,
+            train_buildings=[1], validation_buildings=[1], **kwargs)
+
+    def build_net(self):
+        appliance_source = self.appliance_source()
+        Net(appliance_source, layers_config=[],
+            experiment_name=join(self.tmp, 'experiment'),
+            n_validation_batches=2)
+        return appliance_source
+
+    def test_cached_validation_set_removes_used_activations(self):
+        first = self.build_net()
+        # The second Net re-uses the validation set rendered by the first
+        second = self.build_net()
+        for appliance in APPLIANCES:
+            used = first.train_activations[appliance].popped_ids()
+            self.assertTrue(len(used) > 0)
+            train_ids = second.train_activations[appliance].ids
+            self.assertEqual(len(np.intersect1d(used, train_ids)), 0)
+            np.testing.assert_array_equal(
+                train_ids, first.train_activations[appliance].ids)
+
+    def test_validation_set_key(self):
+        def key(end, **kwargs):
+            window = (pd.Timestamp('2014-01-01', tz='UTC'),
+                      pd.Timestamp(end, tz='UTC'))
+            return validation_set_key(
+                self.appliance_source(window=window, **kwargs),
+                n_validation_batches=2)
+        self.assertEqual(
+            key('2014-02-01'),
+            key('2014-02-01', prefetch=5, n_producer_processes=2))
+        self.assertNotEqual(key('2014-02-01'), key('2014-03-01'))
+
+
+class TestBestCosts(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_all_nan_costs(self):
+        net = Net(ToySource(seq_length=32, n_seq_per_batch=4),
+                  layers_config=[],
+                  experiment_name=join(self.tmp, 'experiment'))
+        net.training_costs = [np.nan]
+        net.validation_costs = [np.nan]
+        net._reset_cost_trackers()
+        net._flush_cost_logs()
+        with open(net.csv_filenames['best_costs']) as fh:
+            lines = fh.read().splitlines()
+        self.assertEqual(lines[1].split('=')[1].strip(), 'nan')
+        self.assertEqual(lines[2].split('=')[1].strip(), 'nan')
+
+
+if __name__ == '__main__':
+    unittest.main()
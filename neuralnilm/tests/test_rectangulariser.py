@@ -0,0 +1,48 @@
+#!/usr/bin/python
+from __future__ import print_function, division
+import unittest
+import numpy as np
+from neuralnilm.rectangulariser import rectangularise, start_and_end_and_mean
+
+SEQ_LENGTH = 50
+
+
+def gen_batch():
+    data = np.zeros((3, SEQ_LENGTH, 1), dtype=np.float32)
+    data[0, 20:30, 0] = 1
+    data[1, 10:40, 0] = 0.5
+    data[1, 15:25, 0] = 2
+    return data
+
+
+class TestRectangulariser(unittest.TestCase):
+    def test_changepoints(self):
+        output = rectangularise(gen_batch(), 3, format='changepoints')
+        self.assertEqual(output.shape, (3, 2, 1))
+        np.testing.assert_array_equal(output[0, :, 0], [20, 30])
+        # Greedy: the first split is at 10, then [10, 49) is split at 25
+        np.testing.assert_array_equal(output[1, :, 0], [10, 25])
+        # All zeros, so no segment can be split
+        np.testing.assert_array_equal(output[2, :, 0], [0, 0])
+
+    def test_proportional(self):
+        data = gen_batch()
+        output = rectangularise(data, 3)
+        np.testing.assert_allclose(output[0, :, 0], [0.4, 0.2, 0.4])
+        np.testing.assert_allclose(output[2, :, 0], [0, 0, 1])
+        for i in range(len(data)):
+            np.testing.assert_allclose(
+                rectangularise(data[i, :, 0], 3), output[i, :, 0])
+
+    def test_start_and_end_and_mean(self):
+        output = start_and_end_and_mean(gen_batch())
+        self.assertEqual(output.shape, (3, 3, 1))
+        np.testing.assert_allclose(output[0, :, 0], [0.4, 29 / 50, 1])
+        np.testing.assert_allclose(output[2, :, 0], [0, 0, 0])
+        np.testing.assert_allclose(
+            start_and_end_and_mean(gen_batch()[1, :, 0]),
+            [0.2, 39 / 50, (5 * 0.5 + 10 * 2 + 14 * 0.5) / 29], rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
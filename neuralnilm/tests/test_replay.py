@@ -0,0 +1,74 @@
+#!/usr/bin/python
+from __future__ import print_function, division
+import unittest
+import shutil
+import tempfile
+import numpy as np
+from neuralnilm.source import ToySource
+from neuralnilm.replay import render_batches, ReplaySource, ValidationSet
+
+N_BATCHES = 7
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = ToySource(seq_length=32, n_seq_per_batch=4)
+        render_batches(self.source, self.directory, n_batches=N_BATCHES,
+                       n_validation_batches=2, batches_per_shard=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_batches_equal(self, batch1, batch2):
+        for array1, array2 in zip(batch1.data, batch2.data):
+            np.testing.assert_array_equal(array1, array2)
+        np.testing.assert_array_equal(batch1.target_power_timeseries,
+                                      batch2.target_power_timeseries)
+
+    def test_replay_in_order(self):
+        replay = ReplaySource(self.directory, shuffle=False)
+        for batch_i in range(N_BATCHES + 2):
+            self.assert_batches_equal(
+                replay.get_batch(batch_index=batch_i),
+                self.source.get_batch(batch_index=batch_i % N_BATCHES))
+        self.assert_batches_equal(
+            replay.validation_data(),
+            self.source.get_batch(validation=True, batch_index=0))
+
+    def pass_order(self, replay, pass_i):
+        """First sequence of each batch in one pass over the batches."""
+        order = []
+        for batch_i in range(N_BATCHES):
+            X, y = replay.get_batch(
+                batch_index=(pass_i * N_BATCHES) + batch_i).data
+            order.append(X[0].tobytes())
+        return order
+
+    def test_shuffle(self):
+        rendered = [self.source.get_batch(batch_index=batch_i).data[0][0]
+                    .tobytes() for batch_i in range(N_BATCHES)]
+        replay = ReplaySource(self.directory)
+        passes = [self.pass_order(replay, pass_i) for pass_i in range(2)]
+        for order in passes:
+            self.assertEqual(sorted(order), sorted(rendered))
+            self.assertNotEqual(order, rendered)
+        self.assertNotEqual(passes[0], passes[1])
+
+        replay = ReplaySource(self.directory, shuffle=False)
+        for pass_i in range(2):
+            self.assertEqual(self.pass_order(replay, pass_i), rendered)
+
+    def test_validation_set(self):
+        validation_set = ValidationSet(self.directory)
+        self.assertEqual(validation_set.input_shape, (4, 32, 1))
+        self.assertEqual(validation_set.output_shape, (4, 32, 1))
+        self.assertEqual(len(validation_set), 2)
+        for batch_i, batch in enumerate(validation_set):
+            self.assert_batches_equal(
+                batch, self.source.get_batch(
+                    validation=True, batch_index=batch_i))
+
+
+if __name__ == '__main__':
+    unittest.main()
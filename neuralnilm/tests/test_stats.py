@@ -0,0 +1,63 @@
+#!/usr/bin/python
+from __future__ import print_function, division
+import unittest
+import shutil
+import tempfile
+from os.path import join, exists
+import numpy as np
+from neuralnilm.stats import RunningStats, save_stats, load_stats
+from neuralnilm.source import ToySource
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.batches = [rng.normal(loc=i, scale=i + 1, size=(4, 50, 3))
+                        for i in range(6)]
+        self.all_data = np.concatenate(self.batches).reshape(-1, 3)
+
+    def check(self, stats):
+        self.assertEqual(stats.n, len(self.all_data))
+        np.testing.assert_allclose(stats.mean, self.all_data.mean(axis=0))
+        np.testing.assert_allclose(stats.std, self.all_data.std(axis=0))
+
+    def test_update(self):
+        stats = RunningStats(3)
+        for batch in self.batches:
+            stats.update(batch)
+        self.check(stats)
+
+    def test_merge(self):
+        # e.g. one accumulator per worker, each seeing some of the batches
+        workers = [RunningStats(3) for _ in range(3)]
+        for batch_i, batch in enumerate(self.batches):
+            workers[batch_i % 3].update(batch)
+        stats = RunningStats(3)
+        stats.merge(RunningStats(3))
+        for worker in workers:
+            stats.merge(worker)
+        self.check(stats)
+
+    def test_save_stats_creates_directory(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = join(tmp, 'cache', 'stats_key.npz')
+            stats = {'mean': np.arange(3.), 'std': np.ones(3)}
+            save_stats(filename, stats, stats)
+            self.assertTrue(exists(filename))
+            input_stats, target_stats = load_stats(filename)
+            np.testing.assert_array_equal(input_stats['mean'], stats['mean'])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_data_key(self):
+        def key(**kwargs):
+            return ToySource(seq_length=20, n_seq_per_batch=2,
+                             **kwargs).data_key()
+        self.assertEqual(key(), key(prefetch=5, n_producer_processes=2))
+        self.assertNotEqual(key(), key(seed=1))
+        self.assertNotEqual(key(), key(on_probability=0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
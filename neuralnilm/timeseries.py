@@ -0,0 +1,326 @@
+from __future__ import print_function, division
+from collections import OrderedDict
+import threading
+import numpy as np
+import pandas as pd
+
+NS_PER_SEC = 10 ** 9
+
+
+class GridSeries(object):
+    def __init__(self, values, start, sample_period, gap_starts, gap_ends,
+                 tz=None):
+        """A regularly sampled time series held as a float32 array.
+
+        Sample i is at time `start + i * sample_period`.  Missing samples
+        are stored as zeros and recorded as runs of grid indices
+        [gap_starts[j], gap_ends[j]).
+
+        Parameters
+        ----------
+        values : 1D np.ndarray
+        start : int
+            Time of values[0] in seconds since the epoch (UTC).
+        sample_period : int
+            Seconds.
+        gap_starts, gap_ends : 1D int np.ndarrays
+        tz : str, optional
+            Timezone of the timestamps returned by `timestamp()`.
+        """
+        self.values = np.asarray(values, dtype=np.float32)
+        self.start = int(start)
+        self.sample_period = int(sample_period)
+        self.gap_starts = np.asarray(gap_starts, dtype=np.int64)
+        self.gap_ends = np.asarray(gap_ends, dtype=np.int64)
+        self.tz = tz
+
+    @classmethod
+    def from_series(cls, series, sample_period):
+        """
+        Parameters
+        ----------
+        series : pd.Series
+            Must have a DatetimeIndex aligned to `sample_period`.
+            Missing or NaN samples become gaps.
+        sample_period : int
+            Seconds.
+        """
+        secs = series.index.values.astype('datetime64[s]').astype(np.int64)
+        start = secs[0]
+        grid_i = (secs - start) // sample_period
+        n_samples = grid_i[-1] + 1
+        values = np.zeros(n_samples, dtype=np.float32)
+        valid = np.zeros(n_samples, dtype=bool)
+        series_values = series.values
+        not_nan = ~np.isnan(series_values)
+        values[grid_i[not_nan]] = series_values[not_nan]
+        valid[grid_i[not_nan]] = True
+        edges = np.diff(np.concatenate([[1], valid.astype(np.int8), [1]]))
+        gap_starts = np.flatnonzero(edges == -1)
+        gap_ends = np.flatnonzero(edges == 1)
+        tz = series.index.tz
+        return cls(values, start, sample_period, gap_starts, gap_ends,
+                   tz=None if tz is None else str(tz))
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return (self.values.nbytes + self.gap_starts.nbytes +
+                self.gap_ends.nbytes)
+
+    def index_of(self, timestamp):
+        """Grid index of the first sample at or after `timestamp`."""
+        ns = pd.Timestamp(timestamp).value - (self.start * NS_PER_SEC)
+        period_ns = self.sample_period * NS_PER_SEC
+        return int(-(-ns // period_ns))
+
+    def values_with_nans(self):
+        """Copy of `values` with NaN in the gaps."""
+        values = self.values.copy()
+        for gap_start, gap_end in zip(self.gap_starts, self.gap_ends):
+            values[gap_start:gap_end] = np.nan
+        return values
+
+    def indices_of(self, timestamps):
+        """Vectorised `index_of` for an array of int64 timestamps in
+        nanoseconds since the epoch."""
+        ns = np.asarray(timestamps, dtype=np.int64) - (
+            self.start * NS_PER_SEC)
+        period_ns = self.sample_period * NS_PER_SEC
+        return -(-ns // period_ns)
+
+    def complete_runs(self):
+        """Start and end (exclusive) grid indices of each gap-free run."""
+        run_starts = np.concatenate([[0], self.gap_ends])
+        run_ends = np.concatenate([self.gap_starts, [len(self.values)]])
+        return run_starts, run_ends
+
+    def timestamp(self, i):
+        ts = pd.Timestamp(
+            (self.start + (i * self.sample_period)) * NS_PER_SEC, tz='UTC')
+        return ts if self.tz is None else ts.tz_convert(self.tz)
+
+    def is_complete(self, start_i, n_samples):
+        """True if the window lies within the series and has no gaps."""
+        end_i = start_i + n_samples
+        if start_i < 0 or end_i > len(self.values):
+            return False
+        gap_i = np.searchsorted(self.gap_ends, start_i, side='right')
+        return not (gap_i < len(self.gap_starts) and
+                    self.gap_starts[gap_i] < end_i)
+
+    def window(self, start_i, n_samples):
+        """View of up to `n_samples` values starting at `start_i`.
+        Shorter than `n_samples` if the window runs off the end."""
+        start_i = max(start_i, 0)
+        return self.values[start_i:start_i+n_samples]
+
+
+class SectionIndex(object):
+    def __init__(self, starts, ends, sample_period, window_duration):
+        """Index of the window start times within a set of sections,
+        for drawing windows uniformly from all sections at once.
+
+        Window starts are placed every `sample_period` seconds from the
+        start of each section.  Section j holds n_windows[j] windows, and
+        a draw picks one of the sum(n_windows) windows uniformly, so
+        long sections are picked more often than short ones.
+
+        Parameters
+        ----------
+        starts, ends : 1D int np.ndarrays
+            Seconds since the epoch (UTC).
+        sample_period : int
+            Seconds.
+        window_duration : int
+            Seconds.
+        """
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.sample_period = int(sample_period)
+        self.window_duration = int(window_duration)
+        n_windows = ((self.ends - self.starts - self.window_duration) //
+                     self.sample_period) + 1
+        self.n_windows = np.clip(n_windows, 0, None)
+        self.cumulative = np.cumsum(self.n_windows)
+
+    @classmethod
+    def from_timeframes(cls, timeframes, sample_period, window_duration):
+        """
+        Parameters
+        ----------
+        timeframes : list of nilmtk.TimeFrame (or a TimeFrameGroup)
+        sample_period, window_duration : int
+            Seconds.
+        """
+        starts = [tf.start.value // NS_PER_SEC for tf in timeframes]
+        ends = [tf.end.value // NS_PER_SEC for tf in timeframes]
+        return cls(starts, ends, sample_period, window_duration)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def n_total_windows(self):
+        return int(self.cumulative[-1]) if len(self.cumulative) else 0
+
+    def subset(self, sections):
+        """New SectionIndex holding only `sections` (an index or slice)."""
+        return SectionIndex(self.starts[sections], self.ends[sections],
+                            self.sample_period, self.window_duration)
+
+    def sample(self, rng, n=None):
+        """Draw window starts uniformly, with replacement.
+
+        Parameters
+        ----------
+        rng : np.random.RandomState
+        n : int, optional
+            Number of windows.  If None then return a single int.
+
+        Returns
+        -------
+        Start times in seconds since the epoch (UTC).
+        """
+        n_total = self.n_total_windows
+        if n_total == 0:
+            raise ValueError("No sections long enough for a window.")
+        window_i = rng.randint(0, n_total, size=n)
+        section_i = np.searchsorted(self.cumulative, window_i, side='right')
+        offset_i = window_i - (self.cumulative[section_i] -
+                               self.n_windows[section_i])
+        return self.starts[section_i] + (offset_i * self.sample_period)
+
+
+class BlockCache(object):
+    def __init__(self, load_func, sample_period, block_duration=6*60*60,
+                 max_bytes=512*(2**20)):
+        """Size-bounded LRU cache of resampled data, held in fixed-length
+        blocks aligned to the epoch.
+
+        Each block is loaded with one call to `load_func`, so windows
+        which fall in the same block share one HDF5 query and resample.
+
+        Parameters
+        ----------
+        load_func : function
+            load_func(key, start, end) returns a pd.Series of the data
+            for `key` in [start, end), resampled to `sample_period`, or
+            None if there is no data.  `start` and `end` are UTC
+            pd.Timestamps.
+        sample_period : int
+            Seconds.
+        block_duration : int
+            Seconds.  Must be a multiple of `sample_period`.
+        max_bytes : int
+            The least recently used blocks are dropped once the cache
+            holds more than this.
+        """
+        if block_duration % sample_period:
+            raise ValueError(
+                "block_duration must be a multiple of sample_period")
+        self.load_func = load_func
+        self.sample_period = int(sample_period)
+        self.block_duration = int(block_duration)
+        self.max_bytes = max_bytes
+        self.samples_per_block = self.block_duration // self.sample_period
+        self.nbytes = 0
+        self.n_hits = 0
+        self.n_misses = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def window(self, key, start, n_samples):
+        """
+        Parameters
+        ----------
+        key : hashable
+            Passed to `load_func`.
+        start : int
+            Seconds since the epoch.  Rounded down to the sample grid.
+        n_samples : int
+
+        Returns
+        -------
+        1D float32 np.ndarray of length `n_samples`.  Missing samples
+        are NaN.
+        """
+        values = np.empty(n_samples, dtype=np.float32)
+        sample_i = int(start) // self.sample_period
+        end_i = sample_i + n_samples
+        out_i = 0
+        while sample_i < end_i:
+            block_i, offset = divmod(sample_i, self.samples_per_block)
+            block = self._get_block(key, block_i)
+            n = min(self.samples_per_block - offset, end_i - sample_i)
+            values[out_i:out_i+n] = block[offset:offset+n]
+            sample_i += n
+            out_i += n
+        return values
+
+    def series(self, key, start, n_samples, tz=None):
+        """Window as a pd.Series, for code which needs a DatetimeIndex."""
+        grid_start = (int(start) // self.sample_period) * self.sample_period
+        index = pd.date_range(
+            start=pd.Timestamp(grid_start * NS_PER_SEC, tz='UTC'),
+            periods=n_samples, freq="{:d}S".format(self.sample_period))
+        if tz is not None:
+            index = index.tz_convert(tz)
+        return pd.Series(self.window(key, start, n_samples), index=index)
+
+    def prefetch(self, requests):
+        """Load every block needed by a set of windows, once each and in
+        time order per key, so a batch of random windows becomes a few
+        sequential reads.
+
+        Parameters
+        ----------
+        requests : iterable of (key, start, n_samples) tuples
+        """
+        needed = set()
+        for key, start, n_samples in requests:
+            first_i = int(start) // self.sample_period
+            last_i = first_i + n_samples - 1
+            for block_i in range(first_i // self.samples_per_block,
+                                 (last_i // self.samples_per_block) + 1):
+                needed.add((key, block_i))
+        for key, block_i in sorted(needed):
+            self._get_block(key, block_i)
+
+    def clear(self):
+        with self._lock:
+            self._blocks = OrderedDict()
+            self.nbytes = 0
+
+    def _get_block(self, key, block_i):
+        with self._lock:
+            block = self._blocks.pop((key, block_i), None)
+            if block is None:
+                self.n_misses += 1
+                block = self._load_block(key, block_i)
+                self.nbytes += block.nbytes
+            else:
+                self.n_hits += 1
+            self._blocks[(key, block_i)] = block
+            while self.nbytes > self.max_bytes and len(self._blocks) > 1:
+                _, dropped = self._blocks.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+        return block
+
+    def _load_block(self, key, block_i):
+        start_secs = block_i * self.block_duration
+        start = pd.Timestamp(start_secs * NS_PER_SEC, tz='UTC')
+        end = pd.Timestamp(
+            (start_secs + self.block_duration) * NS_PER_SEC, tz='UTC')
+        block = np.empty(self.samples_per_block, dtype=np.float32)
+        block.fill(np.nan)
+        series = self.load_func(key, start, end)
+        if series is not None and len(series) > 0:
+            secs = series.index.values.astype('datetime64[s]').astype(
+                np.int64)
+            grid_i = (secs - start_secs) // self.sample_period
+            in_block = (grid_i >= 0) & (grid_i < self.samples_per_block)
+            block[grid_i[in_block]] = series.values[in_block]
+        return block
@@ -0,0 +1,90 @@
+"""Compare the batch-level input encoders in neuralnilm.source with the
+per-sample loops they replaced, and check that both give the same output.
+
+Reports milliseconds per batch for each encoder.
+"""
+from __future__ import print_function, division
+from timeit import default_timer as timer
+import numpy as np
+from neuralnilm.source import (quantize, discretize, discretize_scalar,
+                               fdiff, power_and_fdiff)
+
+N_REPEATS = 5
+SHAPE = (64, 1024, 1)
+N_BINS = 10
+
+
+def quantize_loop(data, n_bins, all_hot=True, range=(-1, 1)):
+    midpoint = n_bins // 2
+    out = np.empty(shape=(len(data), n_bins))
+    for i in np.arange(len(data)):
+        hist, _ = np.histogram(data[i], bins=n_bins, range=range)
+        if all_hot:
+            where = np.where(hist == 1)[0][0]
+            if where > midpoint:
+                hist[midpoint:where] = 1
+            elif where < midpoint:
+                hist[where:midpoint] = 1
+        out[i, :] = hist
+    return (out * 2) - 1
+
+
+def quantize_batch_loop(X, n_bins):
+    output = np.empty(X.shape[:2] + (n_bins,))
+    for i in range(X.shape[0]):
+        output[i] = quantize_loop(X[i, :, 0], n_bins)
+    return output
+
+
+def discretize_loop(X, n_bins=10, **kwargs):
+    output = np.zeros((X.shape[0], X.shape[1], n_bins))
+    for i in range(X.shape[0]):
+        for j in range(X.shape[1]):
+            output[i, j, :] = discretize_scalar(X[i, j, 0], n_bins, **kwargs)
+    return output
+
+
+def fdiff_loop(X):
+    output = np.zeros(X.shape)
+    for i in range(X.shape[0]):
+        output[i, :-1, 0] = np.diff(X[i, :, 0])
+    return output
+
+
+def power_and_fdiff_loop(X):
+    output = np.zeros((X.shape[0], X.shape[1], 2))
+    for i in range(X.shape[0]):
+        output[i, :, 0] = X[i, :, 0]
+        output[i, :-1, 1] = np.diff(X[i, :, 0])
+    return output
+
+
+def time_per_batch(func, X):
+    durations = []
+    for _ in range(N_REPEATS):
+        t0 = timer()
+        output = func(X)
+        durations.append(timer() - t0)
+    return min(durations), output
+
+
+X = np.random.RandomState(0).rand(*SHAPE)
+ENCODERS = [
+    ('quantize', (X * 2) - 1,
+     lambda X: quantize_batch_loop(X, N_BINS),
+     lambda X: quantize(X, N_BINS)),
+    ('discretize', X,
+     lambda X: discretize_loop(X, N_BINS),
+     lambda X: discretize(X, N_BINS)),
+    ('fdiff', X, fdiff_loop, fdiff),
+    ('power_and_fdiff', X, power_and_fdiff_loop, power_and_fdiff)
+]
+
+for name, data, loop_func, batch_func in ENCODERS:
+    loop_secs, expected = time_per_batch(loop_func, data)
+    batch_secs, output = time_per_batch(batch_func, data)
+    identical = np.array_equal(expected.astype(np.float32), output)
+    print("{:16s} loop {:9.3f} ms/batch  batch {:7.3f} ms/batch"
+          "  speedup {:7.1f}x  identical={}".format(
+              name, loop_secs * 1000, batch_secs * 1000,
+              loop_secs / batch_secs, identical))
@@ -0,0 +1,72 @@
+"""Compare Source._process_data with and without preallocated buffers.
+
+Reports seconds per batch and, where `tracemalloc` is available (Python 3
+or the pytracemalloc backport), the peak bytes allocated while processing
+each batch.
+"""
+from __future__ import print_function, division
+from timeit import default_timer as timer
+import numpy as np
+from neuralnilm.source import Source
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+N_BATCHES = 200
+SOURCE_KWARGS = dict(
+    seq_length=1024,
+    n_seq_per_batch=64,
+    n_inputs=1,
+    n_outputs=1,
+    standardise_input=True,
+    standardise_targets=True,
+    input_padding=32,
+    input_stats={'mean': np.array([0.1]), 'std': np.array([0.5])},
+    target_stats={'mean': np.array([0.02]), 'std': np.array([0.1])}
+)
+
+
+class RandomSource(Source):
+    def _init_data(self):
+        shape = (self.n_seq_per_batch, self.seq_length, 1)
+        self.X = self.rng.rand(*shape).astype(np.float32)
+        self.y = self.rng.rand(*shape).astype(np.float32)
+
+    def _gen_data(self, validation=False):
+        return self.X.copy(), self.y.copy()
+
+
+def benchmark(preallocate):
+    source = RandomSource(preallocate=preallocate, **SOURCE_KWARGS)
+    inputs = [source._gen_data() for _ in range(N_BATCHES)]
+    # Warm up, so every buffer in the ring and the clock are allocated
+    for _ in range(source.prefetch + 2):
+        source._process_data(*source._gen_data())
+    t0 = timer()
+    for X, y in inputs:
+        source._process_data(X, y)
+    duration = timer() - t0
+
+    if tracemalloc is None:
+        bytes_per_batch = None
+    else:
+        peaks = []
+        for X, y in inputs:
+            tracemalloc.start()
+            source._process_data(X, y)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        bytes_per_batch = np.mean(peaks)
+    return duration / N_BATCHES, bytes_per_batch
+
+
+for preallocate in [False, True]:
+    secs_per_batch, bytes_per_batch = benchmark(preallocate)
+    print("preallocate={!s:5}  {:8.3f} ms/batch".format(
+        preallocate, secs_per_batch * 1000), end='')
+    if bytes_per_batch is None:
+        print()
+    else:
+        print("  {:12,.0f} bytes allocated/batch".format(
+            bytes_per_batch))